@@ -8,12 +8,18 @@ Nicholas Turner <nturner@cs.princeton.edu>, 2015
 """
 
 import sys
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-from numba import autojit
 
 import emirt
 import utils
+import volume_io
+
+# changed whenever the arrays stored in the preprocessing cache change
+CACHE_FORMAT = 2
 
 class ZNN_Dataset(object):
 
@@ -52,6 +58,10 @@ class ZNN_Dataset(object):
         self.patch_bounds = None
         self.patch_id = 0
 
+        # size of the low side padding of a volume mirrored virtually
+        # (see volume_io.read_mirrored), None if it is not mirrored
+        self.mirror_low = None
+
     def get_dev_range(self):
         """
         Subvolumes can be specified in terms of 'deviation' from the center voxel
@@ -96,6 +106,15 @@ class ZNN_Dataset(object):
 
         loc = self.center + dev
 
+        if self.mirror_low is not None:
+            # the volume is mirrored virtually
+            begins = loc - self.patch_margin_low
+            ends   = loc + self.patch_margin_high + 1
+            subvol = volume_io.read_mirrored(data, begins, ends, self.mirror_low)
+            if rft is not None:
+                subvol = utils.data_aug_transform(subvol, rft)
+            return subvol
+
         # extract volume
         subvol  = data[ :,
             loc[0]-self.patch_margin_low[0]  : loc[0] + self.patch_margin_high[0]+1,\
@@ -187,6 +206,10 @@ class ZNN_Dataset(object):
         patch_beginnings = self.patch_bounds[patch_id][0]
         patch_ends = self.patch_bounds[patch_id][1]
 
+        if self.mirror_low is not None:
+            return volume_io.read_mirrored(self.data, patch_beginnings,
+                                           patch_ends, self.mirror_low)
+
         return self.data[ :,
                     patch_beginnings[0]:patch_ends[0],
                     patch_beginnings[1]:patch_ends[1],
@@ -258,26 +281,89 @@ class ConfigImage(ZNN_Dataset):
     rotations and flips for data augmentation.
     """
 
-    def __init__(self, config, pars, sec_name, setsz, outsz):
+    def __init__(self, config, pars, sec_name, setsz, outsz, stream=False):
 
         #Parameter object (see parser above)
         self.pars = pars
 
+        #Whether the files are read lazily patch by patch
+        self.is_stream = stream
+
         #Reading in data
         fnames = config.get(sec_name, 'fnames').split(',\n')
+        self._is_auto_crop = config.getboolean(sec_name, 'is_auto_crop')
+
+        #Cache of the preprocessed arrays (see volume_io.ArrayCache),
+        # cached holds the arrays shared by another instance or loaded
+        # from the cache, shared the arrays of this instance
+        self.cache = None
+        self.volume_key = None
+        self.cached = None
+        self.shared = None
+
+        if stream:
+            arr = self._open_files( fnames )
+            ZNN_Dataset.__init__(self, arr, setsz, outsz)
+            return
+
+        self.cache = volume_io.open_cache( pars )
+        files = list(fnames)
+        if config.has_option(sec_name, 'fmasks'):
+            files += [f for f in config.get(sec_name, 'fmasks').split(',\n') if f]
+        self.volume_key = volume_io.volume_key( files, CACHE_FORMAT, type(self).__name__,
+                                                sorted(config.items(sec_name)),
+                                                pars['dtype'], pars['is_rebalance'] )
+        self.cached = self.shared = self._load_arrays( self.volume_key )
+
+        if self.cached is not None:
+            print "reusing the preprocessed ", sec_name, "..."
+            ZNN_Dataset.__init__(self, self.cached['data'], setsz, outsz)
+            return
+
         arrlist = self._read_files( fnames );
 
         #Auto crop - constraining 3d vols to be the same size
-        self._is_auto_crop = config.getboolean(sec_name, 'is_auto_crop')
         if self._is_auto_crop:
             arrlist = self._auto_crop( arrlist )
 
         #4d array of all data
-        arr = np.asarray( arrlist, dtype=pars['dtype'])
+        arr = np.asarray( arrlist, dtype=np.result_type(*[a.dtype for a in arrlist]) )
         if arr.ndim==3:
             arr = arr.reshape( (1,) + arr.shape )
         ZNN_Dataset.__init__(self, arr, setsz, outsz)
 
+    def _load_arrays(self, key):
+        '''
+        Returns the arrays shared by another instance (see
+        volume_io.shared_arrays) or stored in the cache, None if neither
+        '''
+        arrays = volume_io.shared_arrays.get( key )
+        if arrays is None and self.cache is not None:
+            arrays = self.cache.load( key )
+            if arrays is not None:
+                arrays = volume_io.share_arrays( key, arrays )
+        return arrays
+
+    def _store_arrays(self, key, arrays):
+        '''
+        Shares the arrays with the other instances and stores them
+        in the cache if it is used
+        '''
+        arrays = volume_io.share_arrays( key, arrays )
+        if self.cache is not None:
+            self.cache.save( key, arrays )
+        return arrays
+
+    def _save_cache(self, arrays):
+        '''
+        Shares and stores the preprocessed data with the other arrays
+        if they were not reused (the lazy volumes of streaming have no
+        key and are neither shared nor stored)
+        '''
+        if self.cached is None and self.volume_key is not None:
+            arrays['data'] = self.data
+            self.shared = self._store_arrays( self.volume_key, arrays )
+
     def _recalculate_sizes(self, net_output_patch_shape):
         '''
         Adjusts the shape attributes to account for a change in the
@@ -286,10 +372,13 @@ class ConfigImage(ZNN_Dataset):
         Currently used to account for boundary mirroring within subclasses
         '''
 
+        self.fov = self.patch_shape[-3:] - net_output_patch_shape + 1
+
         self.volume_shape = np.asarray(self.data.shape[-3:])
+        if self.mirror_low is not None:
+            self.volume_shape += self.fov - 1
 
         self.center = (self.volume_shape-1) / 2
-        self.fov = self.patch_shape[-3:] - net_output_patch_shape + 1
 
         #Number of voxels with index lower than the center
         # within a subvolume (used within get_dev_range, and
@@ -367,10 +456,40 @@ class ConfigImage(ZNN_Dataset):
                 assert( vol.dtype=='uint8' and vol.shape[3]==3 )
                 vol = vol.astype('uint32')
                 vol = vol[:,:,:,0]*256*256 + vol[:,:,:,1]*256 + vol[:,:,:,2]
-            vol = vol.astype(self.pars['dtype'])
-            ret.append( vol )
+            ret.append( self._cast_volume(vol) )
         return ret
 
+    def _cast_volume(self, vol):
+        """
+        the type of the volumes kept in memory
+        """
+        return vol.astype(self.pars['dtype'])
+
+    def _open_files(self, files):
+        """
+        open a list of tif/h5 files lazily
+
+        Parameters
+        ----------
+        files : list of string, file names
+
+        Return
+        ------
+        ret : volume_io.VolumeStack, 4D lazy volume
+        """
+        vols = [volume_io.open_volume(fl) for fl in files]
+        shapes = np.asarray([vol.shape for vol in vols])
+        sz_min = shapes.min(axis=0)
+
+        if self._is_auto_crop:
+            # same offsets with _center_crop
+            offsets = [tuple((sz - sz_min + 1)/2) for sz in shapes]
+        else:
+            assert np.all(shapes == sz_min)
+            offsets = None
+
+        return volume_io.VolumeStack(vols, tuple(sz_min), offsets)
+
     def get_subvolume(self, dev, rft=[], data=None):
         """
         Returns a 4d subvolume of the original, specified
@@ -397,42 +516,180 @@ class ConfigInputImage(ConfigImage):
 
     Internally preprocesses the data, and modifies the legal
     deviation range for affinity data output.
+
+    The images are kept with their original type, the statistics of
+    the preprocessing are computed once and the patches are preprocessed
+    (and converted to the float type) when they are extracted.
     '''
 
-    def __init__(self, config, pars, sec_name, setsz, outsz ):
-        ConfigImage.__init__(self, config, pars, sec_name, setsz, outsz )
+    def __init__(self, config, pars, sec_name, setsz, outsz, stream=False ):
+        ConfigImage.__init__(self, config, pars, sec_name, setsz, outsz, stream )
 
         # preprocessing
         pp_types = config.get(sec_name, 'pp_types').split(',')
-        for c in xrange( self.data.shape[0] ):
-            self.data[c,:,:,:] = self._preprocess(self.data[c,:,:,:], pp_types[c])
+        self.pp_types = [pp_type.strip() for pp_type in pp_types]
+        if self.cached is not None:
+            self.pp_stats = [self._load_pp_stats(c)
+                             for c in xrange( self.data.shape[0] )]
+        else:
+            self.pp_stats = [self._get_pp_stats(c, self.pp_types[c])
+                             for c in xrange( self.data.shape[0] )]
+            arrays = dict()
+            for c, stats in enumerate( self.pp_stats ):
+                if stats is not None:
+                    arrays['pp_stats_%d_0' % c] = stats[0]
+                    arrays['pp_stats_%d_1' % c] = stats[1]
+            self._save_cache( arrays )
 
         if pars['is_bd_mirror']:
-            self.data = utils.boundary_mirror(self.data, self.fov)
+            # the boundary is mirrored virtually, only the voxels
+            # of the patches crossing it are copied (see get_subvolume)
+            self.mirror_low = (self.fov-1) / 2
             #Modifying the deviation boundaries for the modified dataset
             self._recalculate_sizes( outsz )
 
-    def _preprocess( self, vol3d , pp_type ):
+    def _cast_volume(self, vol):
+        """
+        images are kept with their original type
+        """
+        return vol
+
+    def _load_pp_stats( self, c ):
+        '''
+        the statistics of a channel stored in the cache (see _get_pp_stats)
+        '''
+        if 'pp_stats_%d_0' % c not in self.cached:
+            return None
+        return ( np.array(self.cached['pp_stats_%d_0' % c]),
+                 np.array(self.cached['pp_stats_%d_1' % c]) )
+
+    def _get_pp_stats( self, c, pp_type ):
+        """
+        compute the statistics of a channel needed by the preprocessing,
+        reading one section at a time.
+
+        Parameters
+        ----------
+        c : channel of the data
+        pp_type : preprocessing type
+
+        Returns
+        -------
+        stats : per-section (mean, std) arrays for standard2D,
+                (mean, std) for standard3D, (min, max) for symetric_rescale
+        """
+        dtype = self.pars['dtype']
+        Z = self.data.shape[1]
 
         if 'standard2D' == pp_type:
-            for z in xrange( vol3d.shape[0] ):
-                vol3d[z,:,:] = (vol3d[z,:,:] - np.mean(vol3d[z,:,:])) / np.std(vol3d[z,:,:])
+            mean = np.empty(Z, dtype=dtype)
+            std  = np.empty(Z, dtype=dtype)
+            for z in xrange( Z ):
+                sec = self.data[c:c+1, z:z+1, :, :].astype(dtype)
+                mean[z] = np.mean(sec)
+                std[z]  = np.std(sec)
+            return mean, std
 
         elif 'standard3D' == pp_type:
-            vol3d = (vol3d - np.mean(vol3d)) / np.std(vol3d)
+            n = s1 = s2 = 0.0
+            for z in xrange( Z ):
+                sec = self.data[c:c+1, z:z+1, :, :].astype('float64')
+                n  += sec.size
+                s1 += np.sum(sec)
+                s2 += np.sum(sec*sec)
+            mean = s1 / n
+            std  = np.sqrt( max(s2 / n - mean*mean, 0) )
+            return np.asarray(mean, dtype=dtype), np.asarray(std, dtype=dtype)
+
         elif 'symetric_rescale' == pp_type:
-            # rescale to -1,1
-            vol3d -= vol3d.min()
-            vol3d = vol3d / vol3d.max()
-            vol3d = vol3d * 2 - 1
+            vmin = vmax = None
+            for z in xrange( Z ):
+                sec = self.data[c:c+1, z:z+1, :, :]
+                vmin = sec.min() if vmin is None else min(vmin, sec.min())
+                vmax = sec.max() if vmax is None else max(vmax, sec.max())
+            return np.asarray(vmin, dtype=dtype), np.asarray(vmax, dtype=dtype)
+
         elif 'none' == pp_type or "None" in pp_type:
-            return vol3d
+            return None
 
         else:
             raise NameError( 'invalid preprocessing type' )
 
+    def _preprocess_patch( self, vol3d, pp_type, stats, zs ):
+        """
+        preprocess a patch with precomputed statistics (see _get_pp_stats),
+        giving the same result with the preprocessing of the whole volume.
+
+        Parameters
+        ----------
+        vol3d : 3D array, raw patch
+        pp_type : preprocessing type
+        stats : statistics of the channel
+        zs : section index of each patch section
+        """
+        vol3d = vol3d.astype(self.pars['dtype'])
+
+        if 'standard2D' == pp_type:
+            mean, std = stats
+            vol3d = (vol3d - mean[zs].reshape(-1,1,1)) / std[zs].reshape(-1,1,1)
+        elif 'standard3D' == pp_type:
+            vol3d = (vol3d - stats[0]) / stats[1]
+        elif 'symetric_rescale' == pp_type:
+            vol3d = (vol3d - stats[0]) / (stats[1] - stats[0])
+            vol3d = vol3d * 2 - 1
+
         return vol3d
 
+    def _preprocess_channels(self, patch, zb, ze):
+        """
+        preprocess all the channels of a raw patch
+
+        Parameters
+        ----------
+        patch : 4D array, raw patch
+        zb, ze : section range of the patch (in the padded volume)
+
+        Returns
+        -------
+        ret : 4D array with the float type
+        """
+        # original section indices of the patch
+        pad = 0 if self.mirror_low is None else self.mirror_low[0]
+        zs = volume_io.mirror_indices(zb - pad, ze - pad, self.data.shape[1])
+
+        ret = np.empty(patch.shape, dtype=self.pars['dtype'])
+        for c in xrange( patch.shape[0] ):
+            ret[c,:,:,:] = self._preprocess_patch(patch[c,:,:,:],
+                                self.pp_types[c], self.pp_stats[c], zs)
+        return ret
+
+    def get_subvolume(self, dev, rft=[]):
+        """
+        get a preprocessed sub volume for training,
+        the transformation is applied after the preprocessing.
+        """
+        if not self.pars['is_data_aug']:
+            rft = None
+
+        subvol = super(ConfigInputImage, self).get_subvolume(dev, rft=None)
+
+        zb = self.center[0] + dev[0] - self.patch_margin_low[0]
+        subvol = self._preprocess_channels(subvol, zb, zb + subvol.shape[1])
+
+        if rft is not None:
+            subvol = utils.data_aug_transform(subvol, rft)
+        return subvol
+
+    def get_patch(self, patch_id):
+        """
+        get a preprocessed patch for the forward pass
+        """
+        patch = super(ConfigInputImage, self).get_patch(patch_id)
+
+        zb = self.patch_bounds[patch_id][0][0]
+        ze = self.patch_bounds[patch_id][1][0]
+        return self._preprocess_channels(patch, zb, ze)
+
     def get_dev_range(self):
         '''Override of the CImage implementation to account
         for affinity preprocessing'''
@@ -454,6 +711,11 @@ class ConfigOutputLabel(ConfigImage):
 
     Internally handles preprocessing of the data, and can
     contain masks for sparsely-labelled training
+
+    The labels are kept with the smallest integer type holding them
+    (boolean after binary_class/one_class), and the masks are bit-packed.
+    The label channels and the mask are converted to the float type
+    only for the extracted patches.
     '''
 
     def __init__(self, config, pars, sec_name, setsz, outsz):
@@ -469,6 +731,12 @@ class ConfigOutputLabel(ConfigImage):
             self.patch_shape += 1
             self._recalculate_sizes( outsz )
 
+        self.pp_types = config.get(sec_name, 'pp_types').split(',')
+
+        if self.cached is not None:
+            self._load_cached()
+            return
+
         # deal with mask
         self.msk = np.array([])
         if config.has_option(sec_name, 'fmasks'):
@@ -477,18 +745,55 @@ class ConfigOutputLabel(ConfigImage):
                 msklist = self._read_files( fmasks )
                 if self._is_auto_crop:
                     msklist = self._auto_crop( msklist )
-                self.msk = np.asarray( msklist )
                 # mask 'preprocessing'
-                self.msk = (self.msk>0).astype(self.data.dtype)
+                self.msk = volume_io.BitMask( [msk>0 for msk in msklist] )
                 assert(self.data.shape == self.msk.shape)
 
         # preprocessing
-        self.pp_types = config.get(sec_name, 'pp_types').split(',')
         self._preprocess()
 
         if pars['is_rebalance']:
             self._rebalance()
 
+        if 'aff' in self.pp_types[0]:
+            # the segmentation is replaced by the affinity bit-planes
+            self.data = self._aff_planes()
+
+        arrays = dict()
+        if np.size(self.msk)>0:
+            arrays['msk_bits']  = self.msk.bits
+            arrays['msk_shape'] = np.asarray(self.msk.shape)
+        if pars['is_rebalance']:
+            if 'aff' in self.pp_types[0]:
+                arrays['aff_weights'] = [[self.zwp, self.zwz],
+                                         [self.ywp, self.ywz],
+                                         [self.xwp, self.xwz]]
+            else:
+                arrays['balance_weights'] = self.balance_weights
+        self._save_cache( arrays )
+
+    def _load_cached(self):
+        '''
+        restores the mask and rebalance weights stored with
+        the preprocessed labels
+        '''
+        self.msk = np.array([])
+        if 'msk_bits' in self.cached:
+            self.msk = volume_io.BitMask.from_bits( self.cached['msk_bits'],
+                                                    self.cached['msk_shape'] )
+        if 'aff_weights' in self.cached:
+            ((self.zwp, self.zwz), (self.ywp, self.ywz),
+             (self.xwp, self.xwz)) = np.array(self.cached['aff_weights'])
+        if 'balance_weights' in self.cached:
+            self.balance_weights = [tuple(w) for w in
+                                    np.array(self.cached['balance_weights'])]
+
+    def _cast_volume(self, vol):
+        """
+        labels are kept with the smallest integer type holding them
+        """
+        return utils.compact_label(vol, self.pars['dtype'])
+
     def _preprocess( self ):
         """
         preprocess the 4D image stack.
@@ -506,11 +811,11 @@ class ConfigOutputLabel(ConfigImage):
                 pass
 
             elif 'binary_class' == pp_type:
+                # the complementary channel is made for each patch
                 self.data = self._binary_class(self.data)
-                self.msk = np.tile(self.msk, (2,1,1,1))
 
             elif 'one_class' == pp_type:
-                self.data = (self.data>0).astype(self.pars['dtype'])
+                self.data = self.data>0
 
             elif 'aff' in pp_type:
                 # affinity preprocessing handled later
@@ -532,19 +837,126 @@ class ConfigOutputLabel(ConfigImage):
 
         Return
         ------
-        ret : 4D array, two volume with opposite value
+        ret : 4D boolean array, the first of the two volumes with opposite
+              value (the second one is made by _label_patch)
         """
         assert(lbl.shape[0] == 1)
 
         # fill the contacting segments with boundaries
         lbl[0,:,:,:] = utils.fill_boundary( lbl[0,:,:,:] )
 
-        ret = np.empty((2,)+ lbl.shape[1:4], dtype= self.pars['dtype'])
-        ret[0, :,:,:] = (lbl[0,:,:,:]>0).astype(self.pars['dtype'])
-        ret[1:,  :,:,:] = 1 - ret[0, :,:,:]
+        return lbl>0
+
+    def _label_patch(self, sublbl):
+        """
+        the label channels of a patch with the float type
+
+        Parameters
+        ----------
+        sublbl : 4D array, label patch as kept in memory
+
+        Return
+        ------
+        ret : 4D array, two channels with opposite value for binary_class
+        """
+        dtype = self.pars['dtype']
+        if 'binary_class' == self.pp_types[0]:
+            ret = np.empty((2,)+ sublbl.shape[1:4], dtype=dtype)
+            ret[0,:,:,:] = sublbl[0,:,:,:]
+            ret[1,:,:,:] = 1 - ret[0,:,:,:]
+            return ret
+        return sublbl.astype(dtype)
+
+    def _aff_planes(self):
+        """
+        the affinities of the whole volume as bit-planes, computed
+        section by section. Bits 0-2 are the z, y and x affinities of the
+        labels (neighbouring voxels of the same nonzero segment, as
+        emirt.volume_util.seg2aff), bits 3-5 those of the mask (both
+        voxels are masked in). The affinity of two neighbours is stored
+        at the voxel with the higher index.
+
+        Returns
+        -------
+        planes : 4D uint8 array, one channel
+        """
+        lbl = self.data[0,:,:,:]
+        planes = np.zeros((1,) + lbl.shape, dtype=np.uint8)
+        has_msk = np.size(self.msk)>0
+
+        for z in xrange( lbl.shape[0] ):
+            sec = lbl[z,:,:]
+            plane = planes[0,z,:,:]
+            if z>0:
+                plane |= ((sec == lbl[z-1,:,:]) & (sec>0)).astype(np.uint8)
+            plane[1:,:] |= ((sec[1:,:] == sec[:-1,:]) & (sec[1:,:]>0)).astype(np.uint8) << 1
+            plane[:,1:] |= ((sec[:,1:] == sec[:,:-1]) & (sec[:,1:]>0)).astype(np.uint8) << 2
+
+            if has_msk:
+                m = self.msk[0,z,:,:]
+                if z>0:
+                    plane |= (m & self.msk[0,z-1,:,:]).astype(np.uint8) << 3
+                plane[1:,:] |= (m[1:,:] & m[:-1,:]).astype(np.uint8) << 4
+                plane[:,1:] |= (m[:,1:] & m[:,:-1]).astype(np.uint8) << 5
+        return planes
+
+    def _aff_patch(self, begins, ends, rft, bit, offset):
+        """
+        the affinities of a patch read from the bit-planes, the same with
+        computing them from the transformed patch.
+
+        Parameters
+        ----------
+        begins, ends : 3 int, box of the patch
+        rft : the random transformation rule
+        bit : bit of the z affinity, 0 for the labels and 3 for the mask
+        offset : offset of the affinities along the other axes, 1 for
+                 the labels (seg2aff) and 0 for the mask (_msk2affmsk)
 
+        Returns
+        -------
+        ret : 4D array, 3 channel for z,y,x direction
+        """
+        if rft is None or np.size(rft)==0:
+            rft = [False] * 4
+
+        sz = np.asarray(ends) - np.asarray(begins) - 1
+        ret = np.empty((3,) + tuple(sz), dtype=self.pars['dtype'])
+        for c in xrange(3):
+            # the affinities of a reflected axis are taken from
+            # the other side of the edges
+            sls = list()
+            for d in xrange(3):
+                if d == c:
+                    b = begins[d] + 1
+                elif rft[d]:
+                    b = begins[d] + 1 - offset
+                else:
+                    b = begins[d] + offset
+                sls.append( slice(b, b + sz[d]) )
+            aff = (self.data[0][tuple(sls)] >> (bit + c)) & 1
+
+            flips = tuple( slice(None,None,-1) if rft[d] else slice(None)
+                           for d in xrange(3) )
+            ret[c,:,:,:] = aff[flips]
+
+        if rft[3]:
+            # the y and x affinities are swapped by the transpose
+            ret = ret[[0,2,1],:,:,:].transpose(0,1,3,2)
         return ret
 
+    def get_patch(self, patch_id):
+        """
+        get a label patch with the float type
+        """
+        if 'aff' in self.pp_types[0]:
+            self._check_patch_bounds()
+            begins, ends = self.patch_bounds[patch_id]
+            return self._aff_patch(begins, ends, None, 0, 1)
+
+        sublbl = super(ConfigOutputLabel, self).get_patch(patch_id)
+        return self._label_patch(sublbl)
+
     def get_subvolume(self, dev, rft=[]):
         """
         get sub volume for training.
@@ -560,26 +972,39 @@ class ConfigOutputLabel(ConfigImage):
         submsk : 4D array, mask could contain rebalance weight
         """
 
-        sublbl = super(ConfigOutputLabel, self).get_subvolume(dev, rft)
-
-        if np.size(self.msk)>0:
-            submsk = super(ConfigOutputLabel, self).get_subvolume(dev, rft, data=self.msk)
-        else:
-            submsk = np.array([])
-
         if 'aff' in self.pp_types[0]:
-            # transform the output volumes to affinity array
-            sublbl = emirt.volume_util.seg2aff( sublbl )
+            # the affinities are sliced from the bit-planes
+            if not self.pars['is_data_aug']:
+                rft = None
+            loc = self.center + dev
+            begins = loc - self.patch_margin_low
+            ends = loc + self.patch_margin_high + 1
+            sublbl = self._aff_patch(begins, ends, rft, 0, 1)
 
             # get the affinity mask
+            submsk = np.array([])
             if np.size(self.msk)>0:
-                #?? not sure what this is doing yet
-                submsk = self._msk2affmsk( submsk )
+                submsk = self._aff_patch(begins, ends, rft, 3, 0)
 
                 if self.pars['is_rebalance']:
                     # apply the rebalancing
                     submsk = self._rebalance_aff(sublbl, submsk)
 
+        else:
+            sublbl = super(ConfigOutputLabel, self).get_subvolume(dev, rft)
+            sublbl = self._label_patch( sublbl )
+
+            if np.size(self.msk)>0:
+                submsk = super(ConfigOutputLabel, self).get_subvolume(dev, rft, data=self.msk)
+                submsk = submsk.astype(self.pars['dtype'])
+            else:
+                submsk = np.array([])
+            if np.size(submsk)>0 and submsk.shape[0] != sublbl.shape[0]:
+                submsk = np.tile(submsk, (sublbl.shape[0],1,1,1))
+
+            if self.pars['is_rebalance']:
+                submsk = self._rebalance_patch(sublbl, submsk)
+
         # rebalance of output patch
         if self.pars['is_patch_rebalance']:
             submsk = self._patch_rebalance(sublbl, submsk)
@@ -651,36 +1076,18 @@ class ConfigOutputLabel(ConfigImage):
         else:
             return msk*wts
 
-    @autojit(nopython=True)
-    def _msk2affmsk( self, msk ):
+    def _rebalance_patch(self, lbl, msk):
         """
-        transform binary mask to affinity mask
-
-        Parameters
-        ----------
-        msk : 4D array, one channel, binary mask for boundary map
-
-        Returns
-        -------
-        ret : 4D array, 3 channel for z,y,x direction
+        apply the rebalance weights of the whole volume (_rebalance)
+        to a label patch and its mask
         """
+        wts = np.empty(lbl.shape, dtype=self.pars['dtype'])
+        for c, (wp, wz) in enumerate( self.balance_weights ):
+            wts[c,:,:,:] = np.where( lbl[c,:,:,:] > 0, wp, wz )
         if np.size(msk)==0:
-            return msk
-        C,Z,Y,X = msk.shape
-        ret = np.zeros((3, Z-1, Y-1, X-1), dtype=self.pars['dtype'])
-
-        for z in xrange(Z-1):
-            for y in xrange(Y-1):
-                for x in xrange(X-1):
-                    if msk[0,z,y,x]>0:
-                        if msk[0,z+1,y,x]>0:
-                            ret[0,z,y,x] = 1
-                        if msk[0,z,y+1,x]>0:
-                            ret[1,z,y,x] = 1
-                        if msk[0,z,y,x+1]>0:
-                            ret[2,z,y,x] = 1
-        return ret
-
+            return wts
+        else:
+            return msk*wts
 
     def _rebalance( self ):
         """
@@ -695,19 +1102,16 @@ class ConfigOutputLabel(ConfigImage):
             self.ywp, self.ywz = self._get_balance_weight(ylbl)
             self.xwp, self.xwz = self._get_balance_weight(xlbl)
         else:
-            weight = np.empty( self.data.shape, dtype=self.data.dtype )
+            # the weights are applied to each patch (_rebalance_patch)
+            self.balance_weights = list()
             for c in xrange( self.data.shape[0] ):
                 # positive is non-boundary, zero is boundary
                 wp, wz = self._get_balance_weight(self.data[c,:,:,:])
                 print "reblance weights: ", wp, ", ", wz
-                # give value
-                weight[c,:,:,:][self.data[c,:,:,:]> 0] = wp
-                weight[c,:,:,:][self.data[c,:,:,:]==0] = wz
-
-            if np.size(self.msk)==0:
-                self.msk = weight
-            else:
-                self.msk = self.msk * weight
+                self.balance_weights.append( (wp, wz) )
+            if 'binary_class' == self.pp_types[0]:
+                # the complementary channel of _label_patch
+                self.balance_weights.append( (wz, wp) )
 
     def get_candidate_loc( self, low, high ):
         """
@@ -720,30 +1124,97 @@ class ConfigOutputLabel(ConfigImage):
 
         Returns:
         --------
-        ret : a tuple, the coordinate of nonzero elements,
-              format is the same with return of numpy.nonzero.
+        ret : LocationSampler of the nonzero mask voxels within the range,
+              ordered in the same way with numpy.nonzero.
         """
-        if np.size(self.msk) == 0:
-            mask = np.ones(self.data.shape[1:4], dtype=self.data.dtype)
-        else:
-            mask = np.copy(self.msk[0,:,:,:])
-        # erase outside region of deviation range.
         ct = self.center
-        mask[:ct[0]+low[0], :, : ] = 0
-        mask[:, :ct[1]+low[1], : ] = 0
-        mask[:, :, :ct[2]+low[2] ] = 0
-
-        mask[ct[0]+high[0]+1:, :, :] = 0
-        mask[:, ct[1]+high[1]+1:, :] = 0
-        mask[:, :, ct[2]+high[2]+1:] = 0
+        shape = self.data.shape[1:4]
+
+        key = volume_io.volume_key( [], self.volume_key, tuple(low), tuple(high) )
+        self.shared_locs = self._load_arrays( key )
+        if self.shared_locs is not None:
+            return LocationSampler( shape, [self.shared_locs['starts']],
+                                    [self.shared_locs['lengths']] )
+
+        lo = np.maximum( ct + low, 0 )
+        hi = np.minimum( ct + high + 1, shape )
+
+        starts = list()
+        lengths = list()
+        # the mask is read slice by slice, only runs are kept
+        for z in xrange(lo[0], max(hi[0], lo[0])):
+            if np.size(self.msk) == 0:
+                m = np.ones( (max(hi[1]-lo[1], 0), max(hi[2]-lo[2], 0)), dtype=bool )
+            else:
+                m = self.msk[0, z, lo[1]:hi[1], lo[2]:hi[2]] != 0
+            rows, xs, ns = LocationSampler.row_runs( m )
+            starts.append( ((z*shape[1] + rows + lo[1])*shape[2] + xs + lo[2]).astype(np.int64) )
+            lengths.append( ns.astype(np.int64) )
 
-        locs = np.nonzero(mask)
+        locs = LocationSampler( shape, starts, lengths )
 
-        if np.size(locs[0])==0:
+        if len(locs)==0:
             raise NameError('no candidate location!')
 
+        self.shared_locs = self._store_arrays( key, {'starts': locs.starts,
+                                                     'lengths': locs.lengths} )
+
         return locs
 
+class LocationSampler(object):
+    """
+    Compact set of candidate locations, stored as runs of consecutive
+    valid voxels along the x axis (the flat index of the first voxel and
+    the length of each run) instead of the coordinates of every voxel.
+
+    The i-th location is the same with the i-th coordinate returned by
+    numpy.nonzero, so a uniform draw gives the same location with the
+    same random number. Finding a location is a binary search over the runs.
+    """
+
+    def __init__(self, shape, starts, lengths):
+        self.shape = tuple(shape)
+        if len(starts):
+            self.starts = np.concatenate(starts).astype(np.int64)
+            lengths = np.concatenate(lengths).astype(np.int64)
+        else:
+            self.starts = np.zeros(0, dtype=np.int64)
+            lengths = np.zeros(0, dtype=np.int64)
+        self.lengths = lengths
+        # number of locations before each run
+        self.offsets = np.cumsum(lengths) - lengths
+        self.size = int(np.sum(lengths))
+
+    @staticmethod
+    def row_runs( m ):
+        """
+        runs of nonzero elements in the rows of a 2D boolean array
+
+        Returns
+        -------
+        rows, xs, ns : row index, first column and length of each run,
+                       in row-major order
+        """
+        d = np.zeros( (m.shape[0], m.shape[1]+2), dtype=np.int8 )
+        d[:, 1:-1] = m
+        d = np.diff(d, axis=1)
+        rows, xs = np.nonzero( d==1 )
+        _, ends = np.nonzero( d==-1 )
+        return rows, xs, ends - xs
+
+    def __len__(self):
+        return self.size
+
+    def location(self, ind):
+        """the 3D coordinate of the ind-th location"""
+        r = np.searchsorted( self.offsets, ind, side='right' ) - 1
+        flat = self.starts[r] + (ind - self.offsets[r])
+        return np.asarray( np.unravel_index(flat, self.shape), dtype=np.uint32 )
+
+    def draw(self, rng=np.random):
+        """a uniformly random location"""
+        return self.location( rng.randint( self.size ) )
+
 class ConfigSample(object):
     """
     Sample Class, which represents a pair of input and output volume structures
@@ -753,8 +1224,11 @@ class ConfigSample(object):
     structures at once
 
     Designed to be similar with Dataset module of pylearn2
+
+    With stream, the input images are read lazily patch by patch for the
+    forward pass, and the labels are not read.
     """
-    def __init__(self, config, pars, sample_id, net, outsz, log=None):
+    def __init__(self, config, pars, sample_id, net, outsz, log=None, stream=False):
 
         # Parameter object (dict)
         self.pars = pars
@@ -781,7 +1255,7 @@ class ConfigSample(object):
             imid = config.getint(self.sec_name, name)
             imsec_name = "image%d" % (imid,)
 
-            self.inputs[name] = ConfigInputImage( config, pars, imsec_name, setsz, outsz )
+            self.inputs[name] = ConfigInputImage( config, pars, imsec_name, setsz, outsz, stream )
             low, high = self.inputs[name].get_dev_range()
 
             # Deviation bookkeeping
@@ -794,7 +1268,7 @@ class ConfigSample(object):
         for name, setsz in setsz_outs.iteritems():
 
             #Allowing for users to abstain from specifying labels
-            if not config.has_option(self.sec_name, name):
+            if stream or not config.has_option(self.sec_name, name):
                 continue
 
             #Finding the section of the config file
@@ -819,21 +1293,40 @@ class ConfigSample(object):
         #Filename for log
         self.log = log
 
-    def get_random_sample(self):
-        '''Fetches a matching random sample from all input and output volumes'''
+    def get_random_request(self, rng=np.random):
+        '''
+        Draws a random deviation and transformation rule
+
+        rng can be any object with the numpy.random interface
+        (e.g. a seeded np.random.RandomState)
+        '''
 
         # random transformation roll
-        rft = (np.random.rand(4)>0.5)
+        rft = (rng.rand(4)>0.5)
 
         # random deviation
-        ind = np.random.randint( np.size(self.locs[0]) )
-        loc = np.empty( 3, dtype=np.uint32 )
-        loc[0] = self.locs[0][ind]
-        loc[1] = self.locs[1][ind]
-        loc[2] = self.locs[2][ind]
+        loc = self.locs.draw( rng )
         dev = loc - self.outputs.values()[0].center
 
-        self.write_request_to_log(dev, rft)
+        return dev, rft
+
+    def get_random_sample(self, rng=np.random):
+        '''Fetches a matching random sample from all input and output volumes'''
+
+        dev, rft = self.get_random_request(rng)
+
+        return self.get_sample(dev, rft)
+
+    def get_sample(self, dev, rft, log=True):
+        '''
+        Fetches the matching sample at a given deviation and transformation
+
+        The request is written to the log unless log is False (e.g. when
+        it was logged already when drawn, see CSamplesPrefetcher)
+        '''
+
+        if log:
+            self.write_request_to_log(dev, rft)
 
         # get input and output 4D sub arrays
         inputs = dict()
@@ -892,12 +1385,24 @@ class ConfigSample(object):
             utils.write_to_log(self.log, log_line3)
 
 class ConfigSampleOutput(object):
-    '''Documentation coming soon...'''
+    '''
+    Output volumes of a full forward pass, assembled from the output
+    patches of the network
+
+    If fname is given, the volumes are datasets of a hdf5 file chunked
+    by the output patch shape, and the patches are written directly to
+    the file. Otherwise, they are in-memory arrays.
+    '''
 
-    def __init__(self, net, output_volume_shape3d, dtype):
+    def __init__(self, net, output_volume_shape3d, dtype, fname=None):
 
         output_patch_shapes = net.get_outputs_setsz()
 
+        self.file = None
+        if fname is not None:
+            import h5py
+            self.file = h5py.File(fname, 'w')
+
         self.output_volumes = {}
         for name, shape in output_patch_shapes.iteritems():
 
@@ -905,7 +1410,14 @@ class ConfigSampleOutput(object):
 
             volume_shape = np.hstack((num_volumes,output_volume_shape3d)).astype('uint32')
 
-            empty_bin = np.zeros(volume_shape, dtype=dtype)
+            if self.file is None:
+                empty_bin = np.zeros(volume_shape, dtype=dtype)
+            else:
+                chunks = (1,) + tuple(int(c) for c in
+                                      np.minimum(shape[-3:], volume_shape[-3:]))
+                empty_bin = self.file.create_dataset(name,
+                                                     tuple(int(s) for s in volume_shape),
+                                                     dtype=dtype, chunks=chunks)
 
             self.output_volumes[name] = ZNN_Dataset(empty_bin, shape[-3:], shape[-3:])
 
@@ -923,6 +1435,12 @@ class ConfigSampleOutput(object):
 
         return patch_counts
 
+    def close(self):
+        '''Flushes and closes the hdf5 file of the output volumes'''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
 class CSamples(object):
 
     def __init__(self, config, pars, ids, net, outsz, log=None):
@@ -949,7 +1467,86 @@ class CSamples(object):
             sample = ConfigSample(config, pars, sid, net, outsz, log)
             self.samples.append( sample )
 
-    def get_random_sample(self):
+    def get_random_request(self, rng=np.random):
+        '''Draws a random CSample object index, deviation and transformation'''
+        i = rng.randint( len(self.samples) )
+        dev, rft = self.samples[i].get_random_request(rng)
+        return i, dev, rft
+
+    def get_sample(self, i, dev, rft, log=True):
+        '''Fetches the sample of a request drawn by get_random_request'''
+        return self.samples[i].get_sample(dev, rft, log)
+
+    def write_request_to_log(self, i, dev, rft):
+        '''Records a request drawn by get_random_request in the log'''
+        self.samples[i].write_request_to_log(dev, rft)
+
+    def get_random_sample(self, rng=np.random):
         '''Fetches a random sample from a random CSample object'''
-        i = np.random.randint( len(self.samples) )
-        return self.samples[i].get_random_sample()
+        return self.get_sample( *self.get_random_request(rng) )
+
+class CSamplesPrefetcher(object):
+
+    def __init__(self, samples, queue_size=4, num_threads=2, seed=None):
+        """
+        Prefetching Samples Class - extracts random samples of a CSamples
+        object in background threads, so that the subvolume extraction,
+        data augmentation and label transformation overlap with the
+        network computation.
+
+        The random requests are drawn sequentially by a single feeder thread
+        from its own random state, and the samples are returned in the order
+        of the requests. Hence, for a given seed, the sequence of samples is
+        the same with the one of samples.get_random_sample(RandomState(seed))
+
+        The feeder thread also writes the requests to the log when drawing
+        them, so the log is in the order of the requests.
+
+        close() should be called to stop the threads.
+
+        Parameters
+        ----------
+        samples : CSamples object
+        queue_size : maximum number of prefetched samples
+        num_threads : number of threads extracting the samples
+        seed : random seed, None for a random seed
+        """
+        assert(queue_size > 0 and num_threads > 0)
+
+        self.samples = samples
+        self.rng = np.random.RandomState(seed)
+
+        self._pool = ThreadPool(num_threads)
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _feed(self):
+        '''Keeps the queue filled with pending sample extractions'''
+        while not self._stop.is_set():
+            request = self.samples.get_random_request(self.rng)
+            self.samples.write_request_to_log(*request)
+            result = self._pool.apply_async(self.samples.get_sample, request,
+                                            {'log': False})
+
+            # block until there is a free slot, but stay responsive to close
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(result, timeout=0.1)
+                    break
+                except Queue.Full:
+                    continue
+
+    def get_random_sample(self):
+        '''Fetches the next prefetched sample'''
+        return self._queue.get().get()
+
+    def close(self):
+        '''Stops prefetching and joins the worker threads'''
+        self._stop.set()
+        self._feeder.join()
+        self._pool.close()
+        self._pool.join()
@@ -168,53 +168,128 @@ def softmax_loss2(props, lbls):
 # TO-DO
 
 
-def malis_find(sid, seg):
+def malis_find(parent, i):
     """
-    find the root/segment id
+    find the root/segment id, halving the path on the way
+
+    Parameters
+    ----------
+    parent : list of integers, the parent id of each voxel
+    i : voxel id
+
+    Returns
+    -------
+    r : root id of the segment containing voxel i
     """
-    return seg[sid-1]
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
 
-def malis_union(r1, r2, seg, id_sets):
+def malis_union(r1, r2, parent, rank, hists):
     """
-    union the two sets, keep the "tree" update.
+    union the two segments by rank, and merge their label histograms.
 
     parameters
     ----------
-    r1, r2 : segment id of two sets
-    seg : 1d array, record the segment id of all the segments
-    id_sets : dict, key is the root/segment id
-                    value is a set of voxel ids.
+    r1, r2 : root id of the two segments
+    parent : list of integers, the parent id of each voxel
+    rank : list of integers, the rank of each root
+    hists : list of dict, the label histogram of each root,
+            key is the label id, value is the number of voxels.
 
     returns
     -------
-    seg :
-    id_sets
+    r : root id of the merged segment
     """
-    # get set pair
-    set1 = id_sets[r1]
-    set2 = id_sets[r2]
-
-    if len(set1) < len(set2):
-        # exchange the two sets
+    if rank[r1] < rank[r2]:
         r1, r2 = r2, r1
-        set1, set2 = set2, set1
-    # merge the small set to big set
-    id_sets[r1]= set1.union( set2 )
-    # update the segmentation
-    for vid in set2:
-        seg[vid-1] = r1
-    # remove the small set in dict
-    del id_sets[r2]
-    return seg, id_sets
-
-# TO-DO, not fully implemented
+    parent[r2] = r1
+    if rank[r1] == rank[r2]:
+        rank[r1] += 1
+
+    # merge the small histogram to the big one
+    h1 = hists[r1]
+    h2 = hists[r2]
+    if len(h1) < len(h2):
+        h1, h2 = h2, h1
+    for l, n in h2.iteritems():
+        h1[l] = h1.get(l, 0) + n
+    hists[r1] = h1
+    hists[r2] = None
+    return r1
+
+def get_aff_edges(shape):
+    """
+    get the edges of the affinity graph of a volume.
+    the affinity affs[c,z,y,x] connects voxel (z,y,x) with the previous
+    voxel along the axis c (z,y,x), the first section of each axis has
+    no edge.
+
+    Parameters
+    ----------
+    shape : 3 integers, the volume shape Z,Y,X
+
+    Returns
+    -------
+    eids : 1D array, index of the edges in the flattened affinity graph
+    id1, id2 : 1D array, the voxel ids of the two ends of the edges
+    """
+    N = int(np.prod(shape))
+    ids = np.arange(N).reshape( shape )
+    eids, id1, id2 = list(), list(), list()
+    for c in xrange(3):
+        s1 = [slice(None)] * 3
+        s2 = [slice(None)] * 3
+        s1[c] = slice(1, None)
+        s2[c] = slice(None, -1)
+        v = ids[tuple(s1)].ravel()
+        eids.append( v + c*N )
+        id1.append( v )
+        id2.append( ids[tuple(s2)].ravel() )
+    eids = np.concatenate( eids )
+    id1 = np.concatenate( id1 )
+    id2 = np.concatenate( id2 )
+    return eids, id1, id2
+
+def aff2seg(affs, threshold=0.5):
+    """
+    segment an affinity graph by the connected components of the
+    edges with affinity larger than threshold (see get_aff_edges).
+
+    Parameters
+    ----------
+    affs : 4D array, affinity graph, size: 3*Z*Y*X
+    threshold : binarization threshold
+
+    Returns
+    -------
+    seg : 1D list of integers, the root voxel id of each voxel
+    """
+    eids, id1, id2 = get_aff_edges( affs.shape[1:] )
+    sel = affs.ravel()[eids] > threshold
+
+    N = affs[0].size
+    parent = range(N)
+    rank = [0] * N
+    for i1, i2 in zip(id1[sel].tolist(), id2[sel].tolist()):
+        r1 = malis_find(parent, i1)
+        r2 = malis_find(parent, i2)
+        if r1 != r2:
+            if rank[r1] < rank[r2]:
+                r1, r2 = r2, r1
+            parent[r2] = r1
+            if rank[r1] == rank[r2]:
+                rank[r1] += 1
+    return [malis_find(parent, i) for i in xrange(N)]
+
 def malis_weight_aff(affs, true_affs, threshold=0.5):
     """
-    compute malis tree_size
+    compute malis weight for affinity graph
 
     Parameters:
     -----------
-    affs:      4D array of forward pass output affinity graphs, size: C*Z*Y*X
+    affs:      4D array of forward pass output affinity graphs, size: 3*Z*Y*X
     true_affs : 4d array of ground truth affinity graph
     threshold: threshold for segmentation
 
@@ -222,82 +297,65 @@ def malis_weight_aff(affs, true_affs, threshold=0.5):
     ------
     weights : 4D array of weights
     """
+    assert(affs.ndim==4 and affs.shape[0]==3)
+    assert(affs.shape==true_affs.shape)
+
     # segment the true affinity graph
-    tseg = emirt.volume_util.aff2seg(true_affs)
-    tid_sets, tsegf = emirt.volume_util.map_set( seg )
-
-    if isinstance(affs, dict):
-        assert( len(affs.keys())==1 )
-        key = affs.keys()[0]
-        affs = affs.values()[0]
-    # get affinity graphs
-    xaff = affs[2]
-    yaff = affs[1]
-    zaff = affs[0]
-    shape = xaff.shape
-
-    # initialize segmentation with individual label of each voxel
-    seg_shp = np.asarray(xaff.shape)+1
-    N = np.prod( seg_shp )
-    ids = np.arange(1, N+1).reshape( seg_shp )
-    seg = np.copy( ids ).flatten()
-
-    # initialize edges: aff, id1, id2, z/y/x, true_aff
-    edges = list()
-    for z in xrange(shape[0]):
-        for y in xrange(shape[1]):
-            for x in xrange(1,shape[2]):
-                edges.append( (xaff[z,y,x], ids[z,y,x], ids[z,y,x-1], 2) )
-    for z in xrange(shape[0]):
-        for y in xrange(1,shape[1]):
-            for x in xrange(shape[2]):
-                edges.append( (yaff[z,y,x], ids[z,y,x], ids[z,y-1,x], 1) )
-    for z in xrange(1,shape[0]):
-        for y in xrange(shape[1]):
-            for x in xrange(shape[2]):
-                edges.append( (zaff[z,y,x], ids[z,y,x], ids[z-1,y,x], 0) )
-    # descending sort
-    edges.sort(reverse=True)
-
-    # find the maximum-spanning tree based on union-find algorithm
-    weights = np.zeros( affs.shape, dtype=affs.dtype )
-    # the dict set containing all the sets
-    id_sets = dict()
-    # initialize the id sets
-    for i in xrange(1,N+1):
-        id_sets[i] = i
-
-    # accumulate the merge and split errors
-    merr = serr = 0
-
-    # union find the sets
-    for e in edges:
-        # find the segment/root id
-        r1 = malis_find(e[1], seg)
-        r2 = malis_find(e[2], seg)
+    lbl = aff2seg(true_affs, threshold)
+
+    # descending sort of the edges
+    eids, id1, id2 = get_aff_edges( affs.shape[1:] )
+    aff = affs.ravel()[eids]
+    order = np.argsort(-aff, kind='mergesort')
+    eids = eids[order].tolist()
+    id1s = id1[order].tolist()
+    id2s = id2[order].tolist()
+    is_merge = (aff[order] > threshold).tolist()
+
+    # initalize the merge and split errors of each edge
+    merr = np.zeros(affs.size, dtype=affs.dtype)
+    serr = np.zeros(affs.size, dtype=affs.dtype)
+
+    # initialize segmentation with individual voxels
+    # and the label histogram of each segment
+    N = affs[0].size
+    parent = range(N)
+    rank = [0] * N
+    hists = [{l:1} for l in lbl]
+    sizes = [1] * N
 
+    # find the maximum spanning tree based on union-find algorithm
+    for e, i1, i2, m in zip(eids, id1s, id2s, is_merge):
+        r1 = malis_find(parent, i1)
+        r2 = malis_find(parent, i2)
         if r1==r2:
             # this is not a maximin edge
             continue
 
-        if e[0]>threshold:
-            # merge two sets, the voxel pairs not in a segments are errors
-            weights[e[3], r1-1] = weights[e[3],r1-1] + s1*s2
-            # merge the two sets/trees
-
+        me, se = get_merge_split_errors(hists[r1], hists[r2],
+                                        sizes[r1], sizes[r2])
+        if m:
+            # predicted merge, the voxel pairs of different labels are errors
+            merr[e] = me
         else:
-        # do not merge, the voxel pairs in a same segments are errors
-            print "dp "
-
-
-    # normalize the weights
-    #N = float(N)
-    #weights = weights * (3*N) / ( N*(N-1)/2 )
-    #weights = weights.reshape( affs.shape )
-    # transform to dictionary
-    ret = dict()
-    #ret[key] = weights
-    return ret
+            # predicted split, the voxel pairs of the same label are errors
+            serr[e] = se
+
+        # the edge is in the maximin spanning tree either way, the later
+        # (weaker) edges between the two sets are not maximin edges
+        r = malis_union(r1, r2, parent, rank, hists)
+        sizes[r] = sizes[r1] + sizes[r2]
+
+    # normalize the weights, an error type may not exist in a patch
+    smerr = np.sum(merr, dtype=affs.dtype)
+    sserr = np.sum(serr, dtype=affs.dtype)
+    if smerr > 0:
+        merr = merr * ( len(eids)*0.5 / smerr )
+    if sserr > 0:
+        serr = serr * ( len(eids)*0.5 / sserr )
+    # combine the two error weights
+    weights = (merr + serr).reshape(affs.shape)
+    return weights
 
 def malis_weight_bdm_2D(bdm, lbl, threshold=0.5):
     """
@@ -317,82 +375,62 @@ def malis_weight_bdm_2D(bdm, lbl, threshold=0.5):
     assert(bdm.ndim==2)
     assert(bdm.shape==lbl.shape)
 
-    # initialize segmentation with individual id of each voxel
-    ids = np.arange(1,bdm.size+1).reshape( bdm.shape )
-    seg = np.copy(ids).flatten()
+    # create edges of neighboring voxel pairs along x and y
+    ids = np.arange(bdm.size).reshape( bdm.shape )
+    a1 = np.concatenate(( ids[:,:-1].ravel(), ids[:-1,:].ravel() ))
+    a2 = np.concatenate(( ids[:,1:].ravel(),  ids[1:,:].ravel()  ))
 
-    # create edges: aff, id1, id2, true aff
     # the affinity was represented by the minimal boundary map value
     # the voxel with id1 has the minimal value
-    edges = list()
-    for y in xrange(bdm.shape[0]):
-        for x in xrange(bdm.shape[1]-1):
-            v1 = bdm[y,x]
-            i1 = ids[y,x]
-            v2 = bdm[y,x+1]
-            i2 = ids[y,x+1]
-            if v1 > v2:
-                v1, v2 = v2, v1
-                i1, i2 = i2, i1
-            if lbl[y,x] and lbl[y,x+1]:
-                t = True
-            else:
-                t = False
-            edges.append((v1, i1, i2, t))
-
-    for y in xrange(bdm.shape[1]-1):
-        for x in xrange(bdm.shape[0]):
-            v1 = bdm[y,x]
-            i1 = ids[y,x]
-            v2 = bdm[y+1,x]
-            i2 = ids[y+1,x]
-            if v1 > v2:
-                v1, v2 = v2, v1
-                i1, i2 = i2, i1
-            if lbl[y,x] and lbl[y+1,x]:
-                t = True
-            else:
-                t = False
-            edges.append((v1, i1, i2, t))
-    # descending sort
-    edges.sort(reverse=True)
+    flat = bdm.ravel()
+    swap = flat[a1] > flat[a2]
+    id1 = np.where(swap, a2, a1)
+    id2 = np.where(swap, a1, a2)
+    aff = flat[id1]
+
+    # descending sort, ties are ordered by the voxel ids
+    order = np.lexsort((id2, id1, aff))[::-1]
+    id1s = id1[order].tolist()
+    id2s = id2[order].tolist()
+    is_merge = (aff[order] > threshold).tolist()
 
     # initalize the merge and split errors
     merr = np.zeros(lbl.size, dtype=bdm.dtype)
     serr = np.zeros(lbl.size, dtype=bdm.dtype)
-    # set of ids
-    id_sets = dict()
-    # initalize the id sets
-    for i in xrange(1,lbl.size+1):
-        id_sets[i] = {i}
+
+    # initialize segmentation with individual voxels
+    # and the label histogram of each segment
+    parent = range(bdm.size)
+    rank = [0] * bdm.size
+    labels = np.unique(lbl, return_inverse=True)[1].tolist()
+    hists = [{l:1} for l in labels]
+    sizes = [1] * bdm.size
 
     # find the maximum spanning tree based on union-find algorithm
-    for e in edges:
+    for i1, i2, m in zip(id1s, id2s, is_merge):
         # find the segment/root id
-        r1 = malis_find(e[1], seg)
-        r2 = malis_find(e[2], seg)
+        r1 = malis_find(parent, i1)
+        r2 = malis_find(parent, i2)
         if r1==r2:
             # this is not a maximin edge
             # these pixel pair is already in one segment
             continue
 
-        # find the id set pair of this edge
-        set1 = id_sets[r1]
-        set2 = id_sets[r2]
-
         # current segmentation will merge two sets
-        me, se = get_merge_split_errors(set1, set2, lbl)
+        me, se = get_merge_split_errors(hists[r1], hists[r2],
+                                        sizes[r1], sizes[r2])
 
         # deal with the maximin edge
-        if e[0]>threshold:
+        if m:
             # accumulate the merging error
-            merr[e[1]-1] = me
+            merr[i1] = me
             # merge the two sets
-            seg, id_sets = malis_union(r1,r2, seg, id_sets)
+            r = malis_union(r1, r2, parent, rank, hists)
+            sizes[r] = sizes[r1] + sizes[r2]
         else:
             # current segmentation will split the two sets
             # accumulate the spliting error
-            serr[e[1]-1] = se
+            serr[i1] = se
     # normalize the weight
     merr = merr * ( merr.size*0.5 / np.sum(merr, dtype=bdm.dtype) )
     serr = serr * ( serr.size*0.5 / np.sum(serr, dtype=bdm.dtype) )
@@ -400,52 +438,30 @@ def malis_weight_bdm_2D(bdm, lbl, threshold=0.5):
     w = (merr + serr).reshape(bdm.shape)
     return w
 
-def get_merge_split_errors(set1, set2, lbl):
+def get_merge_split_errors(h1, h2, n1, n2):
     """
     count the merging and spliting errors
 
     Parameters
     ----------
-    set1: set of integers, cluster of ids
-    set2: the other set
-    seg: array of integers, current segmentation
-    lbl: array of integers, ground truth segmentation
+    h1: dict, label histogram of a segment
+    h2: dict, label histogram of the other segment
+    n1, n2: integer, number of voxels of the two segments
 
     Returns
     -------
     me: integer, mergers
     se: integer, splits
     """
-    # transform to a dictionary of pixel ids
-    # key: label id
-    # value: set of pixel ids
-    d1 = dict()
-    d2 = dict()
-    for i in set1:
-        l1 = lbl.flat[i-1]
-        if d1.has_key(l1):
-            d1[l1].add(i)
-        else:
-            d1[l1] = {i}
-    for i in set2:
-        l2 = lbl.flat[i-1]
-        if d2.has_key(l2):
-            d2[l2].add(i)
-        else:
-            d2[l2] = {i}
-    # mergers and spliters
-    me = se = 0
-    for l1, s1 in d1.iteritems():
-        for l2, s2 in d2.iteritems():
-            if l1==l2:
-                # they should merge together
-                # this is split error
-                se += len(s1) * len(s2)
-            else:
-                # they should be split
-                # this is merge error
-                me += len(s1) * len(s2)
-    #print "merging and spliting error: ", me, ", ", se
+    if len(h1) > len(h2):
+        h1, h2 = h2, h1
+    # the voxel pairs with the same label should merge together,
+    # they are split errors
+    se = 0
+    for l, n in h1.iteritems():
+        se += n * h2.get(l, 0)
+    # the other pairs should be split, they are merge errors
+    me = n1 * n2 - se
     return me, se
 
 def malis_weight_bdm(bdm, lbl, threshold=0.5):
@@ -18,6 +18,11 @@ ZNN Full Forward-Pass Computation
  The module also features functions for generating the full output volume
  for a given input np array.
 
+ With the option is_forward_stream, the input images are read patch by
+ patch from memory-mapped tif/hdf5 files, and the output volumes are
+ written to chunked hdf5 files (e.g. out_sample1.h5) instead of being
+ kept in memory, so that volumes larger than the memory can be processed.
+
 Inputs:
 
 	-Configuration File Name
@@ -31,6 +36,9 @@ Jingpeng Wu <jingpeng.wu@gmail.com>, 2015
 """
 #TODO- Better argument handling
 
+import Queue
+import threading
+
 import numpy as np
 
 import front_end, netio, utils
@@ -68,16 +76,23 @@ def config_forward_pass( config_filename, verbose=True, sample_ids=None ):
         # read image stacks
         # Note: preprocessing included within CSamples
         # See CONSTANTS section above for optionname values
+        is_stream = params['is_forward_stream']
         Dataset = front_end.ConfigSample(config, params,
-                                         sample, net, output_patch_shape )
+                                         sample, net, output_patch_shape,
+                                         stream=is_stream )
 
-        sample_outputs[sample] = generate_full_output(Dataset, net,
-						params['dtype'], verbose=True)
+        fname = None
+        if is_stream:
+            fname = "{}_sample{}.h5".format(params[output_prefix_optionname], sample)
 
         # softmax if using softmax_loss
-        if 'softmax' in params['cost_fn_str']:
-            sample_outputs[sample] = run_softmax(sample_outputs[sample])
+        sample_outputs[sample] = generate_full_output(Dataset, net,
+						params['dtype'], verbose=True,
+						batch_size=params['forward_batch_size'],
+						is_softmax='softmax' in params['cost_fn_str'],
+						fname=fname)
 
+    netio.print_fft_planning()
     return sample_outputs
 
 def run_softmax( sample_output ):
@@ -96,18 +111,27 @@ def run_softmax( sample_output ):
 
     return sample_output
 
-def generate_full_output( Dataset, network, dtype='float32', verbose=True ):
+def generate_full_output( Dataset, network, dtype='float32', verbose=True, batch_size=1,
+						  is_softmax=False, fname=None ):
 	'''
 	Performs a full forward pass for a given ConfigSample object (Dataset) and
 	a given network object.
+
+	The network computes batches of batch_size patches in a background
+	thread (see CNet.forward_many), while this thread extracts the next
+	batch and stores the outputs of the previous one
+
+	If is_softmax, the softmax is applied to each output patch. If fname
+	is given, the output volumes are written to that hdf5 file.
 	'''
+	from cost_fn import softmax
 
 	# Making sure loaded images expect same size output volume
 	output_vol_shapes = Dataset.output_volume_shape()
 	assert output_volume_shape_consistent(output_vol_shapes)
 	output_vol_shape = output_vol_shapes.values()[0]
 
-	Output = front_end.ConfigSampleOutput( network, output_vol_shape, dtype )
+	Output = front_end.ConfigSampleOutput( network, output_vol_shape, dtype, fname )
 
 	input_num_patches = Dataset.num_patches()
 	output_num_patches = Output.num_patches()
@@ -115,22 +139,74 @@ def generate_full_output( Dataset, network, dtype='float32', verbose=True ):
 	assert num_patches_consistent(input_num_patches, output_num_patches)
 
 	num_patches = output_num_patches.values()[0]
+	batch_sizes = [min(batch_size, num_patches - i)
+				   for i in xrange(0, num_patches, batch_size)]
 
-	for i in xrange( num_patches ):
+	in_queue = Queue.Queue()
+	out_queue = Queue.Queue()
+	worker = threading.Thread( target=_forward_worker,
+							   args=(network, in_queue, out_queue) )
+	worker.daemon = True
+	worker.start()
 
-		if verbose:
-			print "Output patch #{} of {}".format(i+1, num_patches) # i is just an index
+	in_queue.put( _get_input_batch(Dataset, batch_sizes[0], dtype) )
 
-		input_patches, junk = Dataset.get_next_patch()
+	i = 0
+	for b in xrange( len(batch_sizes) ):
+
+		# queue the next batch before waiting for the current one
+		if b+1 < len(batch_sizes):
+			in_queue.put( _get_input_batch(Dataset, batch_sizes[b+1], dtype) )
+
+		outputs = out_queue.get()
+		if isinstance(outputs, Exception):
+			raise outputs
 
-		vol_ins = utils.make_continuous(input_patches, dtype=dtype)
+		for output in outputs:
+			if is_softmax:
+				output = softmax(output)
+			i += 1
+			if verbose:
+				print "Output patch #{} of {}".format(i, num_patches) # i is just an index
 
-		output = network.forward( vol_ins )
+			Output.set_next_patch( output )
 
-		Output.set_next_patch( output )
+	in_queue.put( None )
+	worker.join()
 
 	return Output
 
+def _get_input_batch( Dataset, size, dtype ):
+	'''
+	Extracts the next size input patches of a ConfigSample object
+	'''
+
+	batch = []
+	for i in xrange( size ):
+
+		input_patches, junk = Dataset.get_next_patch()
+
+		batch.append( utils.make_continuous(input_patches, dtype=dtype) )
+
+	return batch
+
+def _forward_worker( network, in_queue, out_queue ):
+	'''
+	Computes the forward passes of the input batches of in_queue until
+	getting None, and puts the output batches (or an exception) to out_queue
+	'''
+
+	while True:
+		batch = in_queue.get()
+		if batch is None:
+			return
+
+		try:
+			out_queue.put( network.forward_many( batch ) )
+		except Exception as e:
+			out_queue.put( e )
+			return
+
 def output_volume_shape_consistent( output_vol_shapes ):
 	'''
 	Returns whether the dictionary of output shapes passed to the function
@@ -167,6 +243,12 @@ def save_sample_outputs(sample_outputs, prefix):
 
 	for sample_num, output in sample_outputs.iteritems():
 
+		if output.file is not None:
+			# streamed output, already written to the hdf5 file
+			print "Output volumes saved in {}".format(output.file.filename)
+			output.close()
+			continue
+
 		for dataset_name, dataset in output.output_volumes.iteritems():
 
 			num_volumes = dataset.data.shape[0]
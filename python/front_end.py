@@ -11,7 +11,7 @@ import ConfigParser
 import numpy as np
 import os
 import cost_fn
-from ZNN_Dataset import CSamples, ConfigSample, ZNN_Dataset, ConfigSampleOutput
+from ZNN_Dataset import CSamples, CSamplesPrefetcher, ConfigSample, ZNN_Dataset, ConfigSampleOutput
 import utils
 
 def parseIntSet(nputstr=""):
@@ -115,6 +115,25 @@ def parser( conf_fname ):
     pars['is_train_optimize'] = config.getboolean('parameters', 'is_train_optimize')
     pars['is_forward_optimize'] = config.getboolean('parameters', 'is_forward_optimize')
     pars['force_fft'] = config.getboolean('parameters', 'force_fft')
+    #File of the fftw wisdom, empty for no wisdom
+    pars['fftw_wisdom'] = ''
+    if config.has_option('parameters', 'fftw_wisdom'):
+        pars['fftw_wisdom'] = os.path.expanduser(
+                                config.get('parameters', 'fftw_wisdom') )
+    #File caching the optimized choices, empty for no caching
+    pars['tuning_cache'] = ''
+    if config.has_option('parameters', 'tuning_cache'):
+        pars['tuning_cache'] = os.path.expanduser(
+                                config.get('parameters', 'tuning_cache') )
+    #Directory caching the preprocessed sample volumes, empty for no caching
+    pars['preprocess_cache'] = ''
+    if config.has_option('parameters', 'preprocess_cache'):
+        pars['preprocess_cache'] = os.path.expanduser(
+                                config.get('parameters', 'preprocess_cache') )
+    #Maximal memory cached by the cube pools (MB), 0 for no limit
+    pars['cube_pool_limit'] = 0
+    if config.has_option('parameters', 'cube_pool_limit'):
+        pars['cube_pool_limit'] = config.getint('parameters', 'cube_pool_limit')
     #Whether to use data augmentation
     pars['is_data_aug'] = config.getboolean('parameters', 'is_data_aug')
     #Whether to use boundary mirroring
@@ -127,6 +146,19 @@ def parser( conf_fname ):
     pars['is_malis']    = config.getboolean('parameters', 'is_malis')
     #Whether to display progress plots
     pars['is_visual']   = config.getboolean('parameters', 'is_visual')
+    #Number of training samples prefetched in background (0: no prefetching)
+    pars['prefetch_size'] = 0
+    if config.has_option('parameters', 'prefetch_size'):
+        pars['prefetch_size'] = config.getint('parameters', 'prefetch_size')
+    #Number of threads extracting the prefetched samples
+    pars['prefetch_threads'] = 1
+    if config.has_option('parameters', 'prefetch_threads'):
+        pars['prefetch_threads'] = config.getint('parameters', 'prefetch_threads')
+    #Random seed of the training sample selection (None: random seed)
+    pars['sample_seed'] = None
+    if config.has_option('parameters', 'sample_seed') and \
+            config.get('parameters', 'sample_seed'):
+        pars['sample_seed'] = config.getint('parameters', 'sample_seed')
 
     #Which Cost Function to Use (as a string)
     pars['cost_fn_str'] = config.get('parameters', 'cost_fn')
@@ -153,6 +185,14 @@ def parser( conf_fname ):
                                         .split(',') ], dtype=np.int64 )
     #Prefix of the output files
     pars['output_prefix'] = config.get('parameters', 'output_prefix')
+    #Number of patches per forward_many call
+    pars['forward_batch_size'] = 1
+    if config.has_option('parameters', 'forward_batch_size'):
+        pars['forward_batch_size'] = config.getint('parameters', 'forward_batch_size')
+    #Stream the input and output volumes patch by patch
+    pars['is_forward_stream'] = False
+    if config.has_option('parameters', 'is_forward_stream'):
+        pars['is_forward_stream'] = config.getboolean('parameters', 'is_forward_stream')
 
 
     if 'fdata_spec' in pars.keys():
@@ -209,6 +249,9 @@ def check_config(config, pars):
     assert(pars['Num_iter_per_save']>0)
     assert(pars['Max_iter']>0)
     assert(pars['Max_iter']>pars['Num_iter_per_save'])
+    assert(pars['prefetch_size']>=0)
+    assert(pars['prefetch_threads']>0)
+    assert(pars['forward_batch_size']>0)
 
     # check and correct the image and labels
     for sec in config.sections():
@@ -209,9 +209,37 @@ def consolidate_opts(source_opts, dest_opts, params=None, layers=None, is_seed=F
     return dest_opts
 
 
+def set_fft_wisdom( params ):
+    '''
+    Sets the fftw wisdom file of the parameter object (if any), the fft
+    plans are then imported from this file (and exported to it by
+    pyznn.save_fft_wisdom once a network is built)
+    '''
+    if params is not None and params.get('fftw_wisdom', ''):
+        pyznn.set_fft_wisdom_file( params['fftw_wisdom'] )
+
+def set_cube_pool_limit( params ):
+    '''
+    Sets the maximal memory kept cached by the cube pools to the
+    cube_pool_limit (MB) of the parameter object (if any)
+    '''
+    if params is not None and params.get('cube_pool_limit', 0) > 0:
+        pyznn.set_cube_pool_limit( params['cube_pool_limit'] * 1024 * 1024 )
+
+def print_fft_planning():
+    '''
+    Prints the number of fft plans, the time spent creating them and
+    how often the threads waited for the planning lock
+    '''
+    print "fft plans: {}, planning time: {:.2f} secs".format(
+        pyznn.get_fft_plan_count(), pyznn.get_fft_planning_time() )
+    st = pyznn.get_fft_plan_lock_stats()
+    print "fft plan lookups: {}, locked: {}, contended: {}, lock wait: {:.3f} secs".format(
+        st['lookups'], st['locks'], st['contended'], st['wait_time'] )
+
 def load_network( params=None, is_seed=False, train=True, hdf5_filename=None,
     network_specfile=None, output_patch_shape=None, num_threads=None,
-    optimize=None, force_fft=None ):
+    optimize=None, force_fft=None, tuning_cache=None ):
     '''
     Loads a network from an hdf5 file.
 
@@ -221,6 +249,9 @@ def load_network( params=None, is_seed=False, train=True, hdf5_filename=None,
     If both a parameter object and any optional arguments are specified,
     the parameter object will form the default options, and those will be
     overwritten by the other optional arguments
+
+    The optimization is skipped if its choices are found in the
+    tuning_cache file
     '''
     #Need to specify either a params object, or all of the other optional args
     params_defined = params is not None
@@ -248,6 +279,9 @@ def load_network( params=None, is_seed=False, train=True, hdf5_filename=None,
         _force_fft = params['force_fft']
         _network_specfile = params['fnet_spec']
         _num_threads = params['num_threads']
+        _tuning_cache = params.get('tuning_cache', '')
+    else:
+        _tuning_cache = ''
 
     #Overwriting defaults with any other optional args
     if hdf5_filename is not None:
@@ -258,6 +292,11 @@ def load_network( params=None, is_seed=False, train=True, hdf5_filename=None,
         _output_patch_shape = output_patch_shape
     if num_threads is not None:
         _num_threads = num_threads
+    if tuning_cache is not None:
+        _tuning_cache = tuning_cache
+
+    set_fft_wisdom( params )
+    set_cube_pool_limit( params )
 
     #ACTUAL LOADING FUNCTIONALITY
     #This is a little strange to allow for "seeding" larger
@@ -286,12 +325,20 @@ def load_network( params=None, is_seed=False, train=True, hdf5_filename=None,
         final_options = template.get_opts()
         del template
 
-    return pyznn.CNet(final_options, _network_specfile, _output_patch_shape,
-                _num_threads, _optimize, phase, _force_fft)
+    net = pyznn.CNet(final_options, _network_specfile, _output_patch_shape,
+                _num_threads, _optimize, phase, _force_fft, _tuning_cache)
+
+    #the plans of the network are created by now
+    pyznn.save_fft_wisdom()
+
+    #the memory of the networks built by the optimization is not reused
+    if _optimize:
+        pyznn.trim_cube_pool()
+    return net
 
 def init_network( params=None, train=True, network_specfile=None,
             output_patch_shape=None, num_threads=None, optimize=None,
-            force_fft=None ):
+            force_fft=None, tuning_cache=None ):
     '''
     Initializes a random network using the Boost Python interface and configuration
     file options.
@@ -302,6 +349,9 @@ def init_network( params=None, train=True, network_specfile=None,
     If both a parameter object and any optional arguments are specified,
     the parameter object will form the default options, and those will be
     overwritten by the other optional arguments
+
+    The optimization is skipped if its choices are found in the
+    tuning_cache file
     '''
     #Need to specify either a params object, or all of the other optional args
     #"ALL" optional args excludes train
@@ -326,6 +376,9 @@ def init_network( params=None, train=True, network_specfile=None,
         _force_fft = params['force_fft']
         _network_specfile = params['fnet_spec']
         _num_threads = params['num_threads']
+        _tuning_cache = params.get('tuning_cache', '')
+    else:
+        _tuning_cache = ''
 
     #Overwriting defaults with any other optional args
     if network_specfile is not None:
@@ -338,6 +391,19 @@ def init_network( params=None, train=True, network_specfile=None,
         _optimize = optimize
     if force_fft is not None:
         _force_fft = force_fft
+    if tuning_cache is not None:
+        _tuning_cache = tuning_cache
+
+    set_fft_wisdom( params )
+    set_cube_pool_limit( params )
+
+    net = pyznn.CNet(_network_specfile, _output_patch_shape,
+                    _num_threads, _optimize, phase, _force_fft, _tuning_cache)
+
+    #the plans of the network are created by now
+    pyznn.save_fft_wisdom()
 
-    return pyznn.CNet(_network_specfile, _output_patch_shape,
-                    _num_threads, _optimize, phase, _force_fft)
+    #the memory of the networks built by the optimization is not reused
+    if _optimize:
+        pyznn.trim_cube_pool()
+    return net
@@ -32,12 +32,22 @@ Boost Python Interface for ZNNv4
 
 Functions:
 
+ CNet(...) - constructs a network from a network file or from options
+ 	(see CNet_getopts). The optional last argument is the file caching
+ 	the FFT/direct convolution choices of the optimization
+
  CNet.forward() - computes the forward pass given a numpy array,
- 	and returns a numpy array of the output
+ 	and returns a numpy array of the output. C-contiguous arrays of the
+ 	network's float type are used without copying (the network may
+ 	overwrite them), a single output volume is returned as a read-only
+ 	view of the network memory
+
+ CNet.forward_many() - computes the forward passes of a list of input
+ 	samples back to back, and returns the list of outputs
 
  CNet.backward() - computes the backward pass given a numpy array
  	of gradient values, implicitly updates the parameters of the
- 	network
+ 	network. The gradient arrays are used without copying as well
 
  CNet.get_fov() - returns a tuple which describes the field-of-view
  	of the network
@@ -46,6 +56,12 @@ Functions:
 
  CNet.set_phase() - currently have no clue what this does
 
+ CNet.start_trace() - starts recording the tasks run by the worker threads
+
+ CNet.stop_trace() - stops recording and writes the tasks to the given
+ 	Chrome trace (JSON) file, for chrome://tracing or Perfetto. Each task
+ 	has its worker, duration, priority and owning edge group(s)
+
  CNet.momentum() - sets the momentum constant - what proportion of the
  	past update defines the next
 
@@ -55,6 +71,37 @@ Functions:
 
  CNet.get_output_num() - returns the number of 3d output volumes to the network
 
+ pyznn.set_fft_wisdom_file() - sets the file to import the fftw wisdom
+ 	from, and export it to (also set by the ZNN_FFTW_WISDOM environment
+ 	variable)
+
+ pyznn.save_fft_wisdom() - exports the wisdom of the new fft plans to the
+ 	wisdom file (also done at exit)
+
+ pyznn.get_fft_planning_time(), pyznn.get_fft_plan_count() - return the
+ 	total time spent creating fft plans and the number of plans
+
+ pyznn.get_cube_pool_stats() - returns a list of dictionaries with the
+ 	statistics of the size classes of the cube memory pools: kind, block
+ 	(bytes of a memory block), live and cached blocks, bytes, hits,
+ 	misses and hit_rate
+
+ pyznn.set_cube_pool_limit() - sets the maximal number of bytes kept
+ 	cached by the cube pools (0 for no limit, also set by the
+ 	ZNN_CUBE_POOL_LIMIT environment variable), the memory of the least
+ 	recently used size classes is freed first
+
+ pyznn.get_cube_pool_limit(), pyznn.get_cube_pool_cached_bytes() - return
+ 	the limit and the number of bytes currently cached by the cube pools
+
+ pyznn.trim_cube_pool() - frees the cached memory of the cube pools down to
+ 	the given number of bytes (default 0), returns the number of bytes freed
+
+ pyznn.get_fft_plan_lock_stats() - returns a dictionary with the number of
+ 	fft plan lookups, the number of times the planning lock was taken,
+ 	how many of those had to wait for another thread, and the total
+ 	waiting time (seconds)
+
  CNet.get_opts() - serializes all fields of the network data structure, and returns
  	them as a tuple of lists of dictionaries. Each dictionary represents the fields
  	of a given layer of the network, the list consolidates all of the layers, and the
@@ -84,6 +131,7 @@ Nicholas Turner <nturner@cs.princeton.edu>, 2015
 
 // znn
 #include "network/parallel/network.hpp"
+#include "network/tuning_cache.hpp"
 #include "cube/cube.hpp"
 #include <zi/zargs/zargs.hpp>
 
@@ -97,6 +145,54 @@ using namespace znn::v4::parallel_network;
 
 //===========================================================================
 //IO FUNCTIONS
+//Chooses FFT or direct convolution for the conv edges
+// the choices of the optimization are cached in tuning_cache_file
+// (if not empty), see network/tuning_cache.hpp
+void tune_edges( std::vector<options> & nodes,
+		std::vector<options> & edges,
+		vec3i const & out_sz,
+		std::size_t const tc,
+		bool const is_optimize,
+		std::uint8_t const phs,
+		bool const force_fft,
+		std::string const & tuning_cache_file )
+{
+    if ( force_fft )
+    {
+        network::force_fft(edges);
+        return;
+    }
+    if ( !is_optimize )
+        return;
+
+    phase _phs = static_cast<phase>(phs);
+    if ( _phs != phase::TRAIN && _phs != phase::TEST )
+    {
+        std::string str = boost::lexical_cast<std::string>(phs);
+        throw std::logic_error(HERE() + "unknown phase: " + str);
+    }
+
+    tuning_cache cache(tuning_cache_file);
+    std::string key = tuning_cache::key(nodes, edges, out_sz, tc,
+                        _phs == phase::TRAIN ? "train" : "forward");
+    if ( cache.load(key, edges) )
+    {
+        std::cout << "loaded the convolution choices from the tuning cache "
+                  << tuning_cache_file << std::endl;
+        return;
+    }
+
+    if ( _phs == phase::TRAIN )
+    {
+        network::optimize(nodes, edges, out_sz, tc, 10);
+    }
+    else
+    {
+        network::optimize_forward(nodes, edges, out_sz, tc, 2);
+    }
+    cache.store(key, edges);
+}
+
 //First constructor - generates a random network
 std::shared_ptr< network > CNet_Init(
 		std::string  const net_config_file,
@@ -104,7 +200,8 @@ std::shared_ptr< network > CNet_Init(
 		std::size_t  tc  = 0,	// thread number
 		bool const is_optimize = true,
         std::uint8_t const phs = 0, // 0:TRAIN, 1:TEST
-        bool const force_fft = false)
+        bool const force_fft = false,
+        std::string const tuning_cache_file = "")
 {
     std::vector<options> nodes;
     std::vector<options> edges;
@@ -118,30 +215,8 @@ std::shared_ptr< network > CNet_Init(
     	tc = std::thread::hardware_concurrency();
 
     // force fft or optimize
-    if ( force_fft )
-    {
-        network::force_fft(edges);
-    }
-    else
-    {
-        if ( is_optimize )
-        {
-            phase _phs = static_cast<phase>(phs);
-            if ( _phs == phase::TRAIN )
-            {
-                network::optimize(nodes, edges, out_sz, tc, 10);
-            }
-            else if ( _phs == phase::TEST )
-            {
-                network::optimize_forward(nodes, edges, out_sz, tc, 2);
-            }
-            else
-            {
-                std::string str = boost::lexical_cast<std::string>(phs);
-                throw std::logic_error(HERE() + "unknown phase: " + str);
-            }
-        }
-    }
+    tune_edges(nodes, edges, out_sz, tc, is_optimize, phs, force_fft,
+               tuning_cache_file);
 
     std::cout<< "construct the network class using the edges and nodes..." <<std::endl;
     std::cout<<"if unseccessful, please check the network config file (networks/XXX.znn)."<<std::endl;
@@ -163,7 +238,8 @@ std::shared_ptr<network> CNet_loadopts( bp::tuple const & opts,
 	std::size_t const tc,
 	bool const is_optimize = true,
 	std::uint8_t const phs = 0,
-    bool const force_fft = false )
+    bool const force_fft = false,
+    std::string const tuning_cache_file = "" )
 {
 
 	bp::list node_opts_list = bp::extract<bp::list>( opts[0] );
@@ -178,31 +254,9 @@ std::shared_ptr<network> CNet_loadopts( bp::tuple const & opts,
 					reinterpret_cast<std::int64_t*>(outsz_a.get_data())[2]
 					);
 
-     // force fft or optimize
-    if ( force_fft )
-    {
-        network::force_fft(edge_opts);
-    }
-    else
-    {
-        if ( is_optimize )
-        {
-            phase _phs = static_cast<phase>(phs);
-            if ( _phs == phase::TRAIN )
-            {
-                network::optimize(node_opts, edge_opts, out_sz, tc, 10);
-            }
-            else if ( _phs == phase::TEST )
-            {
-                network::optimize_forward(node_opts, edge_opts, out_sz, tc, 2);
-            }
-            else
-            {
-                std::string str = boost::lexical_cast<std::string>(phs);
-                throw std::logic_error(HERE() + "unknown phase: " + str);
-            }
-        }
-    }
+    // force fft or optimize
+    tune_edges(node_opts, edge_opts, out_sz, tc, is_optimize, phs, force_fft,
+               tuning_cache_file);
 
 	std::shared_ptr<network> net(
 		new network( node_opts,edge_opts,out_sz,tc,static_cast<phase>(phs) ));
@@ -210,6 +264,30 @@ std::shared_ptr<network> CNet_loadopts( bp::tuple const & opts,
 	return net;
 }
 
+//The constructors without the tuning cache
+std::shared_ptr< network > CNet_Init_nocache(
+		std::string  const net_config_file,
+		np::ndarray  const & outsz_a,
+		std::size_t  tc,
+		bool const is_optimize,
+		std::uint8_t const phs,
+		bool const force_fft )
+{
+	return CNet_Init( net_config_file, outsz_a, tc, is_optimize, phs, force_fft );
+}
+
+std::shared_ptr<network> CNet_loadopts_nocache( bp::tuple const & opts,
+	std::string const net_config_file,
+	np::ndarray const & outsz_a,
+	std::size_t const tc,
+	bool const is_optimize,
+	std::uint8_t const phs,
+	bool const force_fft )
+{
+	return CNet_loadopts( opts, net_config_file, outsz_a, tc, is_optimize,
+						  phs, force_fft );
+}
+
 //Returns a tuple of list of dictionaries of the following form
 // (node_opts, edge_opts)
 // node_opts = [node_group_option_dict, ...]
@@ -256,22 +334,72 @@ bp::dict CNet_forward( bp::object const & self, bp::dict& ins )
 	// extract the class from self
 	network& net = bp::extract<network&>(self)();
 
+	// drop the arrays borrowed by the cubes of previous passes
+	get_borrowed_arrays().release();
+
+	auto sample = pydict2sample<real>( ins );
+	std::map<std::string, std::vector<cube_p<real>>> prop;
+
     // run forward and get output
-    auto prop = net.forward( std::move( pydict2sample<real>( ins ) ) );
+	{
+		gil_release nogil;
+		prop = net.forward( std::move( sample ) );
+	}
     return sample2pydict<real>(self, prop);
 }
 
+//Computes the forward-pass of a list of input samples, and returns
+// the list of the output samples
+//The passes run back to back without returning to python in between,
+// and without holding the GIL, so the caller can prepare the next inputs
+// in another thread meanwhile
+bp::list CNet_forward_many( bp::object const & self, bp::list& ins_list )
+{
+	network& net = bp::extract<network&>(self)();
+
+	get_borrowed_arrays().release();
+
+	std::size_t n = bp::len( ins_list );
+
+	std::vector<std::map<std::string, std::vector<cube_p<real>>>> samples(n);
+	for ( std::size_t i = 0; i < n; i++ )
+	{
+		bp::dict ins = bp::extract<bp::dict>( ins_list[i] );
+		samples[i] = pydict2sample<real>( ins );
+	}
+
+	std::vector<std::map<std::string, std::vector<cube_p<real>>>> props(n);
+	{
+		gil_release nogil;
+		for ( std::size_t i = 0; i < n; i++ )
+		{
+			props[i] = net.forward( std::move( samples[i] ) );
+		}
+	}
+
+	bp::list ret;
+	for ( std::size_t i = 0; i < n; i++ )
+	{
+		ret.append( sample2pydict<real>(self, props[i]) );
+	}
+	return ret;
+}
+
 //Computes the backward-pass and updates network parameters
 void CNet_backward( bp::object & self, bp::dict& grdts )
 {
 	// extract the class from self
 	network& net = bp::extract<network&>(self)();
 
+	// drop the arrays borrowed by the cubes of previous passes
+	get_borrowed_arrays().release();
+
 	// setting up output sample
 	std::map<std::string, std::vector<cube_p<real>>> gsample;
 	gsample = pydict2sample<real>( grdts );
 
 	// backward
+	gil_release nogil;
     net.backward( std::move(gsample) );
 }
 
@@ -345,21 +473,136 @@ void CNet_set_phase(bp::object const & self, std::uint8_t const phs = 0)
 	return;
 }
 
+//===========================================================================
+//FFT PLANNING FUNCTIONS
+
+//Sets the file of the fftw wisdom, and imports the wisdom of the file
+void set_fft_wisdom_file( std::string const & fname )
+{
+	fft_plans.set_wisdom_file( fname );
+}
+
+//Exports the wisdom of the plans created since the last export
+// to the wisdom file
+void save_fft_wisdom()
+{
+	fft_plans.save_wisdom();
+}
+
+//Returns the total time spent creating the fft plans (seconds)
+real get_fft_planning_time()
+{
+	return fft_plans.planning_time();
+}
+
+//Returns the number of fft plans created
+std::size_t get_fft_plan_count()
+{
+	return fft_plans.plan_count();
+}
+
+//Returns the counters of the fft plan lookups and the planning lock
+bp::dict get_fft_plan_lock_stats()
+{
+	plan_lock_stats const & st = fft_plans.lock_stats();
+
+	bp::dict ret;
+	ret["lookups"]   = st.lookups();
+	ret["locks"]     = st.locks();
+	ret["contended"] = st.contended();
+	ret["wait_time"] = st.wait_time();
+	return ret;
+}
+
+//===========================================================================
+//CUBE POOL FUNCTIONS
+
+//Returns the statistics of the size classes of the cube pools
+bp::list get_cube_pool_stats()
+{
+	bp::list ret;
+	for ( auto const & s: cube_pools.stats() )
+	{
+		bp::dict d;
+		d["kind"]     = s.kind;
+		d["block"]    = s.block;
+		d["live"]     = s.live;
+		d["cached"]   = s.cached;
+		d["bytes"]    = s.bytes();
+		d["hits"]     = s.hits;
+		d["misses"]   = s.misses;
+		d["hit_rate"] = s.hit_rate();
+		ret.append(d);
+	}
+	return ret;
+}
+
+//Sets the maximal number of bytes cached by the cube pools (0 for no limit)
+void set_cube_pool_limit( std::size_t bytes )
+{
+	cube_pools.set_limit( bytes );
+}
+
+std::size_t get_cube_pool_limit()
+{
+	return cube_pools.limit();
+}
+
+std::size_t get_cube_pool_cached_bytes()
+{
+	return cube_pools.cached_bytes();
+}
+
+//Frees the cached memory of the cube pools down to keep bytes,
+// returns the number of bytes freed
+std::size_t trim_cube_pool( std::size_t keep )
+{
+	return cube_pools.trim( keep );
+}
+
+std::size_t trim_cube_pool_all()
+{
+	return cube_pools.trim();
+}
+
 //===========================================================================
 //BOOST PYTHON INTERFACE DEFINITION
 BOOST_PYTHON_MODULE(pyznn)
 {
     Py_Initialize();
+    // the GIL is released during the forward and backward passes
+    PyEval_InitThreads();
     np::initialize();
 
+    bp::def("set_fft_wisdom_file",		&set_fft_wisdom_file);
+    bp::def("save_fft_wisdom",			&save_fft_wisdom);
+    bp::def("get_fft_planning_time",	&get_fft_planning_time);
+    bp::def("get_fft_plan_count",		&get_fft_plan_count);
+    bp::def("get_fft_plan_lock_stats",	&get_fft_plan_lock_stats);
+
+    bp::def("get_cube_pool_stats",		&get_cube_pool_stats);
+    bp::def("set_cube_pool_limit",		&set_cube_pool_limit);
+    bp::def("get_cube_pool_limit",		&get_cube_pool_limit);
+    bp::def("get_cube_pool_cached_bytes",	&get_cube_pool_cached_bytes);
+    bp::def("trim_cube_pool",			&trim_cube_pool);
+    bp::def("trim_cube_pool",			&trim_cube_pool_all);
+
+    // owner of the output arrays viewing network cubes
+    bp::class_<cube_holder<real>>("CubeHolder", bp::no_init);
+
     bp::class_<network, std::shared_ptr<network>, boost::noncopyable>("CNet",bp::no_init)
+        .def("__init__", bp::make_constructor(&CNet_Init_nocache))
+        .def("__init__", bp::make_constructor(&CNet_loadopts_nocache))
         .def("__init__", bp::make_constructor(&CNet_Init))
         .def("__init__", bp::make_constructor(&CNet_loadopts))
         .def("get_fov",     		&CNet_fov)
         .def("forward",     		&CNet_forward)
+        .def("forward_many",		&CNet_forward_many)
         .def("backward",			&CNet_backward)
         .def("set_eta",    		&network::set_eta)
         .def("set_phase",            &CNet_set_phase)
+        .def("start_trace",		&network::start_trace)
+        .def("stop_trace",			&network::stop_trace)
         .def("set_momentum",		&network::set_momentum)
         .def("set_weight_decay",	&network::set_weight_decay )
         .def("get_inputs_setsz", 	&CNet_get_inputs_setsz)
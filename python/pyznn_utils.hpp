@@ -15,6 +15,8 @@
 #include <string>
 #include <memory>
 #include <cstdint>
+#include <cstring>
+#include <mutex>
 #include <assert.h>
 // znn
 #include "network/parallel/network.hpp"
@@ -373,25 +375,129 @@ std::vector<options> pyopt_to_znnopt( bp::list const & py_opts )
 	return res;
 }
 
+//Releases the GIL for the lifetime of the object, so that other python
+// threads can run while the network computes
+class gil_release
+{
+private:
+	PyThreadState* state_;
+
+public:
+	gil_release()
+		: state_( PyEval_SaveThread() )
+	{}
+
+	~gil_release()
+	{
+		PyEval_RestoreThread( state_ );
+	}
+};
+
+//The cubes wrapping numpy memory are only supported by the cube
+// implementations that take an external data pointer
+#if !defined( DUMMY_CUBE ) && ( defined( ZNN_MALLOC_CUBE ) ||		\
+                                defined( ZNN_CUBE_POOL_LOCKFREE ) ||	\
+                                defined( ZNN_CUBE_POOL ) )
+#  define ZNN_PYZNN_BORROW_ARRAYS
+#endif
+
+//Numpy arrays whose memory is borrowed by cubes. The last reference to
+// such a cube can be dropped by any worker thread, which can't take the
+// GIL while the main thread is waiting for the network. The references
+// to the arrays are therefore collected here and dropped by the main
+// thread at the next forward/backward call (see release)
+class borrowed_arrays
+{
+private:
+	std::mutex              m_       ;
+	std::vector<PyObject*>  released_;
+
+public:
+	void release_later( PyObject* o )
+	{
+		guard g(m_);
+		released_.push_back(o);
+	}
+
+	//Must be called with the GIL held
+	void release()
+	{
+		std::vector<PyObject*> r;
+		{
+			guard g(m_);
+			r.swap(released_);
+		}
+		for ( auto & o: r )
+		{
+			Py_DECREF(o);
+		}
+	}
+};
+
+inline borrowed_arrays & get_borrowed_arrays()
+{
+	static borrowed_arrays instance;
+	return instance;
+}
+
+#ifdef ZNN_PYZNN_BORROW_ARRAYS
+
+//Creates a cube using the memory of a numpy array, the array is kept
+// alive as long as the cube exists
+template <typename T>
+cube_p< T > borrow_array( np::ndarray const & arr, T* data, vec3i const & s )
+{
+	void*    mem = znn_malloc( __znn_aligned_size<cube<T>>::value );
+	cube<T>* c   = new (mem) cube<T>(s, data);
+
+	PyObject* o = arr.ptr();
+	Py_INCREF(o);
+
+	return cube_p< T >(c, [o](cube<T>* c) {
+			get_borrowed_arrays().release_later(o);
+			znn_free(c);
+		});
+}
+
+#endif
+
+//Converts a 4D array to a list of cubes. The cubes share the memory of
+// the array whenever possible, so the network might overwrite the array
 template <typename T>
 std::vector<cube_p< T >> array2cubelist( np::ndarray& vols )
 {
 	// ensure that the input ndarray is 4 dimension
 	assert( vols.get_nd() == 4 );
 
+	// no-op for C-contiguous arrays of the right type
+	// (e.g. the ones prepared by utils.make_continuous)
+	np::ndarray arr = bp::extract<np::ndarray>(
+		bp::import("numpy").attr("ascontiguousarray")(
+			vols, np::dtype::get_builtin<T>()) );
+
 	std::vector<cube_p< T >> ret;
-	ret.resize( vols.shape(0) );
+	ret.resize( arr.shape(0) );
 	// input volume size
-	std::size_t sc = vols.shape(0);
-	std::size_t sz = vols.shape(1);
-	std::size_t sy = vols.shape(2);
-	std::size_t sx = vols.shape(3);
+	std::size_t sc = arr.shape(0);
+	std::size_t sz = arr.shape(1);
+	std::size_t sy = arr.shape(2);
+	std::size_t sx = arr.shape(3);
+
+	T* data = reinterpret_cast<T*>( arr.get_data() );
 
 	for (std::size_t c=0; c<sc; c++)
 	{
+		T* cdata = data + c*sz*sy*sx;
+#ifdef ZNN_PYZNN_BORROW_ARRAYS
+		// the FFTs expect the cube alignment
+		if ( (reinterpret_cast<std::size_t>(cdata) & __ZNN_ALIGN) == 0 )
+		{
+			ret[c] = borrow_array<T>(arr, cdata, vec3i(sz,sy,sx));
+			continue;
+		}
+#endif
 		cube_p<T> cp = get_cube<T>(vec3i(sz,sy,sx));
-		for (std::size_t k=0; k< sz*sy*sx; k++)
-			cp->data()[k] = reinterpret_cast<T*>( vols.get_data() )[c*sz*sy*sx + k];
+		std::memcpy(cp->data(), cdata, sz*sy*sx*sizeof(T));
 		ret[c] = cp;
 	}
 	return ret;
@@ -411,6 +517,16 @@ std::map<std::string, std::vector<cube_p<T>>> pydict2sample( bp::dict pd)
 	return ret;
 }
 
+//Keeps a cube alive for as long as a numpy array viewing it exists
+template <typename T>
+struct cube_holder
+{
+	cube_p<T> cube;
+};
+
+//Converts a list of cubes to a 4D array. A single cube is handed out as a
+// read-only view (the network still reads it during the backward pass),
+// several cubes are copied into one contiguous array
 template <typename T>
 np::ndarray cubelist2array( bp::object const & self, std::vector<cube_p< T >> clist )
 {
@@ -420,21 +536,27 @@ np::ndarray cubelist2array( bp::object const & self, std::vector<cube_p< T >> cl
 	std::size_t sy = clist[0]->shape()[1];
 	std::size_t sx = clist[0]->shape()[2];
 
-	// temporal 4D qube pointer
-	qube_p<T> tqp = get_qube<T>( vec4i(sc,sz,sy,sx) );
+	bp::tuple shape   = bp::make_tuple(sc,sz,sy,sx);
+	bp::tuple strides = bp::make_tuple(sx*sy*sz*sizeof(T), sx*sy*sizeof(T),
+									   sx*sizeof(T), sizeof(T));
+
+	if ( sc == 1 )
+	{
+		bp::object owner( cube_holder<T>{clist[0]} );
+		np::ndarray ret = np::from_data( clist[0]->data(),
+										 np::dtype::get_builtin<T>(),
+										 shape, strides, owner );
+		ret.attr("setflags")(false);
+		return ret;
+	}
+
+	np::ndarray ret = np::empty( shape, np::dtype::get_builtin<T>() );
+	T* data = reinterpret_cast<T*>( ret.get_data() );
 	for (std::size_t c=0; c<sc; c++)
 	{
-		for (std::size_t k=0; k<sz*sy*sx; k++)
-			tqp->data()[c*sz*sy*sx+k] = clist[c]->data()[k];
+		std::memcpy(data + c*sz*sy*sx, clist[c]->data(), sz*sy*sx*sizeof(T));
 	}
-	// return ndarray
-	return 	np::from_data(
-				tqp->data(),
-				np::dtype::get_builtin<T>(),
-				bp::make_tuple(sc,sz,sy,sx),
-				bp::make_tuple(sx*sy*sz*sizeof(T), sx*sy*sizeof(T), sx*sizeof(T), sizeof(T)),
-				self
-			);
+	return ret;
 }
 
 template <typename T>
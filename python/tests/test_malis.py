@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+__doc__ = """
+
+compare the malis weights of affinity graphs with a brute force
+implementation on tiny random patches.
+
+usage: python tests/test_malis.py   (or pytest)
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cost_fn
+
+def connected(edges, N, i, j):
+    """whether voxel i and j are connected by the edges (breadth first)"""
+    nbrs = [list() for _ in range(N)]
+    for a, b in edges:
+        nbrs[a].append(b)
+        nbrs[b].append(a)
+    seen = set([i])
+    front = [i]
+    while front:
+        nxt = list()
+        for a in front:
+            for b in nbrs[a]:
+                if b not in seen:
+                    seen.add(b)
+                    nxt.append(b)
+        front = nxt
+    return j in seen
+
+def brute_force_malis(affs, true_affs, threshold=0.5):
+    """
+    the maximin edge of every voxel pair is the edge which first connects
+    the pair when adding the edges in descending order
+    """
+    lbl = cost_fn.aff2seg(true_affs, threshold)
+    eids, id1, id2 = cost_fn.get_aff_edges( affs.shape[1:] )
+    aff = affs.ravel()[eids]
+    order = np.argsort(-aff, kind='mergesort')
+
+    N = affs[0].size
+    merr = np.zeros(affs.size, dtype=affs.dtype)
+    serr = np.zeros(affs.size, dtype=affs.dtype)
+    for i in range(N):
+        for j in range(i+1, N):
+            edges = list()
+            for k in order:
+                edges.append( (id1[k], id2[k]) )
+                if connected(edges, N, i, j):
+                    break
+            if aff[k] > threshold and lbl[i] != lbl[j]:
+                merr[eids[k]] += 1
+            if aff[k] <= threshold and lbl[i] == lbl[j]:
+                serr[eids[k]] += 1
+
+    smerr = np.sum(merr, dtype=affs.dtype)
+    sserr = np.sum(serr, dtype=affs.dtype)
+    if smerr > 0:
+        merr = merr * ( len(eids)*0.5 / smerr )
+    if sserr > 0:
+        serr = serr * ( len(eids)*0.5 / sserr )
+    return (merr + serr).reshape(affs.shape)
+
+def test_malis_weight_aff():
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        shape = (3,) + tuple(rng.randint(1, 4, size=3))
+        affs = rng.rand(*shape).astype('float32')
+        true_affs = (rng.rand(*shape) > 0.4).astype('float32')
+
+        weights = cost_fn.malis_weight_aff(affs, true_affs)
+        expected = brute_force_malis(affs, true_affs)
+        assert np.allclose(weights, expected)
+
+if __name__ == '__main__':
+    test_malis_weight_aff()
+    print("ok")
@@ -4,6 +4,7 @@ __doc__ = """
 Jingpeng Wu <jingpeng.wu@gmail.com>, 2015
 """
 import time
+import numpy as np
 import matplotlib.pylab as plt
 import front_end
 import netio
@@ -13,6 +14,14 @@ import utils
 import zstatistics
 import os
 
+def timed_malis_weight( props, lbls ):
+    """
+    compute the malis weights, and the time spent in computation
+    """
+    malis_start = time.time()
+    malis_weights = cost_fn.malis_weight(props, lbls)
+    return malis_weights, time.time() - malis_start
+
 def main( conf_file='config.cfg', logfile=None ):
     #%% parameters
     print "reading config parameters..."
@@ -40,6 +49,8 @@ def main( conf_file='config.cfg', logfile=None ):
         # initalize a learning curve
         lc = zstatistics.CLearnCurve()
 
+    netio.print_fft_planning()
+
     # show field of view
     print "field of view: ", net.get_fov()
     print "output volume sizes: ", net.get_outputs_setsz()
@@ -60,10 +71,21 @@ def main( conf_file='config.cfg', logfile=None ):
     print "\n\ncreate test samples..."
     smp_tst = front_end.CSamples(config, pars, pars['test_range'],  net, outsz, logfile)
 
+    if pars['prefetch_size'] > 0:
+        print "prefetching train samples in background..."
+        smp_trn = front_end.CSamplesPrefetcher(smp_trn, pars['prefetch_size'],
+                                    pars['prefetch_threads'], pars['sample_seed'])
+    elif pars['sample_seed'] is not None:
+        np.random.seed( pars['sample_seed'] )
+
     # initialization
     elapsed = 0
     err = 0
     cls = 0
+    # time waiting for the training samples
+    wait = 0
+    # time of computing the malis weights
+    malis_time = 0
 
     # interactive visualization
     plt.ion()
@@ -77,77 +99,92 @@ def main( conf_file='config.cfg', logfile=None ):
     print "start training..."
     start = time.time()
     print "start from ", iter_last+1
-    for i in xrange(iter_last+1, pars['Max_iter']+1):
-        vol_ins, lbl_outs, msks = smp_trn.get_random_sample()
-
-        # forward pass
-        vol_ins = utils.make_continuous(vol_ins, dtype=pars['dtype'])
-
-        props = net.forward( vol_ins )
-
-        # cost function and accumulate errors
-        props, cerr, grdts = pars['cost_fn']( props, lbl_outs )
-        err = err + cerr
-        cls = cls + cost_fn.get_cls(props, lbl_outs)
-
-        # mask process the gradient
-        grdts = utils.dict_mul(grdts, msks)
-
-        # run backward pass
-        grdts = utils.make_continuous(grdts, dtype=pars['dtype'])
-        net.backward( grdts )
-
-        if pars['is_malis'] :
-            malis_weights = cost_fn.malis_weight(props, lbl_outs)
-            grdts = utils.dict_mul(grdts, malis_weights)
-
-        if i%pars['Num_iter_per_test']==0:
-            # test the net
-            lc = test.znn_test(net, pars, smp_tst, vn, i, lc)
-
-        if i%pars['Num_iter_per_show']==0:
-            # anneal factor
-            eta = eta * pars['anneal_factor']
-            net.set_eta(eta)
-            # normalize
-            err = err / vn / pars['Num_iter_per_show']
-            cls = cls / vn / pars['Num_iter_per_show']
-            lc.append_train(i, err, cls)
-
-            # time
-            elapsed = time.time() - start
-            elapsed = elapsed / pars['Num_iter_per_show']
-
-            show_string = "iteration %d,    err: %.3f,    cls: %.3f,   elapsed: %.1f s/iter, learning rate: %.6f"\
-                    %(i, err, cls, elapsed, eta )
-
-            if pars.has_key('logging') and pars['logging']:
-                utils.write_to_log(logfile, show_string)
-            print show_string
-
-            if pars['is_visual']:
-                # show results To-do: run in a separate thread
-                front_end.inter_show(start, lc, eta, vol_ins, props, lbl_outs, grdts, pars)
-                if pars['is_rebalance'] and 'aff' not in pars['out_type']:
-                    plt.subplot(247)
-                    plt.imshow(msks.values()[0][0,0,:,:], interpolation='nearest', cmap='gray')
-                    plt.xlabel('rebalance weight')
+    try:
+        for i in xrange(iter_last+1, pars['Max_iter']+1):
+            wait_start = time.time()
+            vol_ins, lbl_outs, msks = smp_trn.get_random_sample()
+            wait = wait + time.time() - wait_start
+
+            # forward pass
+            vol_ins = utils.make_continuous(vol_ins, dtype=pars['dtype'])
+
+            props = net.forward( vol_ins )
+
+            # cost function and accumulate errors
+            props, cerr, grdts = pars['cost_fn']( props, lbl_outs )
+
+            err = err + cerr
+            cls = cls + cost_fn.get_cls(props, lbl_outs)
+
+            # mask process the gradient
+            grdts = utils.dict_mul(grdts, msks)
+
+            if pars['is_malis'] :
+                malis_weights, t = timed_malis_weight(props, lbl_outs)
+                malis_time = malis_time + t
+                grdts = utils.dict_mul(grdts, malis_weights)
+
+            # run backward pass
+            grdts = utils.make_continuous(grdts, dtype=pars['dtype'])
+            net.backward( grdts )
+
+            if i%pars['Num_iter_per_test']==0:
+                # test the net
+                lc = test.znn_test(net, pars, smp_tst, vn, i, lc)
+
+            if i%pars['Num_iter_per_show']==0:
+                # anneal factor
+                eta = eta * pars['anneal_factor']
+                net.set_eta(eta)
+                # normalize
+                err = err / vn / pars['Num_iter_per_show']
+                cls = cls / vn / pars['Num_iter_per_show']
+                lc.append_train(i, err, cls)
+
+                # time
+                elapsed = time.time() - start
+                elapsed = elapsed / pars['Num_iter_per_show']
+                wait = wait / pars['Num_iter_per_show']
+
+                show_string = "iteration %d,    err: %.3f,    cls: %.3f,   elapsed: %.1f s/iter, sample wait: %.3f s/iter, learning rate: %.6f"\
+                        %(i, err, cls, elapsed, wait, eta )
                 if pars['is_malis']:
-                    plt.subplot(248)
-                    plt.imshow(malis_weights.values()[0][0,0,:,:], interpolation='nearest', cmap='gray')
-                    plt.xlabel('malis weight (log)')
-                plt.pause(2)
-                plt.show()
-            # reset err and cls
-            err = 0
-            cls = 0
-            # reset time
-            start = time.time()
-
-        if i%pars['Num_iter_per_save']==0:
-            # save network
-            netio.save_network(net, pars['train_save_net'], num_iters=i)
-            lc.save( pars, elapsed )
+                    malis_time = malis_time / pars['Num_iter_per_show']
+                    show_string += ", malis: %.3f s/iter" %(malis_time)
+
+                if pars.has_key('logging') and pars['logging']:
+                    utils.write_to_log(logfile, show_string)
+                print show_string
+
+                if pars['is_visual']:
+                    # show results To-do: run in a separate thread
+                    front_end.inter_show(start, lc, eta, vol_ins, props, lbl_outs, grdts, pars)
+                    if pars['is_rebalance'] and 'aff' not in pars['out_type']:
+                        plt.subplot(247)
+                        plt.imshow(msks.values()[0][0,0,:,:], interpolation='nearest', cmap='gray')
+                        plt.xlabel('rebalance weight')
+                    if pars['is_malis']:
+                        plt.subplot(248)
+                        plt.imshow(malis_weights.values()[0][0,0,:,:], interpolation='nearest', cmap='gray')
+                        plt.xlabel('malis weight (log)')
+                    plt.pause(2)
+                    plt.show()
+                # reset err and cls
+                err = 0
+                cls = 0
+                wait = 0
+                malis_time = 0
+                # reset time
+                start = time.time()
+
+            if i%pars['Num_iter_per_save']==0:
+                # save network
+                netio.save_network(net, pars['train_save_net'], num_iters=i)
+                lc.save( pars, elapsed )
+    finally:
+        if pars['prefetch_size'] > 0:
+            # stop the prefetching threads
+            smp_trn.close()
 
 if __name__ == '__main__':
     """
@@ -200,6 +200,29 @@ def fill_boundary( lbl ):
                         lbl[z,y,x+1] = 0
     return lbl
 
+def compact_label( vol, dtype='float32' ):
+    """
+    cast a label volume to the smallest integer type holding its values.
+
+    Parameters
+    ----------
+    vol : array, label volume
+    dtype : the type used if the values are not integers
+
+    Returns
+    -------
+    vol : the volume with the smallest integer type, or with dtype
+    """
+    if vol.size == 0:
+        return vol.astype(dtype)
+    if vol.dtype.kind == 'b':
+        return vol
+    if vol.dtype.kind == 'f' and not np.all( np.mod(vol, 1)==0 ):
+        return vol.astype(dtype)
+    ltype = np.promote_types( np.min_scalar_type( int(vol.min()) ),
+                              np.min_scalar_type( int(vol.max()) ) )
+    return vol.astype(ltype)
+
 def make_continuous( d , dtype='float32'):
     """
     make the dictionary arrays continuous.
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+__doc__ = """
+
+Lazy Volume Access
+
+ The volumes returned by open_volume only read the parts which are
+ sliced out of them, so that image stacks larger than the memory can be
+ processed patch by patch. Uncompressed tif pages and hdf5 datasets are
+ memory-mapped/read on demand by the operating system and h5py.
+"""
+
+import os
+import shutil
+import weakref
+import hashlib
+import tempfile
+
+import numpy as np
+
+import tifffile
+
+class TiffStack(object):
+    """
+    A lazy 3D volume of a multi-page tif file
+
+    Pages stored contiguously and uncompressed are memory-mapped,
+    the other pages are decoded whenever they are sliced.
+    """
+
+    def __init__(self, fname):
+        self.tif = tifffile.TiffFile(fname)
+        self.pages = self.tif.pages
+
+        page = self.pages[0]
+        assert len(page.shape)==2, "only gray image stacks can be streamed"
+
+        self.shape = (len(self.pages),) + tuple(page.shape)
+        self.dtype = np.dtype(page.dtype)
+        self.ndim = 3
+
+        # memory-mapped pages
+        self._memmaps = dict()
+
+    def _get_page(self, z):
+        if z in self._memmaps:
+            return self._memmaps[z]
+        page = self.pages[z].asarray(memmap=True)
+        if isinstance(page, np.memmap):
+            self._memmaps[z] = page
+        return page
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+
+        zs = np.arange(self.shape[0])[key[0]]
+        if np.ndim(zs)==0:
+            return np.asarray(self._get_page(zs)[key[1:]])
+        return np.asarray([self._get_page(z)[key[1:]] for z in zs],
+                          dtype=self.dtype)
+
+    def close(self):
+        self._memmaps = dict()
+        self.tif.close()
+
+def open_h5(fname):
+    """
+    open the dataset of a hdf5 file without reading it.
+    the emirt convention '/main' is used if it exists,
+    otherwise the file should contain a single dataset.
+    """
+    import h5py
+    f = h5py.File(fname, 'r')
+    if '/main' in f:
+        return f['/main']
+    keys = f.keys()
+    assert len(keys)==1, "can not decide the dataset of " + fname
+    return f[keys[0]]
+
+def open_volume(fname):
+    """
+    open a tif or hdf5 volume lazily
+
+    Parameters
+    ----------
+    fname : string, file name
+
+    Returns
+    -------
+    vol : 3D array-like volume with shape, dtype and slicing
+    """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ('.h5', '.hdf5'):
+        return open_h5(fname)
+    elif ext in ('.tif', '.tiff'):
+        return TiffStack(fname)
+    else:
+        raise NameError( 'can not stream file type: ' + ext )
+
+class VolumeStack(object):
+    """
+    A lazy 4D stack of lazy 3D volumes of the same size. The volumes can
+    be cropped (e.g. by auto crop) through their offsets.
+    """
+
+    def __init__(self, vols, shape3d=None, offsets=None):
+        self.vols = vols
+        if shape3d is None:
+            shape3d = vols[0].shape
+        if offsets is None:
+            offsets = [(0,0,0)] * len(vols)
+        self.offsets = offsets
+        self.shape = (len(vols),) + tuple(shape3d)
+        self.dtype = vols[0].dtype
+        self.ndim = 4
+
+    def _read(self, c, key):
+        off = self.offsets[c]
+        sls = list()
+        for k, o, n in zip(key, off, self.shape[1:]):
+            start, stop, step = k.indices(n)
+            assert step==1, "only unit steps are supported"
+            sls.append( slice(start+o, stop+o) )
+        return np.asarray( self.vols[c][tuple(sls)] )
+
+    def __getitem__(self, key):
+        assert isinstance(key, tuple) and len(key)==4
+        assert all(isinstance(k, slice) for k in key)
+
+        cs = range(self.shape[0])[key[0]]
+        ret = None
+        for i, c in enumerate(cs):
+            vol = self._read(c, key[1:])
+            if ret is None:
+                ret = np.empty((len(cs),) + vol.shape, dtype=vol.dtype)
+            ret[i] = vol
+        return ret
+
+def mirror_indices(begin, end, n):
+    """
+    indices of a range in a volume axis of size n which is virtually
+    extended by mirroring (the same way with utils.boundary_mirror),
+    -1 maps to 0, -2 to 1, n to n-1, and so on.
+    """
+    idx = np.arange(begin, end)
+    idx = np.where(idx < 0, -idx-1, idx)
+    idx = np.where(idx >= n, 2*n-1-idx, idx)
+    return idx
+
+def read_mirrored(data, begins, ends, offsets):
+    """
+    read a box of a 4D volume which is virtually padded by mirroring,
+    only the voxels of the box are read.
+
+    Parameters
+    ----------
+    data : 4D array-like volume
+    begins, ends : 3 int, the box in the padded coordinates
+    offsets : 3 int, size of the low padding of each axis
+
+    Returns
+    -------
+    ret : 4D array
+    """
+    idxs = [mirror_indices(b-o, e-o, n) for b, e, o, n
+            in zip(begins, ends, offsets, data.shape[1:])]
+    lows  = [idx.min() for idx in idxs]
+    highs = [idx.max()+1 for idx in idxs]
+
+    box = data[ :,
+                lows[0]:highs[0],
+                lows[1]:highs[1],
+                lows[2]:highs[2] ]
+
+    if all(len(idx)==h-l for idx, l, h in zip(idxs, lows, highs)) and \
+        all(np.all(np.diff(idx)>0) for idx in idxs):
+        # no mirroring needed
+        return np.asarray(box)
+
+    box = np.asarray(box)
+    return box[ np.ix_( np.arange(box.shape[0]),
+                        idxs[0]-lows[0],
+                        idxs[1]-lows[1],
+                        idxs[2]-lows[2] ) ]
+
+class BitMask(object):
+    """
+    A 4D boolean volume packed to one bit per voxel along the x axis,
+    the slices are unpacked when they are read.
+    """
+
+    def __init__(self, arr):
+        arr = np.asarray(arr) > 0
+        assert arr.ndim==4
+        self.shape = arr.shape
+        self.dtype = np.dtype(bool)
+        self.ndim = 4
+        self.size = arr.size
+        self.bits = np.packbits(arr, axis=3)
+
+    @staticmethod
+    def from_bits(bits, shape):
+        """a mask of already packed bits (e.g. loaded from a cache)"""
+        ret = BitMask(np.zeros((0,0,0,0), dtype=bool))
+        ret.shape = tuple(int(s) for s in shape)
+        ret.size = int(np.prod(ret.shape))
+        ret.bits = bits
+        return ret
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (4 - len(key))
+
+        # integer indices are read as slices and squeezed afterwards
+        sls = list()
+        squeeze = list()
+        for ax, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                assert step==1, "only unit steps are supported"
+            else:
+                start = int(k) + n if k < 0 else int(k)
+                stop = start + 1
+                squeeze.append(ax)
+            sls.append( (start, max(stop, start)) )
+
+        (c0,c1), (z0,z1), (y0,y1), (x0,x1) = sls
+        if x1 > x0:
+            bits = self.bits[c0:c1, z0:z1, y0:y1, x0//8:(x1+7)//8]
+            ret = np.unpackbits(bits, axis=3)[..., x0%8 : x0%8 + x1-x0]
+        else:
+            ret = np.zeros((c1-c0, z1-z0, y1-y0, 0), dtype=np.uint8)
+        ret = ret.view(bool)
+        if squeeze:
+            ret = ret.reshape([s for ax, s in enumerate(ret.shape)
+                               if ax not in squeeze])
+        return ret
+
+def file_signature(fname):
+    """
+    identifies the version of a file by its path, size and modification
+    time, without reading it
+    """
+    st = os.stat(fname)
+    return (os.path.abspath(fname), st.st_size, st.st_mtime)
+
+def volume_key(fnames, *params):
+    """
+    key of the arrays computed from the files with the parameters
+    """
+    h = hashlib.sha1()
+    for fname in fnames:
+        h.update( repr(file_signature(fname)).encode() )
+    for p in params:
+        h.update( repr(p).encode() )
+    return h.hexdigest()
+
+class SharedArrays(dict):
+    """
+    A dict of arrays which can be referenced weakly (see shared_arrays)
+    """
+    pass
+
+# Process-wide registry of the preprocessed arrays by their key (see
+# volume_key). An entry lives as long as some object holds it.
+shared_arrays = weakref.WeakValueDictionary()
+
+def share_arrays(key, arrays):
+    """
+    registers a dict of arrays, which become read-only
+
+    Returns
+    -------
+    arrays : SharedArrays to be held by its users
+    """
+    arrays = SharedArrays(arrays)
+    for arr in arrays.itervalues():
+        if isinstance(arr, np.ndarray):
+            arr.flags.writeable = False
+    shared_arrays[key] = arrays
+    return arrays
+
+class ArrayCache(object):
+    """
+    On-disk cache of preprocessed arrays
+
+    Each entry is a directory of .npy files named by its volume_key, a
+    hash of the source files (see file_signature) and of the parameters
+    used to compute the arrays. The arrays are loaded as read-only
+    memory maps.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = os.path.expanduser(dirname)
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+
+    def load(self, key):
+        """
+        Returns
+        -------
+        arrays : dict of memory-mapped arrays, None if not cached
+        """
+        path = os.path.join(self.dirname, key)
+        if not os.path.isdir(path):
+            return None
+        arrays = dict()
+        for fname in os.listdir(path):
+            name, ext = os.path.splitext(fname)
+            if ext == '.npy':
+                arrays[name] = np.load(os.path.join(path, fname), mmap_mode='r')
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        stores a dict of arrays, the entry appears at once when complete
+        """
+        path = os.path.join(self.dirname, key)
+        if os.path.isdir(path):
+            return
+        tmp = tempfile.mkdtemp(dir=self.dirname)
+        try:
+            for name, arr in arrays.iteritems():
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            # unless saved by another process meanwhile
+            if not os.path.isdir(path):
+                print "WARNING: could not cache the preprocessed arrays: ", e
+
+def open_cache(pars):
+    """
+    the cache of the preprocessed arrays, None if it is not used
+    """
+    if pars.get('preprocess_cache', ''):
+        return ArrayCache(pars['preprocess_cache'])
+    return None
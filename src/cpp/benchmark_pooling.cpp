@@ -0,0 +1,141 @@
+//
+// Copyright (C) 2012-2015  Aleksandar Zlateski <zlateski@mit.edu>
+// ---------------------------------------------------------------
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+//
+#include "assert.hpp"
+#include "pooling/pooling.hpp"
+
+#include <zi/time.hpp>
+
+#include <cstdlib>
+#include <iostream>
+#include <random>
+
+using namespace znn::v4;
+
+// Compares the max filter passes along the three axes of a volume:
+// the repeated passes of size 2, the sorted sliding window and the
+// van Herk/Gil-Werman filter, for window sizes 2 to max_size.
+//
+// usage: benchmark_pooling [x y z [max_size [rounds]]]
+
+template<typename P>
+double time_pass( cube<real> const & v, size_t fsize, size_t rounds,
+                  P const & pass, cube_p<real> & rv, cube_p<int> & ri )
+{
+    vec3i s = size(v);
+    auto cmp = [](real a, real b){ return a>b; };
+
+    double best = 1e100;
+
+    for ( size_t r = 0; r < rounds; ++r )
+    {
+        rv = get_copy(v);
+        ri = make_indices(s);
+        cube<real> & f = *rv;
+        cube<int>  & i = *ri;
+
+        zi::wall_timer wt;
+        wt.reset();
+
+        for ( long_t y = 0; y < s[1]; ++y )
+            for ( long_t z = 0; z < s[2]; ++z )
+                pass(&(f[0][y][z]), &(f[s[0]-1][y][z]), &(i[0][y][z]),
+                     fsize, s[1]*s[2], cmp);
+
+        for ( long_t x = 0; x < s[0]; ++x )
+            for ( long_t z = 0; z < s[2]; ++z )
+                pass(&(f[x][0][z]), &(f[x][s[1]-1][z]), &(i[x][0][z]),
+                     fsize, s[2], cmp);
+
+        for ( long_t x = 0; x < s[0]; ++x )
+            for ( long_t y = 0; y < s[1]; ++y )
+                pass(&(f[x][y][0]), &(f[x][y][s[2]-1]), &(i[x][y][0]),
+                     fsize, 1, cmp);
+
+        best = std::min(best, wt.elapsed<double>());
+    }
+
+    return best;
+}
+
+int main(int argc, char** argv)
+{
+    int64_t x = 128;
+    int64_t y = 128;
+    int64_t z = 128;
+
+    size_t max_size = 12;
+    size_t rounds   = 3;
+
+    if ( argc >= 4 )
+    {
+        x = atoi(argv[1]);
+        y = atoi(argv[2]);
+        z = atoi(argv[3]);
+    }
+
+    if ( argc >= 5 ) max_size = atoi(argv[4]);
+    if ( argc >= 6 ) rounds   = atoi(argv[5]);
+
+    auto v = get_cube<real>(vec3i(x,y,z));
+
+    std::mt19937 rng(1);
+    std::uniform_real_distribution<real> dis(0, 1);
+    for ( size_t i = 0; i < v->num_elements(); ++i )
+        v->data()[i] = dis(rng);
+
+    vec3i s(x,y,z);
+
+    std::cout << "size\trepeated\tsorted\tvhgw\n";
+
+    for ( size_t fsize = 2; fsize <= max_size; ++fsize )
+    {
+        if ( static_cast<int64_t>(fsize) > std::min(x,std::min(y,z)) ) break;
+
+        cube_p<real> rv1, rv2, rv3;
+        cube_p<int>  ri1, ri2, ri3;
+
+        double t1 = time_pass(*v, fsize, rounds,
+            [](auto... a) { pooling_filter_pass_repeated(a...); },
+            rv1, ri1);
+
+        double t2 = time_pass(*v, fsize, rounds,
+            [](auto... a) { pooling_filter_pass_sorted(a...); },
+            rv2, ri2);
+
+        double t3 = time_pass(*v, fsize, rounds,
+            [](auto... a) { pooling_filter_pass_vhgw(a...); },
+            rv3, ri3);
+
+        // the valid part of the filtered volumes should be the same
+        vec3i os = s - vec3i(fsize-1,fsize-1,fsize-1);
+        auto c1 = crop(*rv1, os);
+        auto c3 = crop(*rv3, os);
+        auto i1 = crop(*ri1, os);
+        auto i3 = crop(*ri3, os);
+
+        bool same = true;
+        for ( size_t i = 0; i < c1->num_elements(); ++i )
+        {
+            same = same && ( c1->data()[i] == c3->data()[i] )
+                        && ( i1->data()[i] == i3->data()[i] );
+        }
+
+        std::cout << fsize << '\t' << t1 << '\t' << t2 << '\t' << t3
+                  << ( same ? "" : "\tMISMATCH" ) << std::endl;
+    }
+}
@@ -0,0 +1,36 @@
+#!/bin/bash
+# Compares the speed of the benchmark/ZNN networks built with and without
+# the NUMA mode (-DZNN_NUMA: workers pinned to the NUMA nodes, node local
+# 64 byte aligned/huge page cube memory).
+#
+# usage: ./measure_numa.sh [threads...]        (default: 1 5 10 20 40)
+#        OUTSZ="x y z" ROUNDS=n ./measure_numa.sh ...
+
+NETS=../../../benchmark/ZNN
+THREADS=${@:-1 5 10 20 40}
+OUTSZ=${OUTSZ:-12 12 12}
+ROUNDS=${ROUNDS:-11}
+
+FLAGS="-std=c++1y -I../../.. -I../../../src/include -DNDEBUG -O3 \
+    -DZNN_CUBE_POOL_LOCKFREE -DZNN_USE_FLOATS -DZNN_DONT_CACHE_FFTS \
+    -lpthread -lrt -lfftw3f"
+
+g++ measure.cpp $FLAGS -o measure_default || exit 1
+g++ measure.cpp $FLAGS -DZNN_NUMA -o measure_numa || exit 1
+
+# prints the time of an iteration with the given number of threads
+function measure_time {
+    ./$1 $2 $OUTSZ 2 $ROUNDS $3 $3 | grep "^$3," | cut -d, -f2
+}
+
+echo "net, threads, default, numa, speedup"
+for net in $NETS/*.znn;
+do
+    for t in $THREADS;
+    do
+        a=`measure_time measure_default $net $t`
+        b=`measure_time measure_numa $net $t`
+        s=`echo "$a $b" | awk '{ printf "%.3f", $1 / $2 }'`
+        echo "`basename $net`, $t, $a, $b, $s"
+    done
+done
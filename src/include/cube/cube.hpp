@@ -29,6 +29,8 @@
 #  include "detail/dummy_cube.hpp"
 #endif
 
+#include "detail/pool_registry.hpp"
+
 namespace znn { namespace v4 {
 
 #if 1
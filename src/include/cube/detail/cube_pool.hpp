@@ -21,6 +21,8 @@
 #include <list>
 
 #include "../../types.hpp"
+#include "pool_registry.hpp"
+#include "../../utils/numa.hpp"
 
 #ifdef ZNN_XEON_PHI
 #  include <mkl.h>
@@ -28,7 +30,7 @@
 
 namespace znn { namespace v4 {
 
-#ifdef ZNN_XEON_PHI
+#if defined( ZNN_XEON_PHI ) || defined( ZNN_NUMA )
 #  define __ZNN_ALIGN 0x3F // 64 byte alignment
 #else
 #  define __ZNN_ALIGN 0xF // 16 byte alignment
@@ -48,6 +50,18 @@ inline void znn_free(void* ptr)
     mkl_free(ptr);
 }
 
+#elif defined( ZNN_NUMA )
+
+inline void* znn_malloc(size_t s)
+{
+    return znn_numa_malloc(s);
+}
+
+inline void znn_free(void* ptr)
+{
+    free(ptr);
+}
+
 #else
 
 inline void* znn_malloc(size_t s)
@@ -144,13 +158,28 @@ cube<T>* malloc_cube(const vec3i& s)
 }
 
 template<typename T>
-class single_size_cube_pool
+class single_size_cube_pool: public pool_size_class
 {
 private:
     vec3i                      size_;
     std::list<cube<T>*>        list_;
     std::mutex                 m_   ;
 
+protected:
+    // the least recently returned cube is freed first
+    bool free_cached() override
+    {
+        cube<T>* c = nullptr;
+        {
+            std::lock_guard<std::mutex> g(m_);
+            if ( list_.empty() ) return false;
+            c = list_.front();
+            list_.pop_front();
+        }
+        znn_free(c);
+        return true;
+    }
+
 public:
     void clear()
     {
@@ -165,19 +194,27 @@ public:
 public:
     void return_cube( cube<T>* c )
     {
-        std::lock_guard<std::mutex> g(m_);
-        list_.push_back(c);
+        bool limited = on_return();
+        {
+            std::lock_guard<std::mutex> g(m_);
+            list_.push_back(c);
+        }
+        if ( limited ) after_return();
     }
 
 public:
     single_size_cube_pool( const vec3i& s )
-        : size_(s)
+        : pool_size_class("cube<" + pool_element_name<T>() + ">",
+                          __znn_aligned_size<cube<T>>::value
+                          + s[0]*s[1]*s[2]*sizeof(T))
+        , size_(s)
         , list_{}
         , m_{}
     {}
 
     ~single_size_cube_pool()
     {
+        unregister();
         clear();
     }
 
@@ -193,6 +230,8 @@ public:
             }
         }
 
+        on_get(r != nullptr);
+
         if ( !r )
         {
             r = malloc_cube<T>(size_);
@@ -21,9 +21,13 @@
 #include <boost/lockfree/stack.hpp>
 #include <boost/lockfree/queue.hpp>
 #include <array>
+#include <memory>
+#include <vector>
 
 #include "../../types.hpp"
 #include "../../lockfree_allocator.hpp"
+#include "pool_registry.hpp"
+#include "../../utils/numa.hpp"
 
 #ifdef ZNN_XEON_PHI
 #  include <mkl.h>
@@ -31,7 +35,7 @@
 
 namespace znn { namespace v4 {
 
-#ifdef ZNN_XEON_PHI
+#if defined( ZNN_XEON_PHI ) || defined( ZNN_NUMA )
 #  define __ZNN_ALIGN 0x3F // 64 byte alignment
 #else
 #  define __ZNN_ALIGN 0xF // 16 byte alignment
@@ -40,8 +44,10 @@ namespace znn { namespace v4 {
 
 inline void* znn_malloc(size_t s)
 {
-#ifdef ZNN_XEON_PHI
+#if defined( ZNN_XEON_PHI )
     void* r = mkl_malloc(s,64);
+#elif defined( ZNN_NUMA )
+    void* r = znn_numa_malloc(s);
 #else
     void* r = malloc(s);
 #endif
@@ -134,15 +140,23 @@ inline T* __offset_cast(void* mem, size_t off)
 }
 
 
-class memory_bucket
+class memory_bucket: public pool_size_class
 {
 public:
-    std::size_t                   mem_size_;
     boost::lockfree::queue<void*> stack_   ;
 
+protected:
+    bool free_cached() override
+    {
+        void* p;
+        if ( !stack_.pop(p) ) return false;
+        znn_free(p);
+        return true;
+    }
+
 public:
     memory_bucket(size_t ms = 0)
-        : mem_size_(ms)
+        : pool_size_class("", ms)
         , stack_(65536*4)
     {}
 
@@ -158,20 +172,28 @@ public:
 public:
     void return_memory( void* c )
     {
+        bool limited = on_return();
         while ( !stack_.push(c) );
+        if ( limited ) after_return();
     }
 
 public:
     ~memory_bucket()
     {
+        unregister();
         clear();
     }
 
     void* get()
     {
         void* r;
-        if ( stack_.pop(r) ) return r;
-        return znn_malloc(mem_size_);
+        if ( stack_.pop(r) )
+        {
+            on_get(true);
+            return r;
+        }
+        on_get(false);
+        return znn_malloc(block_size());
     }
 };
 
@@ -179,14 +201,24 @@ template< typename T >
 class single_type_cube_pool
 {
 private:
-    std::array<memory_bucket,32> buckets_;
+    // a set of buckets for each numa node
+    std::vector<std::unique_ptr<std::array<memory_bucket,32>>> buckets_;
 
 public:
     single_type_cube_pool()
     {
-        for ( size_t i = 0; i < 32; ++i )
+        size_t nodes = numa_node_count();
+        for ( size_t n = 0; n < nodes; ++n )
         {
-            buckets_[i].mem_size_ = static_cast<size_t>(1) << i;
+            buckets_.emplace_back(new std::array<memory_bucket,32>);
+
+            std::string kind = "cube<" + pool_element_name<T>() + ">";
+            if ( nodes > 1 ) kind += "@node" + std::to_string(n);
+
+            for ( size_t i = 0; i < 32; ++i )
+            {
+                (*buckets_[n])[i].set_class(kind, static_cast<size_t>(1) << i);
+            }
         }
     }
 
@@ -196,12 +228,14 @@ public:
         size_t bucket = 64 - __builtin_clzl( __znn_aligned_size<cube<T>>::value
                                              + s[0]*s[1]*s[2]*sizeof(T) - 1 );
 
-        void*    mem  = buckets_[bucket].get();
+        memory_bucket* mb = &(*buckets_[this_thread_numa_node()])[bucket];
+
+        void*    mem  = mb->get();
         T*       data = __offset_cast<T>(mem, __znn_aligned_size<cube<T>>::value);
         cube<T>* c    = new (mem) cube<T>(s,data);
 
-        return std::shared_ptr<cube<T>>(c,[this,bucket](cube<T>* c) {
-                this->buckets_[bucket].return_memory(c);
+        return std::shared_ptr<cube<T>>(c,[mb](cube<T>* c) {
+                mb->return_memory(c);
             }, allocator<cube<T>>());
     }
 
@@ -211,14 +245,24 @@ template< typename T >
 class single_type_qube_pool
 {
 private:
-    std::array<memory_bucket,32> buckets_;
+    // a set of buckets for each numa node
+    std::vector<std::unique_ptr<std::array<memory_bucket,32>>> buckets_;
 
 public:
     single_type_qube_pool()
     {
-        for ( size_t i = 0; i < 32; ++i )
+        size_t nodes = numa_node_count();
+        for ( size_t n = 0; n < nodes; ++n )
         {
-            buckets_[i].mem_size_ = static_cast<size_t>(1) << i;
+            buckets_.emplace_back(new std::array<memory_bucket,32>);
+
+            std::string kind = "qube<" + pool_element_name<T>() + ">";
+            if ( nodes > 1 ) kind += "@node" + std::to_string(n);
+
+            for ( size_t i = 0; i < 32; ++i )
+            {
+                (*buckets_[n])[i].set_class(kind, static_cast<size_t>(1) << i);
+            }
         }
     }
 
@@ -229,12 +273,14 @@ public:
             size_t bucket = 64 - __builtin_clzl( __znn_aligned_size<qube<T>>::value
                                                  + s[0]*s[1]*s[2]*s[3]*sizeof(T) - 1 );
 
-            void*    mem  = buckets_[bucket].get();
+            memory_bucket* mb = &(*buckets_[this_thread_numa_node()])[bucket];
+
+            void*    mem  = mb->get();
             T*       data = __offset_cast<T>(mem, __znn_aligned_size<qube<T>>::value);
             qube<T>* c    = new (mem) qube<T>(s,data);
 
-            return std::shared_ptr<qube<T>>(c,[this,bucket](qube<T>* c) {
-                    this->buckets_[bucket].return_memory(c);
+            return std::shared_ptr<qube<T>>(c,[mb](qube<T>* c) {
+                    mb->return_memory(c);
                 }, allocator<qube<T>>());
         }
 
@@ -0,0 +1,394 @@
+//
+// Copyright (C) 2012-2015  Aleksandar Zlateski <zlateski@mit.edu>
+// ---------------------------------------------------------------
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+//
+#pragma once
+
+#include <zi/utility/singleton.hpp>
+
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <complex>
+#include <cstdint>
+#include <cstdlib>
+#include <mutex>
+#include <string>
+#include <vector>
+
+namespace znn { namespace v4 {
+
+template< typename T >
+inline std::string pool_element_name()
+{
+    return std::to_string(sizeof(T)) + " bytes";
+}
+
+template<> inline std::string pool_element_name<float>()  { return "float";  }
+template<> inline std::string pool_element_name<double>() { return "double"; }
+template<> inline std::string pool_element_name<int>()    { return "int";    }
+template<> inline std::string pool_element_name<bool>()   { return "bool";   }
+
+template<> inline std::string pool_element_name<std::complex<float>>()
+{
+    return "complex<float>";
+}
+
+template<> inline std::string pool_element_name<std::complex<double>>()
+{
+    return "complex<double>";
+}
+
+struct pool_class_stats
+{
+    std::string kind  ; // e.g. cube<float>
+    std::size_t block ; // bytes of each memory block of the class
+    std::size_t live  ; // blocks in use
+    std::size_t cached; // blocks kept for reuse
+    std::size_t hits  ; // requests served by a cached block
+    std::size_t misses; // requests which had to allocate
+
+    std::size_t bytes() const
+    {
+        return (live + cached) * block;
+    }
+
+    double hit_rate() const
+    {
+        return ( hits + misses ) ? static_cast<double>(hits) / (hits + misses)
+                                 : 0;
+    }
+};
+
+class pool_size_class;
+
+// All the size classes of the cube pools. The pools keep the freed
+// memory for reuse, the registry frees the cached memory of the least
+// recently used classes when the cached bytes exceed the limit (set by
+// the ZNN_CUBE_POOL_LIMIT environment variable or set_limit, 0 for no
+// limit), or when trim is called. The process-wide count of the cached
+// bytes is only kept up to date while a limit is set, so that the pools
+// without a limit never touch it.
+class cube_pool_registry
+{
+private:
+    std::mutex                    m_           ;
+    std::mutex                    trim_m_      ;
+    std::vector<pool_size_class*> classes_     ;
+    std::atomic<std::size_t>      cached_bytes_;
+    std::atomic<std::size_t>      limit_       ;
+    std::atomic<std::int64_t>     clock_       ; // advanced on each miss
+
+    std::size_t count_cached();
+    std::size_t trim_locked( std::size_t keep );
+
+public:
+    cube_pool_registry()
+        : m_(), trim_m_(), classes_(), cached_bytes_(0), limit_(0), clock_(0)
+    {
+        if ( const char * l = std::getenv("ZNN_CUBE_POOL_LIMIT") )
+        {
+            limit_ = std::strtoull(l, nullptr, 10);
+        }
+    }
+
+    void add( pool_size_class* c )
+    {
+        std::lock_guard<std::mutex> g(m_);
+        classes_.push_back(c);
+    }
+
+    void remove( pool_size_class* c )
+    {
+        std::lock_guard<std::mutex> g(m_);
+        classes_.erase(std::remove(classes_.begin(), classes_.end(), c),
+                       classes_.end());
+    }
+
+    bool limited() const
+    {
+        return limit_.load(std::memory_order_relaxed) != 0;
+    }
+
+    // the time of the last miss, used to order the classes by their use
+    std::int64_t clock() const
+    {
+        return clock_.load(std::memory_order_relaxed);
+    }
+
+    std::int64_t tick()
+    {
+        return clock_.fetch_add(1, std::memory_order_relaxed) + 1;
+    }
+
+    void cached( std::size_t b )
+    {
+        cached_bytes_.fetch_add(b, std::memory_order_relaxed);
+    }
+
+    void uncached( std::size_t b )
+    {
+        cached_bytes_.fetch_sub(b, std::memory_order_relaxed);
+    }
+
+    std::size_t cached_bytes()
+    {
+        return count_cached();
+    }
+
+    std::size_t limit() const
+    {
+        return limit_.load();
+    }
+
+    void set_limit( std::size_t l )
+    {
+        std::lock_guard<std::mutex> g(trim_m_);
+        limit_ = l;
+        cached_bytes_ = count_cached();
+        if ( l ) trim_locked(l);
+    }
+
+    // called by the pools with a limit after returning memory, trims the
+    // pools if the limit is exceeded (unless some other thread is
+    // already trimming)
+    void enforce_limit()
+    {
+        std::size_t l = limit_.load(std::memory_order_relaxed);
+        if ( l == 0 || cached_bytes_.load(std::memory_order_relaxed) <= l )
+        {
+            return;
+        }
+
+        std::unique_lock<std::mutex> g(trim_m_, std::try_to_lock);
+        if ( g.owns_lock() ) trim_locked(l);
+    }
+
+    // frees the cached memory until at most keep bytes are cached,
+    // returns the number of bytes freed
+    std::size_t trim( std::size_t keep = 0 )
+    {
+        std::lock_guard<std::mutex> g(trim_m_);
+        return trim_locked(keep);
+    }
+
+    std::vector<pool_class_stats> stats();
+};
+
+namespace {
+cube_pool_registry& cube_pools =
+    zi::singleton<cube_pool_registry>::instance();
+} // anonymous namespace
+
+// A size class of a pool: memory blocks of the same size which are
+// either in use (live) or kept for reuse (cached). The pools update the
+// counters when handing out and getting back the blocks; each of these
+// is a single relaxed increment of a counter of the class, the numbers
+// of live and cached blocks are derived from the counters.
+class pool_size_class
+{
+private:
+    cube_pool_registry &       registry_;
+    std::string                kind_    ;
+    std::size_t                block_   ;
+    std::atomic<std::size_t>   hits_    ;
+    std::atomic<std::size_t>   misses_  ;
+    std::atomic<std::size_t>   returns_ ;
+    std::atomic<std::size_t>   released_;
+    std::atomic<std::int64_t>  last_use_;
+    bool                       registered_;
+
+protected:
+    // frees one cached block, returns false if there is none
+    virtual bool free_cached() = 0;
+
+    void on_get( bool hit )
+    {
+        if ( hit )
+        {
+            hits_.fetch_add(1, std::memory_order_relaxed);
+            if ( registry_.limited() ) registry_.uncached(block_);
+
+            // only written when some class missed since the last use
+            std::int64_t now = registry_.clock();
+            if ( last_use_.load(std::memory_order_relaxed) != now )
+            {
+                last_use_.store(now, std::memory_order_relaxed);
+            }
+        }
+        else
+        {
+            misses_.fetch_add(1, std::memory_order_relaxed);
+            last_use_.store(registry_.tick(), std::memory_order_relaxed);
+        }
+    }
+
+    // should be called before the block is cached, returns whether the
+    // pool should call after_return once the block is cached
+    bool on_return()
+    {
+        returns_.fetch_add(1, std::memory_order_relaxed);
+        if ( registry_.limited() )
+        {
+            registry_.cached(block_);
+            return true;
+        }
+        return false;
+    }
+
+    // trims the pools if the limit is exceeded
+    void after_return()
+    {
+        registry_.enforce_limit();
+    }
+
+    // should be called before the destruction of the derived classes
+    void unregister()
+    {
+        if ( registered_ )
+        {
+            registry_.remove(this);
+            registered_ = false;
+        }
+    }
+
+public:
+    explicit pool_size_class( std::string const & kind = "",
+                              std::size_t block = 0 )
+        : registry_(zi::singleton<cube_pool_registry>::instance())
+        , kind_(kind)
+        , block_(block)
+        , hits_(0)
+        , misses_(0)
+        , returns_(0)
+        , released_(0)
+        , last_use_(0)
+        , registered_(true)
+    {
+        registry_.add(this);
+    }
+
+    virtual ~pool_size_class()
+    {
+        unregister();
+    }
+
+    void set_class( std::string const & kind, std::size_t block )
+    {
+        kind_  = kind ;
+        block_ = block;
+    }
+
+    std::size_t block_size() const
+    {
+        return block_;
+    }
+
+    std::int64_t last_use() const
+    {
+        return last_use_.load(std::memory_order_relaxed);
+    }
+
+    // blocks kept for reuse (approximate while the pool is in use)
+    std::size_t cached() const
+    {
+        std::int64_t n = static_cast<std::int64_t>(returns_.load())
+            - static_cast<std::int64_t>(hits_.load())
+            - static_cast<std::int64_t>(released_.load());
+        return n > 0 ? n : 0;
+    }
+
+    pool_class_stats stats() const
+    {
+        std::size_t hits   = hits_.load();
+        std::size_t misses = misses_.load();
+        std::int64_t live  = static_cast<std::int64_t>(hits + misses)
+            - static_cast<std::int64_t>(returns_.load());
+
+        return { kind_, block_, live > 0 ? static_cast<std::size_t>(live) : 0,
+                 cached(), hits, misses };
+    }
+
+    // frees a cached block, returns false if there is none
+    bool release()
+    {
+        if ( cached() == 0 || !free_cached() ) return false;
+
+        released_.fetch_add(1, std::memory_order_relaxed);
+        registry_.uncached(block_);
+        return true;
+    }
+};
+
+inline std::size_t cube_pool_registry::count_cached()
+{
+    std::lock_guard<std::mutex> g(m_);
+
+    std::size_t bytes = 0;
+    for ( auto c: classes_ )
+    {
+        bytes += c->cached() * c->block_size();
+    }
+    return bytes;
+}
+
+inline std::size_t cube_pool_registry::trim_locked( std::size_t keep )
+{
+    // the count is not kept without a limit
+    cached_bytes_ = count_cached();
+
+    std::lock_guard<std::mutex> g(m_);
+
+    // least recently used first
+    std::vector<pool_size_class*> order(classes_);
+    std::stable_sort(order.begin(), order.end(),
+                     [](pool_size_class* a, pool_size_class* b)
+                     { return a->last_use() < b->last_use(); });
+
+    std::size_t freed = 0;
+    for ( auto c: order )
+    {
+        while ( cached_bytes_.load() > keep && c->release() )
+        {
+            freed += c->block_size();
+        }
+        if ( cached_bytes_.load() <= keep ) break;
+    }
+    return freed;
+}
+
+inline std::vector<pool_class_stats> cube_pool_registry::stats()
+{
+    std::lock_guard<std::mutex> g(m_);
+
+    std::vector<pool_class_stats> ret;
+    for ( auto c: classes_ )
+    {
+        auto s = c->stats();
+        if ( s.live || s.cached || s.hits || s.misses )
+        {
+            ret.push_back(s);
+        }
+    }
+
+    std::sort(ret.begin(), ret.end(),
+              [](pool_class_stats const & a, pool_class_stats const & b)
+              { return a.kind < b.kind ||
+                      ( a.kind == b.kind && a.block < b.block ); });
+    return ret;
+}
+
+}} // namespace znn::v4
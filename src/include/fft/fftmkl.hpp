@@ -101,10 +101,9 @@ public:
             : sz(s)
             , actual_sz(s)
         {
-            if ( (s[0] == 1) && (s[1] == s[2]) )
+            for ( std::size_t a = 0; a < 3; ++a )
             {
-                int32_t opt = get_optimal(s[1]);
-                actual_sz[1] = actual_sz[2] = opt;
+                actual_sz[a] = get_optimal(s[a]);
             }
 
             forward_plan  = fft_plans.get_forward(actual_sz);
@@ -21,6 +21,7 @@
 
 #include "../types.hpp"
 #include "../cube/cube.hpp"
+#include "plan_registry.hpp"
 
 #include <zi/utility/singleton.hpp>
 #include <zi/time/time.hpp>
@@ -30,6 +31,7 @@
 #include <iostream>
 #include <type_traits>
 #include <mutex>
+#include <string>
 
 namespace znn { namespace v4 {
 
@@ -52,42 +54,77 @@ typedef DFTI_DESCRIPTOR_HANDLE* fft_plan;
 class fft_plans_impl
 {
 private:
-    std::mutex                                           m_          ;
-    std::unordered_map<vec3i, fft_plan, vec_hash<vec3i>> fwd_        ;
-    std::unordered_map<vec3i, fft_plan, vec_hash<vec3i>> bwd_        ;
-    real                                                 time_       ;
+    std::mutex               m_          ;
+    plan_registry<fft_plan>  fwd_        ;
+    plan_registry<fft_plan>  bwd_        ;
+    plan_lock_stats          stats_      ;
+    real                     time_       ;
+    std::size_t              n_plans_ = 0;
 
 public:
+    // MKL has no wisdom, the planning is always repeated
+    void set_wisdom_file( std::string const & )
+    {
+    }
+
+    std::string wisdom_file()
+    {
+        return "";
+    }
+
+    void save_wisdom()
+    {
+    }
+
+    real planning_time()
+    {
+        guard g(m_);
+        return time_;
+    }
+
+    std::size_t plan_count()
+    {
+        guard g(m_);
+        return n_plans_;
+    }
+
+    plan_lock_stats const & lock_stats() const
+    {
+        return stats_;
+    }
+
     ~fft_plans_impl()
     {
-        for ( auto& p: fwd_ )
+        fwd_.for_each([](fft_plan p)
         {
-            DftiFreeDescriptor(p.second);
-            delete p.second;
-        }
+            DftiFreeDescriptor(p);
+            delete p;
+        });
 
-        for ( auto& p: bwd_ )
+        bwd_.for_each([](fft_plan p)
         {
-            DftiFreeDescriptor(p.second);
-            delete p.second;
-        }
+            DftiFreeDescriptor(p);
+            delete p;
+        });
     }
 
-    fft_plans_impl(): m_(), fwd_(), bwd_(), time_(0)
+    fft_plans_impl(): m_(), fwd_(), bwd_(), stats_(), time_(0)
     {
     }
 
     fft_plan get_forward( const vec3i& s )
     {
-        guard g(m_);
+        stats_.lookup();
+
+        if ( fft_plan p = bwd_.find(s) ) return p;
 
-        fft_plan& ret = bwd_[s];
+        auto g = stats_.lock(m_);
 
-        if ( ret ) return ret;
+        if ( fft_plan p = bwd_.find(s) ) return p;
 
         zi::wall_timer wt; wt.reset();
 
-        ret = new DFTI_DESCRIPTOR_HANDLE;
+        fft_plan ret = new DFTI_DESCRIPTOR_HANDLE;
 
         MKL_LONG status, l[3];
         MKL_LONG strides_out[4];
@@ -118,7 +155,10 @@ public:
 
         status = DftiCommitDescriptor(*ret);
 
+        bwd_.insert(s, ret);
+
         time_ += wt.elapsed<real>();
+        ++n_plans_;
 
 //        std::cout << "Total time spent creating fft plans: "
 //                  << time_ << std::endl;
@@ -128,15 +168,17 @@ public:
 
     fft_plan get_backward( const vec3i& s )
     {
-        guard g(m_);
+        stats_.lookup();
+
+        if ( fft_plan p = fwd_.find(s) ) return p;
 
-        fft_plan& ret = fwd_[s];
+        auto g = stats_.lock(m_);
 
-        if ( ret ) return ret;
+        if ( fft_plan p = fwd_.find(s) ) return p;
 
         zi::wall_timer wt; wt.reset();
 
-        ret = new DFTI_DESCRIPTOR_HANDLE;
+        fft_plan ret = new DFTI_DESCRIPTOR_HANDLE;
 
         MKL_LONG status, l[3];
         MKL_LONG strides_out[4];
@@ -167,7 +209,10 @@ public:
 
         status = DftiCommitDescriptor(*ret);
 
+        fwd_.insert(s, ret);
+
         time_ += wt.elapsed<real>();
+        ++n_plans_;
 
 //        std::cout << "Total time spent creating fft plans: "
 //                  << time_ << std::endl;
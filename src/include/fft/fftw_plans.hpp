@@ -25,15 +25,22 @@
 
 #include "../types.hpp"
 #include "../cube/cube.hpp"
+#include "plan_registry.hpp"
 
 #include <zi/utility/singleton.hpp>
 #include <zi/time/time.hpp>
 
+#include <algorithm>
+#include <limits>
 #include <map>
 #include <iostream>
 #include <unordered_map>
 #include <type_traits>
 #include <mutex>
+#include <string>
+#include <cstdio>
+#include <cstdlib>
+#include <unistd.h>
 
 #ifndef ZNN_FFTW_PLANNING_MODE
 #  define ZNN_FFTW_PLANNING_MODE (FFTW_ESTIMATE)
@@ -47,6 +54,12 @@ namespace znn { namespace v4 {
 #define FFT_CLEANUP      fftwf_cleanup
 #define FFT_PLAN_C2R     fftwf_plan_dft_c2r_3d
 #define FFT_PLAN_R2C     fftwf_plan_dft_r2c_3d
+#define FFT_IMPORT_WISDOM fftwf_import_wisdom_from_filename
+#define FFT_EXPORT_WISDOM fftwf_export_wisdom_to_filename
+#define FFT_IMPORT_WISDOM_STRING fftwf_import_wisdom_from_string
+#define FFT_EXPORT_WISDOM_STRING fftwf_export_wisdom_to_string
+#define FFT_FORGET_WISDOM fftwf_forget_wisdom
+#define FFT_EXECUTE      fftwf_execute
 typedef fftwf_plan    fft_plan   ;
 typedef fftwf_complex fft_complex;
 
@@ -56,6 +69,12 @@ typedef fftwf_complex fft_complex;
 #define FFT_CLEANUP      fftw_cleanup
 #define FFT_PLAN_C2R     fftw_plan_dft_c2r_3d
 #define FFT_PLAN_R2C     fftw_plan_dft_r2c_3d
+#define FFT_IMPORT_WISDOM fftw_import_wisdom_from_filename
+#define FFT_EXPORT_WISDOM fftw_export_wisdom_to_filename
+#define FFT_IMPORT_WISDOM_STRING fftw_import_wisdom_from_string
+#define FFT_EXPORT_WISDOM_STRING fftw_export_wisdom_to_string
+#define FFT_FORGET_WISDOM fftw_forget_wisdom
+#define FFT_EXECUTE      fftw_execute
 typedef fftw_plan    fft_plan   ;
 typedef fftw_complex fft_complex;
 
@@ -76,73 +95,224 @@ inline vec3i fft_complex_size(const cube<T>& c)
 }
 
 
+// The plans are created with the wisdom imported from the wisdom file
+// (set by the ZNN_FFTW_WISDOM environment variable or set_wisdom_file).
+// The wisdom of new plans is exported to that file by save_wisdom (e.g.
+// once a network is built) and at destruction, so later processes can
+// reuse the planning (mostly useful with the FFTW_MEASURE and
+// FFTW_PATIENT planning modes). The file is written to a temporary file
+// first and renamed into place, so other processes never read it
+// half-written.
+//
+// Looking up existing plans takes no lock, m_ is only taken to create
+// new plans (the fftw planner is not thread safe).
 class fft_plans_impl
 {
 private:
-    std::mutex                                           m_          ;
-    std::unordered_map<vec3i, fft_plan, vec_hash<vec3i>> fwd_        ;
-    std::unordered_map<vec3i, fft_plan, vec_hash<vec3i>> bwd_        ;
-    real                                                 time_       ;
+    std::mutex               m_          ;
+    plan_registry<fft_plan>  fwd_        ;
+    plan_registry<fft_plan>  bwd_        ;
+    plan_lock_stats          stats_      ;
+    real                     time_       ;
+    std::size_t              n_plans_    ;
+    std::size_t              n_exported_ ; // plans created at the last export
+    std::string              wisdom_file_;
 
     static_assert(std::is_pointer<fft_plan>::value,
                   "fftw_plan must be a pointer");
 
+    // should be called with m_ locked
+    void import_wisdom()
+    {
+        if ( wisdom_file_.empty() ) return;
+
+        if ( FFT_IMPORT_WISDOM(wisdom_file_.c_str()) )
+        {
+            std::cout << "imported fftw wisdom from "
+                      << wisdom_file_ << std::endl;
+        }
+    }
+
+    // should be called with m_ locked
+    void export_wisdom()
+    {
+        if ( wisdom_file_.empty() || n_plans_ == n_exported_ ) return;
+
+        std::string tmp = wisdom_file_ + ".tmp."
+            + std::to_string(static_cast<long>(getpid()));
+
+        if ( !FFT_EXPORT_WISDOM(tmp.c_str()) ||
+             std::rename(tmp.c_str(), wisdom_file_.c_str()) )
+        {
+            std::remove(tmp.c_str());
+            std::cout << "WARNING: can not export fftw wisdom to "
+                      << wisdom_file_ << std::endl;
+        }
+        n_exported_ = n_plans_;
+    }
+
 public:
     ~fft_plans_impl()
     {
-        for ( auto& p: fwd_ ) FFT_DESTROY_PLAN(p.second);
-        for ( auto& p: bwd_ ) FFT_DESTROY_PLAN(p.second);
+        export_wisdom();
+        fwd_.for_each([](fft_plan p) { FFT_DESTROY_PLAN(p); });
+        bwd_.for_each([](fft_plan p) { FFT_DESTROY_PLAN(p); });
         FFT_CLEANUP();
     }
 
-    fft_plans_impl(): m_(), fwd_(), bwd_(), time_(0)
+    fft_plans_impl()
+        : m_(), fwd_(), bwd_(), stats_()
+        , time_(0), n_plans_(0), n_exported_(0), wisdom_file_()
     {
+        if ( const char * f = std::getenv("ZNN_FFTW_WISDOM") )
+        {
+            wisdom_file_ = f;
+            import_wisdom();
+        }
     }
 
-    fft_plan get_forward( const vec3i& s )
+    void set_wisdom_file( std::string const & f )
+    {
+        guard g(m_);
+        wisdom_file_ = f;
+        import_wisdom();
+    }
+
+    std::string wisdom_file()
+    {
+        guard g(m_);
+        return wisdom_file_;
+    }
+
+    // exports the wisdom if plans were created since the last export
+    void save_wisdom()
+    {
+        guard g(m_);
+        export_wisdom();
+    }
+
+    // total time spent creating the plans
+    real planning_time()
     {
         guard g(m_);
+        return time_;
+    }
+
+    std::size_t plan_count()
+    {
+        guard g(m_);
+        return n_plans_;
+    }
+
+    plan_lock_stats const & lock_stats() const
+    {
+        return stats_;
+    }
+
+    fft_plan get_forward( const vec3i& s )
+    {
+        stats_.lookup();
 
-        fft_plan& ret = fwd_[s];
+        if ( fft_plan p = fwd_.find(s) ) return p;
 
-        if ( ret ) return ret;
+        auto g = stats_.lock(m_);
+
+        if ( fft_plan p = fwd_.find(s) ) return p;
 
         zi::wall_timer wt; wt.reset();
 
         auto in  = get_cube<real>(s);
         auto out = get_cube<complex>(fft_complex_size(s));
 
-        ret = FFT_PLAN_R2C
+        fft_plan ret = FFT_PLAN_R2C
             ( s[0], s[1], s[2],
               reinterpret_cast<real*>(in->data()),
               reinterpret_cast<fft_complex*>(out->data()),
               ZNN_FFTW_PLANNING_MODE );
 
+        fwd_.insert(s, ret);
+
         time_ += wt.elapsed<real>();
+        ++n_plans_;
 
         return ret;
     }
 
-    fft_plan get_backward( const vec3i& s )
+    // Times the forward and backward transforms of size s (best of reps
+    // runs, after a warm up run) with plans which are not kept. The
+    // wisdom gathered while planning them is forgotten, so the sizes
+    // which are only timed are neither cached nor exported.
+    double time_transforms( const vec3i& s, int reps )
     {
         guard g(m_);
 
-        fft_plan& ret = bwd_[s];
+        char* wisdom = FFT_EXPORT_WISDOM_STRING();
+
+        auto in  = get_cube<real>(s);
+        auto out = get_cube<complex>(fft_complex_size(s));
+
+        fft_plan fwd = FFT_PLAN_R2C
+            ( s[0], s[1], s[2],
+              reinterpret_cast<real*>(in->data()),
+              reinterpret_cast<fft_complex*>(out->data()),
+              ZNN_FFTW_PLANNING_MODE );
+
+        fft_plan bwd = FFT_PLAN_C2R
+            ( s[0], s[1], s[2],
+              reinterpret_cast<fft_complex*>(out->data()),
+              reinterpret_cast<real*>(in->data()),
+              ZNN_FFTW_PLANNING_MODE );
+
+        // the planning can overwrite the arrays
+        std::fill_n(in->data(), in->num_elements(), static_cast<real>(0));
+
+        double best = std::numeric_limits<double>::max();
+        for ( int i = 0; i <= reps; ++i )
+        {
+            zi::wall_timer wt;
+            FFT_EXECUTE(fwd);
+            FFT_EXECUTE(bwd);
+            if ( i > 0 ) best = std::min(best, wt.elapsed<double>());
+        }
+
+        FFT_DESTROY_PLAN(fwd);
+        FFT_DESTROY_PLAN(bwd);
+
+        FFT_FORGET_WISDOM();
+        if ( wisdom )
+        {
+            FFT_IMPORT_WISDOM_STRING(wisdom);
+            std::free(wisdom);
+        }
+
+        return best;
+    }
+
+    fft_plan get_backward( const vec3i& s )
+    {
+        stats_.lookup();
 
-        if ( ret ) return ret;
+        if ( fft_plan p = bwd_.find(s) ) return p;
+
+        auto g = stats_.lock(m_);
+
+        if ( fft_plan p = bwd_.find(s) ) return p;
 
         zi::wall_timer wt; wt.reset();
 
         auto in  = get_cube<complex>(fft_complex_size(s));
         auto out = get_cube<real>(s);
 
-        ret = FFT_PLAN_C2R
+        fft_plan ret = FFT_PLAN_C2R
             ( s[0], s[1], s[2],
               reinterpret_cast<fft_complex*>(in->data()),
               reinterpret_cast<real*>(out->data()),
               ZNN_FFTW_PLANNING_MODE );
 
+        bwd_.insert(s, ret);
+
         time_ += wt.elapsed<real>();
+        ++n_plans_;
 
 //        std::cout << "Total time spent creating fftw plans: "
 //                  << time_ << std::endl;
@@ -164,3 +334,9 @@ fft_plans_impl& fft_plans =
 #undef FFT_CLEANUP
 #undef FFT_PLAN_R2C
 #undef FFT_PLAN_C2R
+#undef FFT_IMPORT_WISDOM
+#undef FFT_EXPORT_WISDOM
+#undef FFT_IMPORT_WISDOM_STRING
+#undef FFT_EXPORT_WISDOM_STRING
+#undef FFT_FORGET_WISDOM
+#undef FFT_EXECUTE
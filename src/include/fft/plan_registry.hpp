@@ -0,0 +1,120 @@
+//
+// Copyright (C) 2012-2015  Aleksandar Zlateski <zlateski@mit.edu>
+// ---------------------------------------------------------------
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+//
+#pragma once
+
+#include "../types.hpp"
+
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <memory>
+#include <mutex>
+#include <unordered_map>
+
+namespace znn { namespace v4 {
+
+// Read-mostly map of fft plans. The lookups read an immutable snapshot
+// of the map without locking, the (rare) insertions are done with the
+// planning lock held by copying the map and publishing the new snapshot.
+template< typename Plan >
+class plan_registry
+{
+private:
+    typedef std::unordered_map<vec3i, Plan, vec_hash<vec3i>> map_type;
+
+    std::shared_ptr<const map_type> map_;
+
+public:
+    plan_registry()
+        : map_(std::make_shared<map_type>())
+    {}
+
+    // returns nullptr if there is no plan for the size
+    Plan find( const vec3i& s ) const
+    {
+        auto snap = std::atomic_load(&map_);
+        auto it = snap->find(s);
+        return ( it == snap->end() ) ? nullptr : it->second;
+    }
+
+    // should be called with the planning lock held
+    void insert( const vec3i& s, Plan p )
+    {
+        auto snap = std::make_shared<map_type>(*std::atomic_load(&map_));
+        (*snap)[s] = p;
+        std::atomic_store(&map_,
+                          std::shared_ptr<const map_type>(std::move(snap)));
+    }
+
+    template< typename F >
+    void for_each( F const & f ) const
+    {
+        for ( auto& p: *std::atomic_load(&map_) ) f(p.second);
+    }
+};
+
+// Counters of the plan lookups and of the planning lock, to tell how
+// often the workers still have to wait for each other
+class plan_lock_stats
+{
+private:
+    std::atomic<std::uint64_t> lookups_  ;
+    std::atomic<std::uint64_t> locks_    ;
+    std::atomic<std::uint64_t> contended_;
+    std::atomic<std::uint64_t> wait_ns_  ;
+
+public:
+    plan_lock_stats()
+        : lookups_(0), locks_(0), contended_(0), wait_ns_(0)
+    {}
+
+    void lookup()
+    {
+        lookups_.fetch_add(1, std::memory_order_relaxed);
+    }
+
+    std::unique_lock<std::mutex> lock( std::mutex& m )
+    {
+        locks_.fetch_add(1, std::memory_order_relaxed);
+
+        std::unique_lock<std::mutex> l(m, std::try_to_lock);
+        if ( !l.owns_lock() )
+        {
+            auto start = std::chrono::steady_clock::now();
+            l.lock();
+            auto ns = std::chrono::duration_cast<std::chrono::nanoseconds>
+                ( std::chrono::steady_clock::now() - start ).count();
+
+            contended_.fetch_add(1, std::memory_order_relaxed);
+            wait_ns_.fetch_add(ns, std::memory_order_relaxed);
+        }
+        return l;
+    }
+
+    std::uint64_t lookups() const   { return lookups_.load();   }
+    std::uint64_t locks() const     { return locks_.load();     }
+    std::uint64_t contended() const { return contended_.load(); }
+
+    // total time spent waiting for the planning lock (seconds)
+    double wait_time() const
+    {
+        return static_cast<double>(wait_ns_.load()) / 1e9;
+    }
+};
+
+}} // namespace znn::v4
@@ -40,6 +40,9 @@ protected:
     size_t fwd_priority_;
     size_t bwd_priority_;
 
+    // the edge group labeling the traced tasks of the edge
+    size_t trace_group_ = 0;
+
     // minibatch averaging
     real   patch_sz_ = 1;
 
@@ -54,6 +57,9 @@ public:
     size_t fwd_priority() const { return fwd_priority_; }
     size_t bwd_priority() const { return bwd_priority_; }
 
+    size_t trace_group() const { return trace_group_; }
+    void   set_trace_group( size_t g ) { trace_group_ = g; }
+
     void set_patch_size( real s )
     {
         ZI_ASSERT(s > 0);
@@ -190,6 +190,7 @@ inline edges::edges( nodes * in,
                      vec3i const & stride,
                      vec3i const & in_size,
                      task_manager & tm,
+                     phase phs,
                      max_pooling_tag )
     : options_(opts)
     , size_(in_size)
@@ -207,7 +208,7 @@ inline edges::edges( nodes * in,
     {
         edges_[i]
             = std::make_unique<max_pooling_edge>
-            (in, i, out, i, tm_, sz, stride);
+            (in, i, out, i, tm_, sz, stride, phs);
     }
 }
 
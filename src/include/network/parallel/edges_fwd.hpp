@@ -55,7 +55,7 @@ public:
     edges( nodes *, nodes *, options const &, task_manager &, dummy_tag );
 
     edges( nodes *, nodes *, options const &, vec3i const &, vec3i const &,
-           task_manager &, max_pooling_tag );
+           task_manager &, phase phs, max_pooling_tag );
 
     edges( nodes *, nodes *, options const &, vec3i const &,
            task_manager &, real_pooling_tag );
@@ -111,6 +111,15 @@ public:
         }
     }
 
+    // labels the traced tasks of the edges
+    void set_trace_group( size_t g )
+    {
+        for ( auto & e: edges_ )
+        {
+            if ( e ) e->set_trace_group(g);
+        }
+    }
+
     void set_patch_size( real s )
     {
         if ( filters_.size() )
@@ -43,6 +43,8 @@ private:
 
     task_manager::task_handle pending_ = 0;
 
+    fftw::transformer fftw_;
+
 private:
     void do_forward( ccube_p<complex> const & f )
     {
@@ -57,10 +59,17 @@ private:
 
     void do_update( ccube_p<complex> const & g )
     {
+        task_tracer::set_group(trace_group_);
+
         auto dEdW_fft = *last_input * *g;
-        auto dEdW = fftw::backward(std::move(dEdW_fft), in_nodes->fsize());
+        auto dEdW = fftw_.backward(std::move(dEdW_fft));
         real norm = dEdW->num_elements();
 
+        if ( fftw_.size() != fftw_.actual_size() )
+        {
+            dEdW = crop_left(*dEdW, fftw_.size());
+        }
+
         flip(*dEdW);
         // TODO(zlateski): WTH was happening with sparse_implode before
         //                 when I had to use sparse_implode_slow
@@ -91,8 +100,8 @@ private:
         //                 ony happened on my laptop
 
         auto w_tmp = sparse_explode_slow(filter_.W(), filter_stride,
-                                         in_nodes->fsize());
-        return fftw::forward(std::move(w_tmp));
+                                         fftw_.actual_size());
+        return fftw_.forward(std::move(w_tmp));
     }
 
 
@@ -108,7 +117,8 @@ public:
         : edge(in,inn,out,outn,tm),
           filter_stride(stride),
           repeat_(repeat),
-          filter_(f)
+          filter_(f),
+          fftw_(in_nodes->fsize())
     {
         bwd_bucket_ = in->attach_out_fft_edge(inn, this);
         fwd_bucket_ = out->attach_in_fft_edge(outn, this, in->fsize());
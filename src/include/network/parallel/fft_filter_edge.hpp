@@ -58,6 +58,8 @@ private:
 
     void do_update( ccube_p<complex> const & g )
     {
+        task_tracer::set_group(trace_group_);
+
         auto dEdW_fft = *last_input * *g;
         auto dEdW = fftw_.backward(std::move(dEdW_fft));
         real norm = dEdW->num_elements();
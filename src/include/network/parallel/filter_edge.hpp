@@ -46,6 +46,8 @@ private:
 
     void do_update( ccube_p<real> const & g )
     {
+        task_tracer::set_group(trace_group_);
+
         auto dEdW = convolve_sparse_flipped(*last_input, *g, filter_stride);
         filter_.update(*dEdW, patch_sz_);
     }
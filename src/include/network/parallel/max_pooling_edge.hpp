@@ -33,6 +33,11 @@ private:
     cube_p<int> indices;
     vec3i       insize ;
 
+    phase       phase_ ; // TRAIN or TEST
+
+    // the input is filtered in this buffer in the TEST phase
+    cube_p<real> buffer_;
+
 public:
     max_pooling_edge( nodes * in,
                       size_t inn,
@@ -40,10 +45,12 @@ public:
                       size_t outn,
                       task_manager & tm,
                       vec3i const & size,
-                      vec3i const & stride )
+                      vec3i const & stride,
+                      phase phs = phase::TRAIN )
         : edge(in,inn,out,outn,tm)
         , filter_size(size)
         , filter_stride(stride)
+        , phase_(phs)
     {
         insize = in->fsize();
 
@@ -54,6 +61,23 @@ public:
     void forward( ccube_p<real> const & f ) override
     {
         ZI_ASSERT(size(*f)==insize);
+
+        if ( phase_ == phase::TEST )
+        {
+            // no backward pass, so no indices are needed
+            if ( !buffer_ ) buffer_ = get_cube<real>(insize);
+            *buffer_ = *f;
+
+            inplace_pooling_filter_no_indices(*buffer_,
+                                              [](real a, real b){ return a>b; },
+                                              filter_size,
+                                              filter_stride);
+
+            vec3i out_size = insize - (filter_size-vec3i::one) * filter_stride;
+            out_nodes->forward(out_num,crop(*buffer_,out_size));
+            return;
+        }
+
         auto r = pooling_filter(get_copy(*f),
                                 [](real a, real b){ return a>b; },
                                 filter_size,
@@ -62,6 +86,19 @@ public:
         out_nodes->forward(out_num,std::move(r.first));
     }
 
+    void set_phase( phase phs ) override
+    {
+        phase_ = phs;
+        if ( phase_ == phase::TEST )
+        {
+            indices.reset();
+        }
+        else
+        {
+            buffer_.reset();
+        }
+    }
+
     void backward( ccube_p<real> const & g )
     {
         ZI_ASSERT(indices);
@@ -24,7 +24,15 @@
 #include "../../initializator/initializators.hpp"
 #include "../helpers.hpp"
 
+#include <array>
+#include <chrono>
+#include <cmath>
+#include <fstream>
+#include <iomanip>
+#include <limits>
 #include <map>
+#include <set>
+#include <thread>
 #include <zi/time.hpp>
 
 namespace znn { namespace v4 { namespace parallel_network {
@@ -118,6 +126,16 @@ private:
 
     phase phase_;
 
+    // names of the edge groups computing for the nodes of the given
+    // priority (see create_nodes), used to label the traced tasks
+    std::map<size_t, std::string> fwd_labels_;
+    std::map<size_t, std::string> bwd_labels_;
+
+    // names of the edge groups by their trace group (see create_edges)
+    std::vector<std::string> group_names_;
+
+    enum trace_tag : size_t { TRACE_FORWARD = 1, TRACE_BACKWARD = 2 };
+
 #ifdef ZNN_ANALYSE_TASK_MANAGER
     void dump() { tm_.dump(); }
 #endif
@@ -302,7 +320,8 @@ private:
             {
                 e.second->dedges = std::make_unique<edges>
                     ( in, out, *opts, e.second->in_stride,
-                      e.second->in_fsize, tm_, edges::max_pooling_tag() );
+                      e.second->in_fsize, tm_, phase_,
+                      edges::max_pooling_tag() );
             }
             else if ( type == "max_pool" )
             {
@@ -353,9 +372,28 @@ private:
 
             e.second->opts = nullptr;
         }
+
+        // the traced tasks of the edges are labeled by their group
+        for ( auto & e: edges_ )
+        {
+            group_names_.push_back(e.first);
+            e.second->dedges->set_trace_group(group_names_.size());
+        }
     }
 
 
+    static std::string edge_group_names( std::vector<nedges*> const & es,
+                                         std::string const & dflt )
+    {
+        std::string ret;
+        for ( auto & e: es )
+        {
+            if ( ret.size() ) ret += "+";
+            ret += e->opts->require_as<std::string>("name");
+        }
+        return ret.size() ? ret : dflt;
+    }
+
     void create_nodes()
     {
         std::map<size_t,size_t> fwd_pts;
@@ -374,6 +412,10 @@ private:
                 + bwd_pts[n.second->bwd_priority];
             ++bwd_pts[n.second->bwd_priority];
 
+            // the edges scheduled with the priorities of the nodes
+            fwd_labels_[fwd_p] = edge_group_names(n.second->in, n.first);
+            bwd_labels_[bwd_p] = edge_group_names(n.second->out, n.first);
+
 
             ZI_ASSERT(sz>0);
 
@@ -430,6 +472,8 @@ private:
         {
             es->width  = op.require_as<ovec3i>("size");
             es->stride = op.require_as<ovec3i>("stride");
+            // no pooling indices in the TEST phase
+            phase_dependent_edges_[name] = es;
         }
         else if ( type == "conv" )
         {
@@ -545,6 +589,8 @@ public:
     forward( std::map<std::string, std::vector<cube_p<real>>> && fin )
     {
         ZI_ASSERT(fin.size()==input_nodes_.size());
+        tm_.set_trace_tag(TRACE_FORWARD);
+
         for ( auto & in: fin )
         {
             ZI_ASSERT(input_nodes_.count(in.first));
@@ -573,6 +619,8 @@ public:
     backward( std::map<std::string, std::vector<cube_p<real>>> && fout )
     {
         ZI_ASSERT(fout.size()==input_nodes_.size());
+        tm_.set_trace_tag(TRACE_BACKWARD);
+
         for ( auto & out: fout )
         {
             ZI_ASSERT(output_nodes_.count(out.first));
@@ -620,236 +668,366 @@ public:
             e.second->dedges->zap();
     }
 
-    static void optimize( std::vector<options> & ns,
-                          std::vector<options> & es,
-                          vec3i const & outsz,
-                          size_t n_threads = 1,
-                          size_t rounds = 10)
+    // starts recording the tasks executed by the workers
+    void start_trace()
     {
-        std::vector<options*> edge_groups;
-        for ( auto & e: es )
+        tm_.start_trace();
+    }
+
+    // stops recording and writes the recorded tasks to a Chrome trace
+    // (JSON) file, which can be opened by chrome://tracing or Perfetto.
+    // The tasks are named by their edge groups, the forward and backward
+    // tasks carry the index of the node they compute for.
+    void stop_trace( std::string const & fname )
+    {
+        auto events = tm_.stop_trace();
+
+        std::ofstream f(fname);
+        if ( !f )
         {
-            if ( e.require_as<std::string>("type") == "conv" )
-            {
-                edge_groups.push_back(&e);
-                e.push("fft",1);
-            }
+            throw std::logic_error(HERE() + "can not write the trace " + fname);
         }
 
-        std::cout << "Total of " << edge_groups.size()
-                  << " to optimize\n\n";
-
-        // generate 10 inputs and outputs
-        network net(ns,es,outsz,n_threads);
+        std::set<size_t> workers;
 
-        std::vector<std::map<std::string, std::vector<cube_p<real>>>>
-            allins, allouts;
+        f << "{\"traceEvents\":[";
+        bool first = true;
+        for ( auto const & e: events )
+        {
+            std::string name = "task";
+            std::string cat  = "task";
 
+            if ( e.unprivileged )
+            {
+                name = cat = "update";
+            }
+            else if ( e.priority == std::numeric_limits<size_t>::max() )
+            {
+                name = cat = "fft dispatch";
+            }
+            else if ( e.tag == TRACE_FORWARD || e.tag == TRACE_BACKWARD )
+            {
+                auto & labels = ( e.tag == TRACE_FORWARD ) ? fwd_labels_
+                                                           : bwd_labels_;
+                cat = ( e.tag == TRACE_FORWARD ) ? "forward" : "backward";
+                if ( labels.count(e.priority / 1024) )
+                {
+                    name = labels[e.priority / 1024];
+                }
+            }
 
-        std::cout << "Create samples...";
+            if ( e.group && e.group <= group_names_.size() )
+            {
+                name = group_names_[e.group - 1];
+                if ( e.priority == std::numeric_limits<size_t>::max() )
+                {
+                    name += " fft";
+                }
+            }
 
-        std::tie(allins, allouts) = generate_inout(rounds,net);
+            workers.insert(e.worker);
 
-        std::cout << "DONE\nFFT Warmup..." << std::flush;
+            f << ( first ? "\n" : ",\n" )
+              << "{\"name\":\"" << name << "\",\"cat\":\"" << cat
+              << "\",\"ph\":\"X\",\"pid\":0,\"tid\":" << e.worker
+              << ",\"ts\":" << e.start << ",\"dur\":" << ( e.end - e.start )
+              << ",\"args\":{\"priority\":" << e.priority
+              << ",\"node\":" << ( e.priority % 1024 ) << "}}";
+            first = false;
+        }
 
+        for ( auto w: workers )
         {
-            auto is = copy_samples(allins);
-            auto os = copy_samples(allouts);
-            net.forward(std::move(is[0]));
-            net.backward(std::move(os[0]));
-            net.zap();
+            f << ( first ? "\n" : ",\n" )
+              << "{\"name\":\"thread_name\",\"ph\":\"M\",\"pid\":0,"
+              << "\"tid\":" << w << ",\"args\":{\"name\":\"worker "
+              << w << "\"}}";
+            first = false;
         }
 
-        std::cout << "DONE\nTrying all FFTs..." << std::flush;
-
-        real tot_time = 0;
-
-        {
-            network net(ns,es,outsz,n_threads);
+        f << "\n],\"displayTimeUnit\":\"ms\"}\n";
+    }
 
-            auto is = copy_samples(allins);
-            auto os = copy_samples(allouts);
+private:
+    // times of the passes, means and standard errors of the rounds
+    struct tuning_time
+    {
+        std::pair<double,double> fwd;
+        std::pair<double,double> bwd;
+        std::pair<double,double> upd;
+        std::pair<double,double> tot;
+    };
 
-            zi::wall_timer wt;
-            net.forward(std::move(is[0]));
+    struct tuning_trial
+    {
+        tuning_time                        net   ; // wall time of the passes
+        std::map<std::string, tuning_time> groups; // time of the group tasks
+    };
 
-            wt.reset();
+    // waits for the tasks still running after the passes (the updates)
+    void wait_idle()
+    {
+        while ( !tm_.idle() )
+        {
+            std::this_thread::sleep_for(std::chrono::microseconds(50));
+        }
+    }
 
-            for ( size_t i = 0; i < rounds-1; ++i )
-            {
-                net.backward(std::move(os[i]));
-                net.forward(std::move(is[i+1]));
-            }
+    // the durations (secs) of the traced tasks of each edge group, as
+    // forward, backward and update
+    std::map<std::string, std::array<double,3>>
+    group_times( std::vector<task_trace_event> const & events ) const
+    {
+        std::map<std::string, std::array<double,3>> ret;
+        for ( auto const & e: events )
+        {
+            if ( e.group == 0 || e.group > group_names_.size() ) continue;
 
-            tot_time = wt.elapsed<real>();
+            size_t k = e.unprivileged ? 2 : ( e.tag == TRACE_BACKWARD ? 1 : 0 );
+            ret[group_names_[e.group - 1]][k] += ( e.end - e.start ) / 1e6;
+        }
+        return ret;
+    }
 
-            //net.backward(std::move(os[rounds-1]));
-            net.zap();
+    // times the passes of the network with the current choices of the
+    // edges, and the tasks of each edge group (traced)
+    static tuning_trial time_trial( std::vector<options> & ns,
+                                    std::vector<options> & es,
+                                    vec3i const & outsz,
+                                    size_t n_threads,
+                                    size_t rounds,
+                                    bool is_train,
+                                    inout_t const & allins,
+                                    inout_t const & allouts )
+    {
+        network net(ns,es,outsz,n_threads);
 
-#ifdef ZNN_ANALYSE_TASK_MANAGER
-            std::cout << "HERE";
-            net.dump();
-#endif
+        auto is = copy_samples(allins);
+        auto os = copy_samples(allouts);
 
+        std::vector<double> fwd(rounds), bwd(rounds), upd(rounds), tot(rounds);
+        std::map<std::string, std::array<std::vector<double>,4>> groups;
 
-            std::cout << (tot_time/(rounds-1)) << " secs" << std::endl;
-        }
+        // warmup round (plans and memory pools)
+        net.forward(std::move(is[0]));
+        if ( is_train ) net.backward(std::move(os[0]));
+        net.wait_idle();
 
-        //std::vector<options*> edge_groups;
-        for ( auto & e: edge_groups )
+        zi::wall_timer wt;
+        for ( size_t i = 0; i < rounds; ++i )
         {
-            std::cout << "Trying edge group: "
-                      << e->require_as<std::string>("name")
-                      << " ..." << std::flush;
-            e->push("fft","0");
-
-            network net(ns,es,outsz,n_threads);
-
-            auto is = copy_samples(allins);
-            auto os = copy_samples(allouts);
-
-            zi::wall_timer wt;
-            net.forward(std::move(is[0]));
+            net.tm_.start_trace();
 
             wt.reset();
-
-            for ( size_t i = 0; i < rounds-1; ++i )
+            net.forward(std::move(is[i+1]));
+            fwd[i] = wt.lap<double>();
+            bwd[i] = 0;
+            if ( is_train )
             {
-                net.backward(std::move(os[i]));
-                net.forward(std::move(is[i+1]));
+                net.backward(std::move(os[i+1]));
+                bwd[i] = wt.lap<double>();
             }
 
-            //net.backward(std::move(os[rounds-1]));
-
-            real my_time = wt.elapsed<real>();
+            // the updates finishing after the backward pass
+            net.wait_idle();
+            upd[i] = wt.lap<double>();
+            tot[i] = fwd[i] + bwd[i] + upd[i];
 
-            std::cout <<  (my_time/(rounds-1)) << " secs" << std::endl;
-
-            if ( my_time < tot_time )
+            for ( auto & g: net.group_times(net.tm_.stop_trace()) )
             {
-                tot_time = my_time;
-                std::cout << "   will use direct convolution" << std::endl;
-            }
-            else
-            {
-                std::cout << "   will use FFT convolution" << std::endl;
-                e->push("fft","1");
+                auto & v = groups[g.first];
+                for ( auto & x: v ) x.resize(rounds);
+                for ( size_t k = 0; k < 3; ++k ) v[k][i] = g.second[k];
+                v[3][i] = g.second[0] + g.second[1] + g.second[2];
             }
         }
+        net.zap();
+
+        tuning_trial ret;
+        ret.net = { measured(fwd, false), measured(bwd, false),
+                    measured(upd, false), measured(tot, false) };
+        for ( auto & g: groups )
+        {
+            ret.groups[g.first] = { measured(g.second[0], false),
+                                    measured(g.second[1], false),
+                                    measured(g.second[2], false),
+                                    measured(g.second[3], false) };
+        }
+        return ret;
     }
 
-    static void optimize_forward( std::vector<options> & ns,
-                                  std::vector<options> & es,
-                                  vec3i const & outsz,
-                                  size_t n_threads = 1,
-                                  size_t rounds = 10 )
+    // whether a is faster than b, beyond two standard errors
+    // of the difference
+    static bool significantly_faster( std::pair<double,double> const & a,
+                                      std::pair<double,double> const & b )
     {
+        double se = std::sqrt( a.second * a.second + b.second * b.second );
+        return b.first - a.first > 2 * se;
+    }
+
+    static void print_time( std::pair<double,double> const & t,
+                            double scale = 1 )
+    {
+        std::ios::fmtflags flags(std::cout.flags());
+        std::cout << std::fixed << std::setprecision(4) << t.first * scale
+                  << " +/- " << t.second * scale;
+        std::cout.flags(flags);
+    }
+
+    // Chooses FFT or direct convolution for each conv edge group.
+    //
+    // The network is run with all the groups using FFT and with all of
+    // them direct, tracing the forward, backward and update tasks of
+    // each group. As the costs of the groups add up, the joint choice
+    // minimizing the total cost takes, for each group, the convolution
+    // with the lower cost of its tasks; direct is only taken if it is
+    // cheaper beyond the noise of the measurements. The chosen mix is
+    // then timed, and replaced by all FFT or all direct if either of
+    // them is significantly faster as a whole (e.g. as the groups share
+    // the transforms of their inputs).
+    static void tune( std::vector<options> & ns,
+                      std::vector<options> & es,
+                      vec3i const & outsz,
+                      size_t n_threads,
+                      size_t rounds,
+                      bool is_train )
+    {
+        rounds = std::max(rounds, static_cast<size_t>(3));
+
         std::vector<options*> edge_groups;
         for ( auto & e: es )
         {
             if ( e.require_as<std::string>("type") == "conv" )
             {
                 edge_groups.push_back(&e);
-                e.push("fft",1);
             }
         }
 
         std::cout << "Total of " << edge_groups.size()
                   << " to optimize\n\n";
 
-        // generate 10 inputs and outputs
-        network net(ns,es,outsz,n_threads);
-        auto ins  = net.inputs();
-        auto outs = net.outputs();
-
-        std::vector<std::map<std::string, std::vector<cube_p<real>>>>
-            allins, allouts;
-
-        std::cout << "Create samples...";
-
-        std::tie(allins, allouts) = generate_inout(rounds,net);
-
-        std::cout << "DONE\nFFT Warmup..." << std::flush;
-
-        {
-            auto is = copy_samples(allins);
-            auto os = copy_samples(allouts);
-            net.forward(std::move(is[0]));
-            //net.backward(std::move(os[0]));
-            net.zap();
-        }
-
-        std::cout << "DONE\nTrying all FFTs..." << std::flush;
-
-        real tot_time = 0;
+        inout_t allins, allouts;
 
         {
             network net(ns,es,outsz,n_threads);
 
-            auto is = copy_samples(allins);
-            auto os = copy_samples(allouts);
-
-            zi::wall_timer wt;
-            net.forward(std::move(is[0]));
-
-            wt.reset();
+            std::cout << "Create samples...";
+            std::tie(allins, allouts) = generate_inout(rounds+1,net);
+            std::cout << "DONE\n";
+        }
 
-            for ( size_t i = 0; i < rounds-1; ++i )
+        auto use = [&]( std::vector<int> const & fft )
             {
-                //net.backward(std::move(os[i]));
-                net.forward(std::move(is[i+1]));
-            }
-
-            //net.backward(std::move(os[rounds-1]));
+                for ( size_t g = 0; g < edge_groups.size(); ++g )
+                {
+                    edge_groups[g]->push("fft", fft[g]);
+                }
+            };
 
-            tot_time = wt.elapsed<real>();
+        auto trial = [&]( std::string const & what )
+            {
+                std::cout << "Trying " << what << "..." << std::flush;
+                tuning_trial t = time_trial(ns, es, outsz, n_threads, rounds,
+                                            is_train, allins, allouts);
+                std::cout << t.net.tot.first << " secs" << std::endl;
+                return t;
+            };
+
+        std::vector<int> all_fft(edge_groups.size(), 1);
+        std::vector<int> all_direct(edge_groups.size(), 0);
+
+        // the times of the tasks of each group with direct and fft
+        std::array<tuning_trial,2> times;
+
+        use(all_fft);
+        times[1] = trial("all FFTs");
+        use(all_direct);
+        times[0] = trial("all direct");
+
+        std::vector<int> choice(edge_groups.size(), 1);
+        for ( size_t g = 0; g < edge_groups.size(); ++g )
+        {
+            auto name = edge_groups[g]->require_as<std::string>("name");
+            tuning_time const & t_fft = times[1].groups[name];
+            tuning_time const & t_dir = times[0].groups[name];
 
-            net.zap();
+            auto const & c_fft = is_train ? t_fft.tot : t_fft.fwd;
+            auto const & c_dir = is_train ? t_dir.tot : t_dir.fwd;
 
-            std::cout << (tot_time/(rounds-1)) << " secs" << std::endl;
+            choice[g] = significantly_faster(c_dir, c_fft) ? 0 : 1;
         }
 
-        //std::vector<options*> edge_groups;
-        for ( auto & e: edge_groups )
+        tuning_time best;
+        if ( choice == all_fft )
         {
-            std::cout << "Trying edge group: "
-                      << e->require_as<std::string>("name")
-                      << " ..." << std::flush;
-            e->push("fft","0");
-
-            network net(ns,es,outsz,n_threads);
-
-            auto is = copy_samples(allins);
-            auto os = copy_samples(allouts);
-
-            zi::wall_timer wt;
-            net.forward(std::move(is[0]));
-
-            wt.reset();
+            best = times[1].net;
+        }
+        else if ( choice == all_direct )
+        {
+            best = times[0].net;
+        }
+        else
+        {
+            use(choice);
+            best = trial("the chosen mix").net;
 
-            for ( size_t i = 0; i < rounds-1; ++i )
+            for ( int c = 1; c >= 0; --c )
             {
-                //net.backward(std::move(os[i]));
-                net.forward(std::move(is[i+1]));
+                if ( significantly_faster(times[c].net.tot, best.tot) )
+                {
+                    choice = c ? all_fft : all_direct;
+                    best   = times[c].net;
+                }
             }
+        }
+        use(choice);
 
-            //net.backward(std::move(os[rounds-1]));
-
-            real my_time = wt.elapsed<real>();
-
-            std::cout << (my_time/(rounds-1)) << " secs" << std::endl;
-
-            if ( my_time < tot_time )
-            {
-                tot_time = my_time;
-                std::cout << "   will use direct convolution" << std::endl;
-            }
-            else
+        std::cout << "\nConvolution choices (task time of the edge group "
+                  << "per round, msecs)\n";
+        for ( size_t g = 0; g < edge_groups.size(); ++g )
+        {
+            auto name = edge_groups[g]->require_as<std::string>("name");
+            for ( int c = 1; c >= 0; --c )
             {
-                std::cout << "   will use FFT convolution" << std::endl;
-                e->push("fft","1");
+                tuning_time const & t = times[c].groups[name];
+                std::cout << "  " << name
+                          << ( c == 1 ? " FFT    fwd " : " direct fwd " );
+                print_time(t.fwd, 1000);
+                if ( is_train )
+                {
+                    std::cout << "  bwd ";
+                    print_time(t.bwd, 1000);
+                    std::cout << "  upd ";
+                    print_time(t.upd, 1000);
+                }
+                std::cout << "\n";
             }
+            std::cout << "  => will use "
+                      << ( choice[g] ? "FFT" : "direct" )
+                      << " convolution\n";
         }
+        std::cout << "Total: ";
+        print_time(best.tot);
+        std::cout << " secs" << std::endl;
+    }
+
+public:
+    static void optimize( std::vector<options> & ns,
+                          std::vector<options> & es,
+                          vec3i const & outsz,
+                          size_t n_threads = 1,
+                          size_t rounds = 10)
+    {
+        tune(ns, es, outsz, n_threads, rounds, true);
+    }
+
+    static void optimize_forward( std::vector<options> & ns,
+                                  std::vector<options> & es,
+                                  vec3i const & outsz,
+                                  size_t n_threads = 1,
+                                  size_t rounds = 10 )
+    {
+        tune(ns, es, outsz, n_threads, rounds, false);
     }
 
     static void force_fft( std::vector<options> & es )
@@ -0,0 +1,222 @@
+//
+// Copyright (C) 2012-2015  Aleksandar Zlateski <zlateski@mit.edu>
+// ---------------------------------------------------------------
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+//
+#pragma once
+
+#include "../options/options.hpp"
+#include "../types.hpp"
+
+#include <cstdint>
+#include <fstream>
+#include <iomanip>
+#include <iostream>
+#include <mutex>
+#include <set>
+#include <sstream>
+#include <string>
+#include <vector>
+
+namespace znn { namespace v4 {
+
+// Persistent cache of the FFT/direct convolution choices made by
+// network::optimize and network::optimize_forward.
+//
+// Each line of the cache file holds a key followed by the choices of
+// the conv edge groups:
+//
+//     <key> <edge group>=<fft> <edge group>=<fft> ...
+//
+// The key is a hash of the network structure (the node and edge options
+// without the learned parameters), the output size, the number of
+// threads, the CPU model and the tuning mode. Later lines override
+// earlier ones with the same key.
+class tuning_cache
+{
+private:
+    std::string fname_;
+
+    static std::mutex & file_mutex()
+    {
+        static std::mutex m;
+        return m;
+    }
+
+    // options which do not change the structure of the network
+    static bool is_structural( std::string const & k )
+    {
+        static const std::set<std::string> skip
+            = { "filters", "biases", "fft",
+                "eta", "momentum", "weight_decay" };
+        return skip.count(k) == 0;
+    }
+
+    // 64 bit FNV-1a, stable across runs and compilers
+    static void hash_string( std::uint64_t & h, std::string const & s )
+    {
+        for ( unsigned char c: s )
+        {
+            h ^= c;
+            h *= 1099511628211ULL;
+        }
+        h ^= 0xff;
+        h *= 1099511628211ULL;
+    }
+
+    static void hash_options( std::uint64_t & h,
+                              std::vector<options> const & opts )
+    {
+        for ( auto & o: opts )
+        {
+            for ( auto & p: o )
+            {
+                if ( is_structural(p.first) )
+                {
+                    hash_string(h, p.first);
+                    hash_string(h, p.second);
+                }
+            }
+            hash_string(h, "");
+        }
+    }
+
+public:
+    explicit tuning_cache( std::string const & fname )
+        : fname_(fname)
+    {}
+
+    static std::string cpu_model()
+    {
+        std::ifstream f("/proc/cpuinfo");
+        std::string line;
+        while ( std::getline(f, line) )
+        {
+            if ( line.compare(0, 10, "model name") == 0 )
+            {
+                auto p = line.find(':');
+                if ( p != std::string::npos )
+                {
+                    return line.substr(line.find_first_not_of(" \t", p+1));
+                }
+            }
+        }
+        return "unknown";
+    }
+
+    static std::string key( std::vector<options> const & ns,
+                            std::vector<options> const & es,
+                            vec3i const & outsz,
+                            size_t n_threads,
+                            std::string const & mode )
+    {
+        std::uint64_t h = 14695981039346656037ULL;
+        hash_options(h, ns);
+        hash_options(h, es);
+
+        std::ostringstream oss;
+        oss << outsz[0] << ',' << outsz[1] << ',' << outsz[2] << ';'
+            << n_threads << ';' << cpu_model() << ';' << mode;
+        hash_string(h, oss.str());
+
+        std::ostringstream ret;
+        ret << std::hex << std::setw(16) << std::setfill('0') << h;
+        return ret.str();
+    }
+
+    // sets the fft option of the conv edges, returns false
+    // (leaving the edges untouched) if the key is not cached
+    bool load( std::string const & k, std::vector<options> & es ) const
+    {
+        if ( fname_.empty() ) return false;
+
+        std::map<std::string, std::string> choices;
+        bool found = false;
+        {
+            guard g(file_mutex());
+            std::ifstream f(fname_);
+            std::string line;
+            while ( std::getline(f, line) )
+            {
+                std::istringstream iss(line);
+                std::string lk;
+                if ( !(iss >> lk) || lk != k ) continue;
+
+                found = true;
+                choices.clear();
+                std::string c;
+                while ( iss >> c )
+                {
+                    auto p = c.rfind('=');
+                    if ( p != std::string::npos )
+                    {
+                        choices[c.substr(0,p)] = c.substr(p+1);
+                    }
+                }
+            }
+        }
+
+        if ( !found ) return false;
+
+        for ( auto & e: es )
+        {
+            if ( e.require_as<std::string>("type") == "conv" &&
+                 choices.count(e.require_as<std::string>("name")) == 0 )
+            {
+                return false;
+            }
+        }
+
+        for ( auto & e: es )
+        {
+            if ( e.require_as<std::string>("type") == "conv" )
+            {
+                std::string const & name = e.require_as<std::string>("name");
+                e.push("fft", choices[name]);
+                std::cout << "Edge group " << name << " will use "
+                          << ( choices[name] == "1" ? "FFT" : "direct" )
+                          << " convolution (cached)" << std::endl;
+            }
+        }
+        return true;
+    }
+
+    void store( std::string const & k, std::vector<options> const & es ) const
+    {
+        if ( fname_.empty() ) return;
+
+        guard g(file_mutex());
+        std::ofstream f(fname_, std::ios::app);
+        if ( !f )
+        {
+            std::cout << "WARNING: can not write the tuning cache "
+                      << fname_ << std::endl;
+            return;
+        }
+
+        f << k;
+        for ( auto & e: es )
+        {
+            if ( e.require_as<std::string>("type") == "conv" )
+            {
+                f << ' ' << e.require_as<std::string>("name")
+                  << '=' << ( e.count("fft") ? e.at("fft") : "1" );
+            }
+        }
+        f << '\n';
+    }
+};
+
+}} // namespace znn::v4
@@ -24,6 +24,7 @@
 
 #include <utility>
 #include <set>
+#include <vector>
 
 namespace znn { namespace v4 {
 
@@ -89,35 +90,30 @@ inline void pooling_filter_pass_4( real *  head1,
 }
 
 
+// size-1 passes of size 2, O(size) per element
 template<typename F>
-inline void pooling_filter_pass( real *  head1,
-                                 real *  end,
-                                 int *     head2,
-                                 size_t    size,
-                                 size_t    stride,
-                                 F const & cmp ) noexcept
+inline void pooling_filter_pass_repeated( real *  head1,
+                                          real *  end,
+                                          int *     head2,
+                                          size_t    size,
+                                          size_t    stride,
+                                          F const & cmp ) noexcept
 {
-    ZI_ASSERT(size > 1);
-
-    if ( size == 2 )
+    for ( size_t i = 0; i < size - 1; ++i, end -= stride )
     {
         pooling_filter_pass_2(head1, end, head2, stride, cmp);
-        return;
     }
+}
 
-    if ( size == 3 )
-    {
-        pooling_filter_pass_3(head1, end, head2, stride, cmp);
-        return;
-    }
-
-    if ( size == 4 )
-    {
-        pooling_filter_pass_4(head1, end, head2, stride, cmp);
-        return;
-    }
-
-
+// sliding window kept in a sorted set, O(log size) per element
+template<typename F>
+inline void pooling_filter_pass_sorted( real *  head1,
+                                        real *  end,
+                                        int *     head2,
+                                        size_t    size,
+                                        size_t    stride,
+                                        F const & cmp ) noexcept
+{
     typedef std::pair<real,int> pair_type;
 
     auto cmpf =
@@ -160,6 +156,109 @@ inline void pooling_filter_pass( real *  head1,
     }
 }
 
+// van Herk/Gil-Werman filter, O(1) per element regardless of the size.
+// The sequence is split into blocks of the filter size. The window
+// starting at i spans the suffix of its block (h) and the prefix of the
+// next block (g), so the result is the better of h[i] and g[i+size-1].
+// Ties keep the earliest element, as the passes of size 2 do.
+template<typename F>
+inline void pooling_filter_pass_vhgw( real *  head1,
+                                      real *  end,
+                                      int *     head2,
+                                      size_t    size,
+                                      size_t    stride,
+                                      F const & cmp ) noexcept
+{
+    ZI_ASSERT(end>=head1);
+
+    size_t n = static_cast<size_t>(end - head1) / stride + 1;
+    if ( n < size ) return;
+
+    static thread_local std::vector<real> gv, hv;
+    static thread_local std::vector<int>  gi, hi;
+
+    gv.resize(n); hv.resize(n);
+    gi.resize(n); hi.resize(n);
+
+    // prefix of each block
+    for ( size_t i = 0; i < n; ++i )
+    {
+        real v = head1[i*stride];
+        if ( i % size == 0 || cmp(v, gv[i-1]) )
+        {
+            gv[i] = v;
+            gi[i] = head2[i*stride];
+        }
+        else
+        {
+            gv[i] = gv[i-1];
+            gi[i] = gi[i-1];
+        }
+    }
+
+    // suffix of each block
+    for ( size_t i = n; i-- > 0; )
+    {
+        real v = head1[i*stride];
+        if ( i % size == size - 1 || i == n - 1 || !cmp(hv[i+1], v) )
+        {
+            hv[i] = v;
+            hi[i] = head2[i*stride];
+        }
+        else
+        {
+            hv[i] = hv[i+1];
+            hi[i] = hi[i+1];
+        }
+    }
+
+    for ( size_t i = 0; i + size <= n; ++i )
+    {
+        size_t j = i + size - 1;
+        if ( cmp(gv[j], hv[i]) )
+        {
+            head1[i*stride] = gv[j];
+            head2[i*stride] = gi[j];
+        }
+        else
+        {
+            head1[i*stride] = hv[i];
+            head2[i*stride] = hi[i];
+        }
+    }
+}
+
+template<typename F>
+inline void pooling_filter_pass( real *  head1,
+                                 real *  end,
+                                 int *     head2,
+                                 size_t    size,
+                                 size_t    stride,
+                                 F const & cmp ) noexcept
+{
+    ZI_ASSERT(size > 1);
+
+    if ( size == 2 )
+    {
+        pooling_filter_pass_2(head1, end, head2, stride, cmp);
+        return;
+    }
+
+    if ( size == 3 )
+    {
+        pooling_filter_pass_3(head1, end, head2, stride, cmp);
+        return;
+    }
+
+    if ( size == 4 )
+    {
+        pooling_filter_pass_4(head1, end, head2, stride, cmp);
+        return;
+    }
+
+    pooling_filter_pass_vhgw(head1, end, head2, size, stride, cmp);
+}
+
 template<typename F>
 inline void pooling_filter_pass_2_no_indices( real *  head1,
                                               real *  end,
@@ -202,6 +301,44 @@ inline void pooling_filter_pass_4_no_indices( real *  head1,
 }
 
 
+// van Herk/Gil-Werman filter without indices
+// (see pooling_filter_pass_vhgw)
+template<typename F>
+inline void pooling_filter_pass_vhgw_no_indices( real *  head1,
+                                                 real *  end,
+                                                 size_t    size,
+                                                 size_t    stride,
+                                                 F const & cmp ) noexcept
+{
+    ZI_ASSERT(end>=head1);
+
+    size_t n = static_cast<size_t>(end - head1) / stride + 1;
+    if ( n < size ) return;
+
+    static thread_local std::vector<real> gv, hv;
+
+    gv.resize(n); hv.resize(n);
+
+    for ( size_t i = 0; i < n; ++i )
+    {
+        real v = head1[i*stride];
+        gv[i] = ( i % size == 0 || cmp(v, gv[i-1]) ) ? v : gv[i-1];
+    }
+
+    for ( size_t i = n; i-- > 0; )
+    {
+        real v = head1[i*stride];
+        hv[i] = ( i % size == size - 1 || i == n - 1 || !cmp(hv[i+1], v) )
+            ? v : hv[i+1];
+    }
+
+    for ( size_t i = 0; i + size <= n; ++i )
+    {
+        size_t j = i + size - 1;
+        head1[i*stride] = cmp(gv[j], hv[i]) ? gv[j] : hv[i];
+    }
+}
+
 template<typename F>
 inline void pooling_filter_pass_no_indices( real *  head1,
                                             real *  end,
@@ -229,7 +366,7 @@ inline void pooling_filter_pass_no_indices( real *  head1,
         return;
     }
 
-    UNIMPLEMENTED();
+    pooling_filter_pass_vhgw_no_indices(head1, end, size, stride, cmp);
 }
 
 
@@ -37,6 +37,8 @@
 
 #include "log.hpp"
 #include "global_task_manager.hpp"
+#include "numa.hpp"
+#include "task_trace.hpp"
 
 namespace znn { namespace v4 {
 
@@ -95,6 +97,8 @@ private:
     std::condition_variable manager_cv_;
     std::condition_variable workers_cv_;
 
+    task_tracer             tracer_;
+
     list<task_handle>                   unprivileged_  ;
     list<regular_task*>                 tasks_         ;
     list<regular_task*>                 local_tasks_[1000];
@@ -118,8 +122,12 @@ private:
             }
         }
 
+        pin_to_numa_node(znn_thread_id - 1);
+
         task_handle f2;
 
+        task_trace_event event;
+
         while (true)
         {
             regular_task* f1 = nullptr;
@@ -158,6 +166,10 @@ private:
 
             }
 
+            // the tasks have no priorities
+            bool traced = tracer_.begin(event, znn_thread_id - 1, 0,
+                                        f1 == nullptr);
+
             if ( f1 )
             {
                 f1->fn();
@@ -169,6 +181,8 @@ private:
             {
                 execute_unprivileged_task(f2);
             }
+
+            if ( traced ) tracer_.finish(event);
         }
     }
 
@@ -245,6 +259,25 @@ public:
         return concurrency_;
     }
 
+    // starts recording the executed tasks
+    void start_trace()
+    {
+        tracer_.start();
+    }
+
+    // stops recording, waits for the running tasks and returns the
+    // recorded ones
+    std::vector<task_trace_event> stop_trace()
+    {
+        return tracer_.stop();
+    }
+
+    // the tag of the tasks started from now on
+    void set_trace_tag( std::size_t t )
+    {
+        tracer_.set_tag(t);
+    }
+
     std::size_t get_concurrency()
     {
         std::lock_guard<std::mutex> g(mutex_);
@@ -257,6 +290,14 @@ public:
         return idle_threads_;
     }
 
+    // whether no task is queued or running
+    bool idle()
+    {
+        std::lock_guard<std::mutex> g(mutex_);
+        return tasks_.empty() && unprivileged_.empty() &&
+            idle_threads_ == spawned_threads_;
+    }
+
     std::size_t active_threads()
     {
         std::lock_guard<std::mutex> g(mutex_);
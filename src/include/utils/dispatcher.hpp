@@ -141,10 +141,16 @@ private:
                        std::vector<FFTEdge*> const & targets,
                        task_manager & manager )
     {
+        // the transform is shared by the targets, traced as the first's
+        task_tracer::set_group(targets.front()->trace_group());
+
         ccube_p<complex> x = fftw_[s]->forward_pad(v);
         for ( auto& t: targets )
         {
-            manager.schedule(t->fwd_priority(), [t,x](){t->forward(x);});
+            manager.schedule(t->fwd_priority(), [t,x](){
+                    task_tracer::set_group(t->trace_group());
+                    t->forward(x);
+                });
         }
     }
 
@@ -153,7 +159,10 @@ public:
                    task_manager & manager)
     {
         for ( auto& t: targets_ )
-            manager.schedule(t->fwd_priority(), [t,v](){t->forward(v);});
+            manager.schedule(t->fwd_priority(), [t,v](){
+                    task_tracer::set_group(t->trace_group());
+                    t->forward(v);
+                });
 
         for ( auto& fft_target: fft_targets_ )
             manager.asap(&this_type::fft_dispatch,this,v,fft_target.first,
@@ -193,6 +202,9 @@ private:
                        const std::vector<FFTEdge*>& targets,
                        task_manager& manager )
     {
+        // the transform is shared by the targets, traced as the first's
+        task_tracer::set_group(targets.front()->trace_group());
+
         auto vp = get_copy(*v);
         flip(*vp);
 
@@ -200,7 +212,10 @@ private:
 
         for ( auto& t: targets )
         {
-            manager.schedule(t->bwd_priority(), [t,x](){t->backward(x);});
+            manager.schedule(t->bwd_priority(), [t,x](){
+                    task_tracer::set_group(t->trace_group());
+                    t->backward(x);
+                });
         }
     }
 
@@ -208,7 +223,10 @@ public:
     void dispatch(const ccube_p<real>& v, task_manager& manager)
     {
         for ( auto& t: targets_ )
-            manager.schedule(t->bwd_priority(), [t,v](){t->backward(v);});
+            manager.schedule(t->bwd_priority(), [t,v](){
+                    task_tracer::set_group(t->trace_group());
+                    t->backward(v);
+                });
 
         for ( auto& fft_target: fft_targets_ )
             manager.asap(&this_type::fft_dispatch,this,v,fft_target.first,
@@ -0,0 +1,172 @@
+//
+// Copyright (C) 2012-2015  Aleksandar Zlateski <zlateski@mit.edu>
+// ---------------------------------------------------------------
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+//
+#pragma once
+
+#include "../types.hpp"
+
+#include <zi/utility/singleton.hpp>
+
+#include <cstdlib>
+#include <fstream>
+#include <new>
+#include <sstream>
+#include <string>
+#include <thread>
+#include <vector>
+
+#ifdef ZNN_NUMA
+#  include <sched.h>
+#  include <sys/mman.h>
+#endif
+
+// With ZNN_NUMA defined, the workers of the task managers are pinned to
+// the cpus of the NUMA nodes (round robin), and the cube pools keep
+// separate memory for each node. Linux places the pages on the node of
+// the thread which first touches them, so the cubes allocated by a
+// worker stay local to its node. Without ZNN_NUMA there is a single node
+// and nothing is pinned.
+
+namespace znn { namespace v4 {
+
+class numa_topology_impl
+{
+private:
+    std::vector<std::vector<int>> cpus_;
+
+    // parses lists like "0-9,20-29"
+    static std::vector<int> parse_cpulist( std::string const & s )
+    {
+        std::vector<int> ret;
+        std::istringstream iss(s);
+        std::string range;
+        while ( std::getline(iss, range, ',') )
+        {
+            if ( range.empty() ) continue;
+            auto p = range.find('-');
+            int from = std::atoi(range.substr(0,p).c_str());
+            int to   = ( p == std::string::npos ) ? from
+                : std::atoi(range.substr(p+1).c_str());
+            for ( int c = from; c <= to; ++c ) ret.push_back(c);
+        }
+        return ret;
+    }
+
+public:
+    numa_topology_impl()
+        : cpus_()
+    {
+#ifdef ZNN_NUMA
+        for ( int n = 0; n < 256; ++n )
+        {
+            std::ifstream f("/sys/devices/system/node/node"
+                            + std::to_string(n) + "/cpulist");
+            std::string line;
+            if ( f && std::getline(f, line) )
+            {
+                auto cpus = parse_cpulist(line);
+                if ( cpus.size() ) cpus_.push_back(cpus);
+            }
+        }
+#endif
+        if ( cpus_.empty() )
+        {
+            cpus_.resize(1);
+            for ( int c = 0; c < static_cast<int>
+                      (std::thread::hardware_concurrency()); ++c )
+            {
+                cpus_[0].push_back(c);
+            }
+        }
+    }
+
+    std::size_t nodes() const
+    {
+        return cpus_.size();
+    }
+
+    std::vector<int> const & cpus( std::size_t node ) const
+    {
+        return cpus_[node];
+    }
+};
+
+namespace {
+numa_topology_impl& numa_topology =
+    zi::singleton<numa_topology_impl>::instance();
+} // anonymous namespace
+
+inline std::size_t numa_node_count()
+{
+    return zi::singleton<numa_topology_impl>::instance().nodes();
+}
+
+// the node the calling thread is pinned to (0 if not pinned)
+inline std::size_t& this_thread_numa_node()
+{
+    static thread_local std::size_t node = 0;
+    return node;
+}
+
+// pins the calling thread to the cpus of node i % numa_node_count()
+inline void pin_to_numa_node( std::size_t i )
+{
+#ifdef ZNN_NUMA
+    auto& topo = zi::singleton<numa_topology_impl>::instance();
+    if ( topo.nodes() < 2 ) return;
+
+    std::size_t node = i % topo.nodes();
+
+    cpu_set_t set;
+    CPU_ZERO(&set);
+    for ( int c: topo.cpus(node) ) CPU_SET(c, &set);
+
+    if ( sched_setaffinity(0, sizeof(set), &set) == 0 )
+    {
+        this_thread_numa_node() = node;
+    }
+#else
+    (void)i;
+#endif
+}
+
+#ifdef ZNN_NUMA
+
+// 64 byte aligned memory, blocks of 2MB and more are aligned to (and
+// advised to be backed by) transparent huge pages
+inline void* znn_numa_malloc( std::size_t s )
+{
+    static const std::size_t huge_page = 2 * 1024 * 1024;
+
+    std::size_t align = ( s >= huge_page ) ? huge_page : 64;
+
+    void* r = nullptr;
+    if ( posix_memalign(&r, align, s) ) throw std::bad_alloc();
+
+#ifdef MADV_HUGEPAGE
+    if ( align == huge_page )
+    {
+        madvise(r, s & ~(huge_page-1), MADV_HUGEPAGE);
+    }
+#endif
+
+    return r;
+}
+
+#endif
+
+}} // namespace znn::v4
@@ -37,6 +37,8 @@
 
 #include "log.hpp"
 #include "global_task_manager.hpp"
+#include "numa.hpp"
+#include "task_trace.hpp"
 
 #ifdef ZNN_DFS_TASK_SCHEDULER
 #  include "dfs_task_manager.hpp"
@@ -107,9 +109,13 @@ private:
     std::condition_variable manager_cv_;
     std::condition_variable workers_cv_;
 
+    task_tracer             tracer_;
+
 private:
     void worker_loop()
     {
+        std::size_t worker_id = 0;
+
         {
             std::lock_guard<std::mutex> g(mutex_);
 
@@ -118,18 +124,23 @@ private:
                 return;
             }
 
-            ++spawned_threads_;
+            worker_id = spawned_threads_++;
             if ( spawned_threads_ == concurrency_ )
             {
                 manager_cv_.notify_all();
             }
         }
 
+        pin_to_numa_node(worker_id);
+
         task_handle f2;
 
+        task_trace_event event;
+
         while (true)
         {
             callable_t* f1 = nullptr;
+            std::size_t priority = 0;
 
             {
                 std::unique_lock<std::mutex> g(mutex_);
@@ -155,6 +166,7 @@ private:
 
                 if ( tasks_.size() )
                 {
+                    priority = tasks_.rbegin()->first;
                     f1 = next_task();
                 }
                 else
@@ -165,6 +177,8 @@ private:
 
             }
 
+            bool traced = tracer_.begin(event, worker_id, priority, f1 == nullptr);
+
             if ( f1 )
             {
                 (*f1)();
@@ -176,6 +190,8 @@ private:
             {
                 execute_unprivileged_task(f2);
             }
+
+            if ( traced ) tracer_.finish(event);
         }
     }
 
@@ -252,6 +268,25 @@ public:
         return concurrency_;
     }
 
+    // starts recording the executed tasks
+    void start_trace()
+    {
+        tracer_.start();
+    }
+
+    // stops recording, waits for the running tasks and returns the
+    // recorded ones
+    std::vector<task_trace_event> stop_trace()
+    {
+        return tracer_.stop();
+    }
+
+    // the tag of the tasks started from now on
+    void set_trace_tag( std::size_t t )
+    {
+        tracer_.set_tag(t);
+    }
+
     std::size_t get_concurrency()
     {
         std::lock_guard<std::mutex> g(mutex_);
@@ -264,6 +299,14 @@ public:
         return idle_threads_;
     }
 
+    // whether no task is queued or running
+    bool idle()
+    {
+        std::lock_guard<std::mutex> g(mutex_);
+        return tasks_.empty() && unprivileged_.empty() &&
+            idle_threads_ == spawned_threads_;
+    }
+
     std::size_t active_threads()
     {
         std::lock_guard<std::mutex> g(mutex_);
@@ -0,0 +1,153 @@
+//
+// Copyright (C) 2012-2015  Aleksandar Zlateski <zlateski@mit.edu>
+// ---------------------------------------------------------------
+//
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+//
+#pragma once
+
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <cstdint>
+#include <mutex>
+#include <vector>
+
+namespace znn { namespace v4 {
+
+struct task_trace_event
+{
+    std::size_t  worker      ;
+    std::size_t  priority    ;
+    bool         unprivileged;
+    std::size_t  tag         ; // set by the owner of the manager
+    std::size_t  group       ; // set by the task, 0 if not set
+    std::int64_t start       ; // microseconds since the start of the trace
+    std::int64_t end         ;
+};
+
+// Records the execution of the tasks of a task manager while enabled.
+// The workers begin an event before running a task and finish it right
+// after, under the tracer's own lock. stop() waits for the events in
+// flight, so the last tasks of a pass are never missing from the trace.
+class task_tracer
+{
+private:
+    typedef std::chrono::steady_clock clock_type;
+
+    std::mutex                    m_        ;
+    std::condition_variable       cv_       ;
+    std::atomic<bool>             enabled_  ;
+    std::atomic<std::size_t>      tag_      ;
+    std::atomic<std::int64_t>     t0_       ; // clock ticks at the start
+    std::size_t                   in_flight_;
+    std::vector<task_trace_event> events_   ;
+
+    static std::int64_t ticks()
+    {
+        return clock_type::now().time_since_epoch().count();
+    }
+
+    // the group of the task run by the calling thread
+    static std::size_t & current_group()
+    {
+        static thread_local std::size_t group = 0;
+        return group;
+    }
+
+    std::int64_t now() const
+    {
+        return std::chrono::duration_cast<std::chrono::microseconds>
+            ( clock_type::duration(ticks() - t0_.load()) ).count();
+    }
+
+public:
+    task_tracer()
+        : m_()
+        , cv_()
+        , enabled_(false)
+        , tag_(0)
+        , t0_(ticks())
+        , in_flight_(0)
+        , events_()
+    {}
+
+    bool enabled() const
+    {
+        return enabled_.load(std::memory_order_relaxed);
+    }
+
+    void set_tag( std::size_t t )
+    {
+        tag_.store(t, std::memory_order_relaxed);
+    }
+
+    // called by a running task to label its event (e.g. with the edge
+    // group computing it), cheap enough to be called when not tracing
+    static void set_group( std::size_t g )
+    {
+        current_group() = g;
+    }
+
+    void start()
+    {
+        std::lock_guard<std::mutex> g(m_);
+        events_.clear();
+        t0_ = ticks();
+        enabled_ = true;
+    }
+
+    // stops recording, waits for the events in flight
+    std::vector<task_trace_event> stop()
+    {
+        std::unique_lock<std::mutex> g(m_);
+        enabled_ = false;
+        while ( in_flight_ ) cv_.wait(g);
+
+        std::vector<task_trace_event> ret;
+        ret.swap(events_);
+        return ret;
+    }
+
+    // begins the event of a task, returns false if not recording
+    bool begin( task_trace_event & e,
+                std::size_t worker,
+                std::size_t priority,
+                bool unprivileged )
+    {
+        if ( !enabled() ) return false;
+
+        std::lock_guard<std::mutex> g(m_);
+        if ( !enabled() ) return false;
+
+        ++in_flight_;
+        current_group() = 0;
+        e = { worker, priority, unprivileged,
+              tag_.load(std::memory_order_relaxed), 0, now(), 0 };
+        return true;
+    }
+
+    // records the event of a finished task (begun by begin)
+    void finish( task_trace_event & e )
+    {
+        e.end   = now();
+        e.group = current_group();
+
+        std::lock_guard<std::mutex> g(m_);
+        events_.push_back(e);
+        if ( --in_flight_ == 0 ) cv_.notify_all();
+    }
+};
+
+}} // namespace znn::v4